@@ -37,6 +37,11 @@ type dependency_type =
 	| BuildTime
 	| AlwaysRebuild
 	| ClobbersTarget
+	(* only written by the python implementation (format version 4) *)
+	| ContentDependency
+	| BuildStats
+	| WaitTime
+	| CriticalPath
 
 module Log = (val Var.log_module "gup.state")
 let meta_dir_name = PathComponent.name_of_string ".gup"
@@ -45,6 +50,8 @@ let new_deps_ext = "deps2"
 
 let empty_field = "-"
 let format_version = 3
+(* version 4 adds the content, stats, waited and critical lines *)
+let readable_format_versions = [3; 4]
 let version_marker = "version: "
 
 (* exceptionless helpers *)
@@ -98,6 +105,10 @@ let string_of_dependency_type = function
 	| Builder -> "builder"
 	| AlwaysRebuild -> "always"
 	| ClobbersTarget -> "clobbers"
+	| ContentDependency -> "content"
+	| BuildStats -> "stats"
+	| WaitTime -> "waited"
+	| CriticalPath -> "critical"
 
 
 let serializable_dependencies = [
@@ -108,6 +119,10 @@ let serializable_dependencies = [
 	{ tag = Builder; num_fields = 3; };
 	{ tag = AlwaysRebuild; num_fields = 0; };
 	{ tag = ClobbersTarget; num_fields = 0; };
+	{ tag = ContentDependency; num_fields = 3; };
+	{ tag = BuildStats; num_fields = 4; };
+	{ tag = WaitTime; num_fields = 1; };
+	{ tag = CriticalPath; num_fields = 1; };
 ]
 
 let tag_assoc     = serializable_dependencies |> List.map (fun dep -> (dep.tag, dep))
@@ -346,6 +361,17 @@ and dependency_builder ~var target_path (input:Lwt_io.input_channel) = object
 								(RelativeFrom.of_field ~basedir path))
 					| (BuildTime, [time]) -> Some (new build_time (Big_int.big_int_of_string time))
 					| (AlwaysRebuild, []) -> Some (new always_rebuild)
+					(* the checksum is of the file's contents, which we don't check -
+					 * just treat it as a (more conservative) mtime dependency *)
+					| (ContentDependency, [mtime; _cs; path]) ->
+							Some (new file_dependency
+								~mtime:(parse_mtime mtime)
+								~checksum:None
+								(RelativeFrom.of_field ~basedir path)
+							)
+					| (BuildStats, [_; _; _; _]) -> None
+					| (WaitTime, [_]) -> None
+					| (CriticalPath, [_]) -> None
 					| _ -> Error.raise_safe "Invalid dependency line: %s" line
 			in
 			let%lwt rules = Lwt_io.read_lines input
@@ -373,7 +399,7 @@ and dependency_builder ~var target_path (input:Lwt_io.input_channel) = object
 			match version_number with
 				| None -> raise Invalid_dependency_file
 				| Some v ->
-					if v <> format_version then
+					if not (List.mem v readable_format_versions) then
 						raise @@ Version_mismatch ("can't read format version: " ^ (string_of_int v))
 			;
 			_parse input rv
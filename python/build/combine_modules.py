@@ -33,12 +33,15 @@ def main():
 
 	here = os.path.dirname(os.path.abspath(__file__))
 
+	# standalone modules (run with `python -m`), which gup itself doesn't use
+	standalone = ['cache_server.py']
+
 	def is_interesting(filename):
-		return filename.endswith('.py') and not filename == '__init__.py'
+		return filename.endswith('.py') and not filename == '__init__.py' and filename not in standalone
 
 	existing_files = set(filter(is_interesting, os.listdir(root)))
 	
-	files = [mod + '.py' for mod in 'whichcraft var log path version error util parallel gupfile state builder task cmd'.split()]
+	files = [mod + '.py' for mod in 'rpc whichcraft var log path version error timeline summary selfprofile util parallel gupfile revdeps state remote cache watch daemon builder task cmd'.split()]
 	assert set(files) == existing_files, "file mismatch:\n%r\n%r" % (sorted(files), sorted(existing_files))
 
 	mods = []
@@ -113,6 +116,11 @@ def main():
 					line = re.sub('(.*getLogger\()__name__', r"\1'gup.%s'" % (mod,), line)
 					output.write(line + '\n')
 
+				if mod == 'rpc':
+					# forward nested invocations to the coordinator
+					# before loading the remaining modules
+					output.write("\nif __name__ == '__main__': forward_and_exit(sys.argv[1:])\n")
+
 		assert main_section, "No main section found!"
 		output.write('\n'.join(main_section))
 
@@ -1,29 +1,58 @@
 from __future__ import print_function
 import os
+import sys
 from os import path
 import errno
 import subprocess
 import logging
 from shlex import quote
 
-from .gupfile import Builder
+import time
+from .gupfile import Builder, clear_resolution_cache, save_caches
 from .error import *
 from .util import *
-from .state import TargetState
+from .state import TargetState, FileDependency, BaseFileDependency, ResourceUsage, critical_path, flush_dependencies
 from .log import getLogger
-from .var import ROOT_CWD, XTRACE, IS_WINDOWS, keep_failed_outputs
+from .var import ROOT_CWD, IS_WINDOWS, xtrace, keep_failed_outputs, speculate
 from .path import resolve_base
-from .parallel import extend_build_env
+from .parallel import extend_build_env, is_parallel, try_start_job, wait_jobs
+from .daemon import query_daemon, report_clean
+from .timeline import timeline_span
+from .summary import summary_count
+from .selfprofile import set_profile_label
+from .cache import output_cache, content_checksum
 _log = getLogger(__name__)
 
 def prepare_build(p):
 	p = resolve_base(p)
-	builder = Builder.for_target(p)
+	with timeline_span('resolve', 'resolve', target=p):
+		builder = Builder.for_target(p)
 	_log.trace('prepare_build(%r) -> %r' % (p, builder))
 	if builder is not None:
 		return Target(builder)
 	return None
 
+# Dirty-check results for this process, keyed by resolved target path.
+# Each node is only checked once, no matter how many paths
+# through the dependency graph reach it.
+_CLEAN = 'clean'
+_DIRTY = 'dirty'
+_BUILT = 'built'
+_dirty_memo = {}
+
+def _memoized_dirty(key, allow_build):
+	'''
+	Returns the memoized result for `key`, or None if
+	it needs to be checked.
+	'''
+	state = _dirty_memo.get(key, None)
+	if state is _CLEAN:
+		return False
+	if state is _BUILT or (state is _DIRTY and not allow_build):
+		return True
+	# not yet checked (or only checked without building)
+	return None
+
 def _build_parent_if_dirty(target, allow_build):
 	if target.builder.parent is not None:
 		return _build_if_dirty(Target(target.builder.parent), allow_build)
@@ -42,7 +71,25 @@ def _build_if_dirty(target, allow_build):
 		return True
 
 	def build_target_if_dirty(target):
+		key = resolve_base(target.path)
+		dirty = _memoized_dirty(key, allow_build)
+		if dirty is None:
+			with timeline_span('check', 'check', target=target.path):
+				dirty = check_target(target, key)
+			_dirty_memo[key] = (_BUILT if allow_build else _DIRTY) if dirty else _CLEAN
+		else:
+			_log.trace("%s: memoized result is %r", target.path, _dirty_memo[key])
+		return dirty
+
+	def check_target(target, key):
 		_log.debug("build_target_if_dirty: %r", target)
+		summary_count('checked')
+		token = query_daemon(key)
+		if token is True:
+			_log.trace("CLEAN: %s (according to gup daemon)", target.path)
+			summary_count('clean')
+			return False
+
 		if _build_parent_if_dirty(target, allow_build):
 			_log.debug("DIRTY: builder was rebuilt")
 			return perform_build(target)
@@ -63,11 +110,16 @@ def _build_if_dirty(target, allow_build):
 			else:
 				built_children.add(path)
 				_log.trace("Recursing over dependency: %s -> %s", target.path, path)
+				key = resolve_base(path)
+				child_dirty = _memoized_dirty(key, allow_build)
+				if child_dirty is not None:
+					return child_dirty
 				child = prepare_build(path)
 				if child is not None:
 					child_dirty = build_target_if_dirty(child)
 					_log.trace("_is_dirty(%s) -> %s", child, child_dirty)
 					return child_dirty
+				_dirty_memo[key] = _CLEAN
 				return False
 
 		if not allow_build:
@@ -84,10 +136,81 @@ def _build_if_dirty(target, allow_build):
 		_log.trace("deps.is_dirty(%r) -> %r", target.path, dirty)
 		if dirty:
 			return perform_build(target)
+		if deps.refreshed:
+			target.state.save_refreshed(deps)
+		report_clean(key, token)
+		summary_count('clean')
 		return False
 
 	return build_target_if_dirty(target)
 
+class Speculation(object):
+	'''
+	Builds the dependencies recorded by a target's previous build alongside
+	its build script (whenever jobserver tokens are free), so that the
+	script's own `gup -u` calls mostly find them already built.
+
+	Nothing is recorded for these builds, so a dependency which
+	the script no longer uses is merely built for nothing.
+	'''
+	# how often to check for finished jobs / free tokens
+	# while the build script is running
+	POLL_INTERVAL = 0.05
+
+	def __init__(self, target, deps):
+		self.target = target
+		base = os.path.dirname(target.path)
+		self.pending = []
+		for rule in deps.rules:
+			if isinstance(rule, FileDependency):
+				path = rule.full_path(base)
+				if _dirty_memo.get(resolve_base(path), None) is None:
+					# not already checked by this process
+					self.pending.append(path)
+		if len(self.pending) > 1:
+			# start the longest chains first
+			self.pending.sort(key=lambda path: critical_path(TargetState(path)), reverse=True)
+		self.running = 0
+
+	def start(self):
+		while self.pending:
+			child = prepare_build(self.pending[0])
+			if child is not None:
+				if not try_start_job(lambda: self._build(child), self._done(child)):
+					# no free tokens
+					return
+				_log.trace("speculatively building %s", child.path)
+				self.running += 1
+			self.pending.pop(0)
+
+	def _build(self, child):
+		set_profile_label(child.path)
+		child.build_or_update(update=True)
+		flush_dependencies()
+		save_caches()
+
+	def _done(self, child):
+		def done(rv):
+			self.running -= 1
+			if rv != 0:
+				_log.debug("speculative build of %s failed (status %d)", child.path, rv)
+		return done
+
+	def run_alongside(self, proc):
+		while proc.poll() is None:
+			self.start()
+			if self.running:
+				wait_jobs(self.POLL_INTERVAL)
+			elif self.pending:
+				time.sleep(self.POLL_INTERVAL)
+			else:
+				return
+
+	def finish(self):
+		self.pending = []
+		while self.running:
+			wait_jobs(None)
+
 class Target(object):
 	def __init__(self, builder):
 		self.builder = builder
@@ -113,7 +236,88 @@ class Target(object):
 		return _build_if_dirty(self, allow_build = False)
 
 	def perform_build(self, from_update):
-		self.state.perform_build(self.builder, lambda deps: self._perform_build(deps, from_update))
+		cache = output_cache()
+		if cache is None:
+			with timeline_span('build', 'build', target=self.path):
+				self.state.perform_build(self.builder, lambda deps: self._perform_build(deps, from_update))
+			return
+
+		trace_key = None
+		if from_update:
+			trace_key = cache.trace_key(self.builder, self.path)
+			# fetched while we wait for the target's locks
+			cache.prefetch_traces(trace_key)
+
+		restored = []
+		def build(deps):
+			# a forced build always runs the build script
+			if from_update and self._restore_from_cache(cache, trace_key):
+				restored.append(True)
+				return True
+			return self._perform_build(deps, from_update)
+
+		def store(deps):
+			if restored:
+				return
+			try:
+				if cache.store(self.builder, self.path, deps):
+					summary_count('cache_stores')
+			except (OSError, IOError, ValueError) as e:
+				_log.warning("Unable to cache %s: %s", os.path.relpath(self.path, ROOT_CWD), e)
+
+		with timeline_span('build', 'build', target=self.path):
+			self.state.perform_build(self.builder, build, store)
+
+	def _restore_from_cache(self, cache, trace_key):
+		'''
+		Assumes locks are held (by state.perform_build).
+		Returns whether the target was restored from `cache`.
+		'''
+		with timeline_span('cache lookup', 'cache', target=self.path):
+			base = os.path.dirname(self.path)
+			for trace in cache.traces(trace_key):
+				cache.prefetch(trace)
+				for dep_path, checksum in trace.deps:
+					path = os.path.normpath(os.path.join(base, dep_path))
+					# make sure it's up to date, as the build script would
+					try:
+						child = prepare_build(path)
+						if child is not None:
+							_build_if_dirty(child, True)
+						current = content_checksum(path)
+					except (SafeError, ValueError) as e:
+						# leave it to the build script
+						_log.debug("cache: unable to check %s: %s", dep_path, e)
+						break
+					if current != checksum:
+						_log.trace("cache: %s has changed", dep_path)
+						break
+				else:
+					output_file = os.path.abspath(self.state.meta_path('out'))
+					try_remove(output_file)
+					rules = cache.restore(trace, output_file)
+					if rules is None:
+						_log.trace("cache: output %s is missing", trace.output)
+						continue
+					self._install_output(output_file)
+					for rule in rules:
+						if isinstance(rule, BaseFileDependency) and rule.mtime is not None:
+							rule.mtime = get_mtime(rule.full_path(base))
+						self.state.add_dependency(rule)
+					_log.info("%s (cached)", os.path.relpath(self.path, ROOT_CWD))
+					summary_count('cache_hits')
+					return True
+		summary_count('cache_misses')
+		cache.count('misses')
+		return False
+
+	def _install_output(self, output_file):
+		if os.path.lexists(self.path) and (
+			lisdir(self.path) or lisdir(output_file)
+		):
+			_log.trace("removing previous %s", self.path)
+			try_remove(self.path)
+		rename(output_file, self.path)
 
 	def _perform_build(self, deps, from_update):
 		'''
@@ -148,18 +352,29 @@ class Target(object):
 			if exe is not None:
 				args = exe + args
 
-			if XTRACE:
+			if xtrace():
 				_log.info(' # %s'% (os.path.abspath(basedir),))
 				_log.info(' + ' + ' '.join(map(quote, args)))
 			else:
 				_log.trace(' from cwd: %s'% (os.path.abspath(basedir),))
 				_log.trace('executing: ' + ' '.join(map(quote, args)))
 
+			speculation = None
+			if deps is not None and speculate() and is_parallel():
+				speculation = Speculation(self, deps)
+				speculation.start()
+
 			try:
-				ret = self._run_process(args, cwd = basedir, env = env)
+				ret = self._run_process(args, cwd = basedir, env = env, speculation = speculation)
 			except OSError:
 				if exe: raise # we only expect errors when we could deduce no executable
 				raise SafeError("%s is not executable and has no shebang line" % (exe_path_relative_to_cwd))
+			finally:
+				if speculation is not None:
+					speculation.finish()
+
+			# the build script may have created or removed builders
+			clear_resolution_cache()
 
 			new_mtime = get_mtime(self.path)
 			target_changed = mtime != new_mtime
@@ -173,12 +388,7 @@ class Target(object):
 						_log.warning("%s modified %s directly" % (exe_path_relative_to_cwd, self.path))
 			if ret == 0:
 				if os.path.lexists(output_file):
-					if os.path.lexists(self.path) and (
-						lisdir(self.path) or lisdir(output_file)
-					):
-						_log.trace("removing previous %s", self.path)
-						try_remove(self.path)
-					rename(output_file, self.path)
+					self._install_output(output_file)
 				else:
 					if (not target_changed) and (os.path.lexists(self.path)) and (not os.path.islink(self.path)):
 						_log.warning("Removing stale target: %s", target_relative_to_cwd)
@@ -198,14 +408,57 @@ class Target(object):
 		return True
 
 	
-	def _run_process(self, args, cwd, env):
-		try:
-			proc = subprocess.Popen(args, cwd = cwd, env = env, close_fds=False)
-		except OSError as e:
-			if e.errno == errno.ENOENT:
-				raise SafeError("Executable not found: %s" % (args[0],))
-			raise e
-		return proc.wait()
+	def _run_process(self, args, cwd, env, speculation=None):
+		with timeline_span('exec', 'exec', target=self.path):
+			try:
+				proc = _BuildProcess(args, cwd = cwd, env = env)
+			except OSError as e:
+				if e.errno == errno.ENOENT:
+					raise SafeError("Executable not found: %s" % (args[0],))
+				raise e
+			if speculation is not None:
+				speculation.run_alongside(proc)
+			ret = proc.wait()
+		self.state.usage = proc.usage
+		return ret
+
+class _BuildProcess(object):
+	'''
+	A running build script, which is reaped with os.wait4 (where
+	available) so that its resource usage can be recorded.
+	'''
+	def __init__(self, args, cwd, env):
+		self.start = time.time()
+		self.proc = subprocess.Popen(args, cwd = cwd, env = env, close_fds=False)
+		self.usage = None
+
+	def poll(self):
+		return self._wait(os.WNOHANG if _HAS_WAIT4 else None)
+
+	def wait(self):
+		return self._wait(0)
+
+	def _wait(self, options):
+		proc = self.proc
+		if proc.returncode is not None:
+			return proc.returncode
+		if not _HAS_WAIT4:
+			ret = proc.wait() if options == 0 else proc.poll()
+			if ret is not None:
+				self.usage = ResourceUsage(time.time() - self.start, 0, 0)
+			return ret
+		pid, status, rusage = os.wait4(proc.pid, options)
+		if pid == 0:
+			return None
+		proc.returncode = os.waitstatus_to_exitcode(status)
+		maxrss = rusage.ru_maxrss
+		if sys.platform == 'darwin':
+			maxrss //= 1024 # bytes, not KiB
+		self.usage = ResourceUsage(time.time() - self.start, rusage.ru_utime + rusage.ru_stime, maxrss)
+		_log.trace("%s used %.3fs (%.3fs cpu, %dKiB maxrss)", self.proc.args[-1], *self.usage)
+		return proc.returncode
+
+_HAS_WAIT4 = hasattr(os, 'wait4')
 
 def _guess_executable(p):
 	with open(p, 'rb') as f:
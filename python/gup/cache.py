@@ -0,0 +1,546 @@
+'''
+A content-addressed cache of build outputs (enabled by $GUP_CACHE).
+
+A target's output depends on its builder and the contents of whatever
+the builder read, but we only know what that was once it's been built.
+So the cache is two-level:
+
+	traces/<key>:   for each builder (and target name), the dependencies
+	                recorded by each build along with their checksums
+	outputs/<key>:  the output of a build, keyed by the builder and the
+	                checksums of its dependencies
+
+To restore a target, each trace is checked in turn (building its
+dependencies as necessary, just as the build script would), and
+the output of the first whose dependencies are unchanged is used.
+Paths are relative to the target, so checkouts can share a cache.
+
+Each entry's `meta` file is touched whenever it's used, and the least
+recently used entries are evicted once the cache grows beyond
+$GUP_CACHE_SIZE. (Access times themselves are unreliable, since reads
+only update them occasionally on most filesystems.) Entries are read and
+written with the cache's lock held (shared), and only removed with it
+held exclusively.
+
+With $GUP_REMOTE_CACHE, traces and outputs which aren't stored locally
+are downloaded from a remote cache (see remote.py), and new outputs are
+uploaded to it.
+'''
+import os
+import io
+import re
+import stat
+import time
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import collections
+
+from .log import getLogger
+from .error import SafeError
+from .util import mkdirp, get_mtime, try_remove, rmtree
+from .var import cache_dir, cache_size
+from .parallel import Lock
+from .gupfile import register_cache
+from .remote import remote_cache
+from .state import Dependency, BuilderDependency, AlwaysRebuild, BuildTime, Checksum
+_log = getLogger(__name__)
+
+# bump to invalidate existing caches
+_CACHE_VERSION = '1'
+
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(text):
+	'''
+	>>> parse_size('1024'), parse_size('1.5k'), parse_size('10G')
+	(1024, 1536, 10737418240)
+	'''
+	match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', text, re.IGNORECASE)
+	try:
+		if match is None: raise ValueError()
+		return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+	except ValueError:
+		raise SafeError("Invalid cache size: %s" % (text,))
+
+def format_size(size):
+	'''
+	>>> format_size(100), format_size(1536), format_size(10 * 1024 ** 3)
+	('100B', '1.5KB', '10.0GB')
+	'''
+	if size < 1024:
+		return '%dB' % (size,)
+	for unit in 'KMGT':
+		size /= 1024.0
+		if size < 1024 or unit == 'T':
+			return '%.1f%sB' % (size, unit)
+
+def content_checksum(path):
+	'''
+	A checksum of whatever is at `path` (a file, symlink or
+	directory), or None if nothing is.
+	'''
+	try:
+		st = os.lstat(path)
+	except OSError as e:
+		if e.errno in (errno.ENOENT, errno.ENOTDIR):
+			return None
+		raise
+	if stat.S_ISLNK(st.st_mode):
+		return 'link:' + os.readlink(path)
+	if stat.S_ISDIR(st.st_mode):
+		sh = hashlib.sha256()
+		for name in sorted(os.listdir(path)):
+			sh.update(('%s\0%s\n' % (name, content_checksum(os.path.join(path, name)))).encode('utf-8'))
+		return 'dir:' + sh.hexdigest()
+	if not stat.S_ISREG(st.st_mode):
+		raise ValueError("Can't checksum special file %s" % (path,))
+	value = Checksum.from_file(path).value
+	if st.st_mode & stat.S_IXUSR:
+		value = 'exe:' + value
+	return value
+
+def _key(*parts):
+	sh = hashlib.sha256()
+	for part in parts:
+		sh.update(part.encode('utf-8') + b'\0')
+	return sh.hexdigest()
+
+def _copy(src, dest):
+	'''
+	Copy a file, symlink or directory (without following symlinks)
+	'''
+	if os.path.islink(src):
+		os.symlink(os.readlink(src), dest)
+	elif os.path.isdir(src):
+		shutil.copytree(src, dest, symlinks=True)
+	else:
+		shutil.copyfile(src, dest)
+		shutil.copymode(src, dest)
+
+def _size(path):
+	st = os.lstat(path)
+	if not stat.S_ISDIR(st.st_mode):
+		return st.st_size
+	return sum(_size(os.path.join(path, name)) for name in os.listdir(path))
+
+# a recorded build: `deps` is a list of (path, checksum) and
+# `output` is the key of its output
+CacheTrace = collections.namedtuple('CacheTrace', 'deps output')
+
+class OutputCache(object):
+	def __init__(self, root, remote=None):
+		self.root = root
+		self.remote = remote
+
+	def _path(self, kind, key):
+		return os.path.join(self.root, kind, key[:2], key)
+
+	def _lock(self):
+		mkdirp(self.root)
+		return Lock(os.path.join(self.root, 'lock'))
+
+	def count(self, name, n=1):
+		_cache_stats.add(self.root, name, n)
+
+	def trace_key(self, builder, target_path):
+		'''
+		Identifies a builder (by contents) and the target it's building
+		'''
+		base = os.path.dirname(target_path)
+		return _key('trace', _CACHE_VERSION,
+			content_checksum(builder.realpath) or '',
+			os.path.relpath(builder.realpath, base),
+			builder.target)
+
+	@staticmethod
+	def output_key(trace_key, deps):
+		return _key('output', trace_key, *['%s\t%s' % (path, checksum or '-') for path, checksum in deps])
+
+	@staticmethod
+	def _read_traces(path):
+		try:
+			with open(path) as f:
+				lines = f.read().splitlines()
+		except (OSError, IOError) as e:
+			if e.errno != errno.ENOENT: raise
+			return []
+		return OutputCache._parse_traces(lines)
+
+	@staticmethod
+	def _parse_traces(lines):
+		traces = []
+		for line in lines:
+			try:
+				record = json.loads(line)
+				traces.append(CacheTrace([tuple(dep) for dep in record['deps']], record['output']))
+			except (ValueError, KeyError, TypeError):
+				# partially written, most likely
+				continue
+		return traces
+
+	@staticmethod
+	def _trace_line(trace):
+		return json.dumps({'deps': trace.deps, 'output': trace.output}, separators=(',', ':')) + '\n'
+
+	def prefetch_traces(self, trace_key):
+		'''
+		Start fetching the remote traces for trace_key (if there's a remote).
+		'''
+		if self.remote is not None:
+			self.remote.prefetch_traces(trace_key)
+
+	def traces(self, trace_key):
+		'''
+		Yields the traces recorded for trace_key, most recent first.
+		Local traces come first, so they're checked while remote ones are fetched.
+		'''
+		self.prefetch_traces(trace_key)
+		seen = set()
+		for trace in reversed(self._read_traces(self._path('traces', trace_key))):
+			if trace.output not in seen:
+				seen.add(trace.output)
+				yield trace
+		if self.remote is not None:
+			for trace in reversed(self._parse_traces(self.remote.trace_lines(trace_key))):
+				if trace.output not in seen:
+					seen.add(trace.output)
+					yield trace
+
+	def prefetch(self, trace):
+		'''
+		Start downloading the output of `trace` (if it's only stored remotely)
+		while its dependencies are being checked.
+		'''
+		if self.remote is not None and not os.path.exists(self._path('outputs', trace.output)):
+			self.remote.prefetch(trace.output, self._tmp_root())
+
+	def _tmp_root(self):
+		tmp_root = os.path.join(self.root, 'tmp')
+		mkdirp(tmp_root)
+		return tmp_root
+
+	def _download(self, trace):
+		'''
+		Move a remotely stored output into this cache.
+		'''
+		tmp = self.remote.download(trace.output, self._tmp_root())
+		if tmp is None:
+			return
+		entry = self._path('outputs', trace.output)
+		try:
+			with open(os.path.join(tmp, 'meta')) as f:
+				size = json.load(f).get('size', 0)
+			with self._lock().read():
+				mkdirp(os.path.dirname(entry))
+				try:
+					os.rename(tmp, entry)
+				except OSError as e:
+					# downloaded by a concurrent build
+					if e.errno not in (errno.EEXIST, errno.ENOTEMPTY): raise
+				else:
+					self.count('remote_hits')
+					self.count('size', size)
+		finally:
+			if os.path.exists(tmp):
+				rmtree(tmp)
+
+	def restore(self, trace, dest):
+		'''
+		Copy the output of `trace` to `dest`, returning its
+		recorded dependencies (or None if it's not cached).
+		'''
+		entry = self._path('outputs', trace.output)
+		if self.remote is not None and not os.path.exists(entry):
+			self._download(trace)
+		with self._lock().read():
+			try:
+				with open(os.path.join(entry, 'deps')) as f:
+					lines = f.read().splitlines()
+				with open(os.path.join(entry, 'meta')) as f:
+					meta = json.load(f)
+				_copy(os.path.join(entry, 'target'), dest)
+				# mark as recently used
+				os.utime(os.path.join(entry, 'meta'), None)
+			except (OSError, IOError) as e:
+				if e.errno != errno.ENOENT: raise
+				try_remove(dest)
+				return None
+		self.count('hits')
+		self.count('bytes_saved', meta.get('size', 0))
+		self.count('seconds_saved', meta.get('seconds', None) or 0)
+		return [Dependency.parse(line) for line in lines]
+
+	def store(self, builder, target_path, deps):
+		'''
+		Store a freshly built target, given its committed Dependencies.
+		'''
+		if deps.clobbers or not os.path.lexists(target_path):
+			return False
+		base = os.path.dirname(target_path)
+		checksums = []
+		recorded = io.StringIO()
+		for rule in deps.rules:
+			if isinstance(rule, AlwaysRebuild):
+				_log.trace("Not caching %s (always rebuilt)", target_path)
+				return False
+			if isinstance(rule, BuildTime):
+				continue
+			path = rule.full_path(base)
+			if rule.mtime is not None and get_mtime(path) != rule.mtime:
+				# modified since the build used it
+				_log.trace("Not caching %s (%s has changed)", target_path, rule.path)
+				return False
+			if isinstance(rule, BuilderDependency):
+				continue
+			checksums.append((rule.path, content_checksum(path)))
+			rule.append_to(recorded)
+		if deps.checksum is not None:
+			Checksum(deps.checksum).append_to(recorded)
+
+		trace_key = self.trace_key(builder, target_path)
+		trace = CacheTrace(checksums, self.output_key(trace_key, checksums))
+		entry = self._path('outputs', trace.output)
+		tmp_root = self._tmp_root()
+		with self._lock().read():
+			if not os.path.exists(entry):
+				tmp = tempfile.mkdtemp(dir=tmp_root)
+				try:
+					_copy(target_path, os.path.join(tmp, 'target'))
+					with open(os.path.join(tmp, 'deps'), 'w') as f:
+						f.write(recorded.getvalue())
+					seconds = None
+					if deps.stats is not None:
+						# the build script's own time, which a cache hit saves
+						seconds = max(0, deps.stats.wall - deps.waited) / 1000.0
+					size = _size(os.path.join(tmp, 'target'))
+					with open(os.path.join(tmp, 'meta'), 'w') as f:
+						json.dump({
+							'target': os.path.basename(target_path),
+							'size': size,
+							'seconds': seconds,
+						}, f)
+					mkdirp(os.path.dirname(entry))
+					try:
+						os.rename(tmp, entry)
+					except OSError as e:
+						# stored by a concurrent build
+						if e.errno not in (errno.EEXIST, errno.ENOTEMPTY): raise
+					else:
+						self.count('stores')
+						self.count('size', size)
+						if self.remote is not None:
+							self.remote.upload_output(trace.output, entry, tmp_root)
+							self.count('uploads')
+				finally:
+					if os.path.exists(tmp):
+						rmtree(tmp)
+
+			trace_path = self._path('traces', trace_key)
+			if not any(existing.output == trace.output for existing in self._read_traces(trace_path)):
+				mkdirp(os.path.dirname(trace_path))
+				with open(trace_path, 'a') as f:
+					f.write(self._trace_line(trace))
+				if self.remote is not None:
+					self.remote.upload_trace(trace_key, self._trace_line(trace))
+		_log.trace("Cached %s as %s", target_path, trace.output)
+		return True
+
+	def _entries(self):
+		'''
+		Yields (last used, size, path) for each stored output.
+		No locking needed, entries removed while scanning are skipped.
+		'''
+		outputs = os.path.join(self.root, 'outputs')
+		for prefix in _listdir(outputs):
+			for key in _listdir(os.path.join(outputs, prefix)):
+				entry = os.path.join(outputs, prefix, key)
+				try:
+					meta_path = os.path.join(entry, 'meta')
+					with open(meta_path) as f:
+						size = json.load(f)['size']
+					used = os.stat(meta_path).st_mtime
+				except (OSError, IOError, ValueError, KeyError):
+					# incomplete, so evict it first
+					try:
+						yield 0, _size(entry), entry
+					except OSError as e:
+						if e.errno not in (errno.ENOENT, errno.ENOTDIR): raise
+				else:
+					yield used, size, entry
+
+	@staticmethod
+	def _last_used(entry):
+		'''
+		As reported by _entries, or None if `entry` has been removed.
+		'''
+		try:
+			return os.stat(os.path.join(entry, 'meta')).st_mtime
+		except OSError as e:
+			if e.errno not in (errno.ENOENT, errno.ENOTDIR): raise
+			return 0 if os.path.exists(entry) else None
+
+	def usage(self):
+		'''
+		Returns the (count, total size) of stored outputs.
+		'''
+		entries = list(self._entries())
+		return len(entries), sum(size for _used, size, _entry in entries)
+
+	def evict(self, budget):
+		'''
+		Remove the least recently used outputs (and traces which refer to them)
+		until the cache is under `budget` bytes.
+		Returns the remaining size, and the number of outputs evicted.
+		'''
+		# scan without the lock, so builds aren't blocked in the meantime
+		entries = sorted(self._entries())
+		total = sum(size for _used, size, _entry in entries)
+		if total <= budget:
+			return total, 0
+		# drop to 3/4 capacity, so we don't evict on every build
+		remaining = budget * 3 // 4
+		candidates = []
+		for used, size, entry in entries:
+			if total <= remaining:
+				break
+			candidates.append((used, size, entry))
+			total -= size
+		keys = set(os.path.basename(entry) for _used, _size, entry in candidates)
+
+		# traces are only rewritten if they referred to a candidate when scanned
+		traces_dir = os.path.join(self.root, 'traces')
+		trace_paths = []
+		for prefix in _listdir(traces_dir):
+			for key in _listdir(os.path.join(traces_dir, prefix)):
+				path = os.path.join(traces_dir, prefix, key)
+				if any(trace.output in keys for trace in self._read_traces(path)):
+					trace_paths.append(path)
+
+		evicted = set()
+		with self._lock().write():
+			for used, size, entry in candidates:
+				if self._last_used(entry) != used:
+					# used (or removed) since the scan
+					total += size
+					continue
+				_log.trace("evicting %s", entry)
+				rmtree(entry)
+				evicted.add(os.path.basename(entry))
+
+			for path in trace_paths:
+				traces = self._read_traces(path)
+				kept = [trace for trace in traces if trace.output not in evicted]
+				if len(kept) == len(traces):
+					continue
+				if kept:
+					with open(path + '.tmp', 'w') as f:
+						f.write(''.join(self._trace_line(trace) for trace in kept))
+					os.rename(path + '.tmp', path)
+				else:
+					os.remove(path)
+
+			# leftovers from builds which were killed while storing
+			tmp_root = os.path.join(self.root, 'tmp')
+			for name in _listdir(tmp_root):
+				path = os.path.join(tmp_root, name)
+				if os.lstat(path).st_mtime < time.time() - 60 * 60:
+					rmtree(path)
+		_log.debug("evicted %d outputs from %s", len(evicted), self.root)
+		return total, len(evicted)
+
+	def stats(self):
+		'''
+		Returns the activity recorded in this cache.
+		'''
+		# no locking needed, it's replaced atomically
+		return _load_stats(os.path.join(self.root, 'stats'))
+
+	def update_stats(self, counts):
+		'''
+		Add `counts` to the activity recorded in this cache, returning the new totals.
+		'''
+		path = os.path.join(self.root, 'stats')
+		mkdirp(self.root)
+		with Lock(path + '-lock').write():
+			stats = _load_stats(path)
+			for name, n in counts.items():
+				stats[name] = stats.get(name, 0) + n
+			with open(path + '.tmp', 'w') as f:
+				json.dump(stats, f)
+			os.rename(path + '.tmp', path)
+		return stats
+
+	def check_size(self, stats):
+		budget = cache_budget()
+		if stats.get('size', 0) > budget:
+			size, evicted = self.evict(budget)
+			# (also corrects any drift, e.g. from entries removed by hand)
+			self.update_stats({'size': size - stats['size'], 'evictions': evicted})
+
+def _listdir(path):
+	try:
+		return os.listdir(path)
+	except OSError as e:
+		if e.errno != errno.ENOENT: raise
+		return []
+
+def _load_stats(path):
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, IOError) as e:
+		if e.errno != errno.ENOENT: raise
+	except ValueError:
+		pass
+	return {}
+
+def cache_budget():
+	size = cache_size()
+	if size is None:
+		return DEFAULT_CACHE_SIZE
+	return parse_size(size)
+
+class CacheStats(object):
+	'''
+	Cache activity in this process, which is added to each
+	cache's totals (and may trigger eviction) when caches are saved.
+	'''
+	def __init__(self):
+		self.pending = {}
+
+	def add(self, root, name, n):
+		counts = self.pending.setdefault(root, collections.Counter())
+		counts[name] += n
+
+	def after_fork(self):
+		# a forked child reports only its own activity
+		self.pending = {}
+
+	def save(self):
+		pending, self.pending = self.pending, {}
+		for root, counts in pending.items():
+			cache = OutputCache(root)
+			try:
+				cache.check_size(cache.update_stats(counts))
+			except (OSError, IOError) as e:
+				_log.warning("Unable to update cache %s: %s", root, e)
+
+_cache_stats = CacheStats()
+register_cache(_cache_stats)
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_cache_stats.after_fork)
+
+def output_cache():
+	'''
+	The OutputCache for $GUP_CACHE, or None if it's not set.
+	'''
+	root = cache_dir()
+	if root is None:
+		return None
+	return OutputCache(root, remote_cache())
@@ -0,0 +1,144 @@
+'''
+A minimal remote cache server (see remote.py), storing files in a directory:
+
+	python -m gup.cache_server [--bind ADDR] [--port PORT] DIR
+
+It prints the URL to use for $GUP_REMOTE_CACHE once it's listening. It's
+intended for testing and small teams; it does no authentication and never
+evicts anything.
+'''
+from __future__ import print_function
+import os
+import re
+import sys
+import shutil
+import tempfile
+import optparse
+
+try:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+
+_BUFFER_SIZE = 256 * 1024
+_PATH = re.compile(r'^/(traces|outputs)/([0-9a-f]{64})$')
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def _path(self):
+		match = _PATH.match(self.path)
+		if match is None:
+			self._reply(400)
+			return None
+		kind, key = match.groups()
+		return os.path.join(self.server.root, kind, key[:2], key)
+
+	def _reply(self, code, length=0):
+		self.send_response(code)
+		self.send_header('Content-Length', str(length))
+		self.end_headers()
+
+	def do_HEAD(self):
+		self._get(send_body=False)
+
+	def do_GET(self):
+		self._get(send_body=True)
+
+	def _get(self, send_body):
+		path = self._path()
+		if path is None:
+			return
+		try:
+			f = open(path, 'rb')
+		except (OSError, IOError):
+			return self._reply(404)
+		with f:
+			self._reply(200, os.fstat(f.fileno()).st_size)
+			if send_body:
+				shutil.copyfileobj(f, self.wfile, _BUFFER_SIZE)
+
+	def _body_chunks(self):
+		if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+			while True:
+				size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+				if size == 0:
+					# trailers
+					while self.rfile.readline().strip():
+						pass
+					return
+				for chunk in self._read(size):
+					yield chunk
+				self.rfile.readline()
+		else:
+			for chunk in self._read(int(self.headers.get('Content-Length', 0))):
+				yield chunk
+
+	def _read(self, remaining):
+		while remaining > 0:
+			chunk = self.rfile.read(min(remaining, _BUFFER_SIZE))
+			if not chunk:
+				raise IOError("Request body was truncated")
+			remaining -= len(chunk)
+			yield chunk
+
+	def do_PUT(self):
+		path = self._path()
+		if path is None:
+			return
+		directory = os.path.dirname(path)
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# created concurrently
+				pass
+		fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				for chunk in self._body_chunks():
+					f.write(chunk)
+			os.rename(tmp, path)
+		except:
+			os.remove(tmp)
+			self.close_connection = True
+			raise
+		self._reply(201)
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def serve(root, bind='127.0.0.1', port=0, verbose=False):
+	server = _Server((bind, port), _Handler)
+	server.root = os.path.abspath(root)
+	server.verbose = verbose
+	host, port = server.server_address[:2]
+	print("http://%s:%d/" % (host, port))
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+def main():
+	p = optparse.OptionParser('Usage: python -m gup.cache_server [OPTIONS] DIR')
+	p.add_option('--bind', default='127.0.0.1', help='Address to listen on (default %default)')
+	p.add_option('--port', type='int', default=0, help='Port to listen on (default: any free port)')
+	p.add_option('-v', '--verbose', action='store_true', help='Log each request')
+	opts, args = p.parse_args()
+	if len(args) != 1:
+		p.error("Exactly one directory expected")
+	if not os.path.isdir(args[0]):
+		p.error("No such directory: %s" % (args[0],))
+	serve(args[0], opts.bind, opts.port, opts.verbose)
+
+if __name__ == '__main__':
+	main()
@@ -3,16 +3,26 @@ import sys
 import logging
 import optparse
 import os
+import time
 
 from .error import *
 from .util import *
-from .state import TargetState, AlwaysRebuild, Checksum, FileDependency, META_DIR
-from .gupfile import Builder
+from .state import TargetState, AlwaysRebuild, Checksum, FileDependency, WaitTime, flush_dependencies
+from .gupfile import Builder, save_caches
 from .builder import Target, prepare_build
 from .log import PLAIN, getLogger, TRACE_LVL
-from .var import INDENT, set_verbosity, set_keep_failed_outputs, DEFAULT_VERBOSITY, set_trace, IS_WINDOWS
+from .var import META_DIR, indent, set_verbosity, set_keep_failed_outputs, set_hash_sources, set_checksum_algorithm, set_speculate, set_profile_json, profile_json, set_summary_path, set_cache_dir, cache_dir, set_remote_cache_url, remote_cache_url, default_verbosity, set_trace, init_env, is_root, IS_WINDOWS
 from .parallel import setup_jobserver
+from .rpc import Coordinator, COORDINATOR_ENV
 from .task import Task, TaskRunner
+from .watch import watch
+from .daemon import serve_daemon
+from .revdeps import ReverseIndex
+from .timeline import start_timeline, finish_timeline
+from .summary import BuildSummary, summary_journal
+from .selfprofile import start_profile, save_profile, profile_report
+from .cache import OutputCache, cache_budget, format_size
+from .remote import remote_cache, wait_for_uploads
 from .version import VERSION
 from .path import resolve_base, traverse_from
 
@@ -20,19 +30,19 @@ _log = getLogger(__name__)
 
 def _init_logging(verbosity):
 	lvl = logging.INFO
-	fmt = '%(color)sgup  ' + INDENT + '%(bold)s%(message)s' + PLAIN
+	fmt = '%(color)sgup  ' + indent() + '%(bold)s%(message)s' + PLAIN
 
 	if verbosity < 0:
 		lvl = logging.ERROR
 	elif verbosity == 1:
 		lvl = logging.DEBUG
 	elif verbosity > 1:
-		fmt = '%(color)sgup[%(process)s %(name)-12s %(levelname)-5s]  ' + INDENT + '%(bold)s%(message)s' + PLAIN
+		fmt = '%(color)sgup[%(process)s %(name)-12s %(levelname)-5s]  ' + indent() + '%(bold)s%(message)s' + PLAIN
 		lvl = TRACE_LVL
 	
 	if 'GUP_IN_TESTS' in os.environ:
 		lvl = TRACE_LVL
-		fmt = fmt = '# %(color)s%(levelname)-5s ' + INDENT + '%(bold)s%(message)s' + PLAIN
+		fmt = fmt = '# %(color)s%(levelname)-5s ' + indent() + '%(bold)s%(message)s' + PLAIN
 
 	# persist for child processes
 	set_verbosity(verbosity)
@@ -42,6 +52,9 @@ def _init_logging(verbosity):
 	handler.setFormatter(logging.Formatter(fmt))
 	baseLogger.propagate = False
 	baseLogger.setLevel(lvl)
+	# replace any handler inherited from the root process (in a coordinator worker)
+	for existing in list(baseLogger.handlers):
+		baseLogger.removeHandler(existing)
 	baseLogger.addHandler(handler)
 
 def _bin_init():
@@ -101,6 +114,28 @@ def _main(argv):
 			p.add_option('-f', '--force', action='store_true', help='Actually remove files')
 			p.add_option('-m', '--metadata', action='store_true', help='Remove .gup metadata directories, but leave targets')
 			action = _clean_targets
+		elif cmd == '--watch':
+			p = optparse.OptionParser('Usage: gup --watch [OPTIONS] [target [...]]')
+			p.add_option('-j', '--jobs', type='int', default=None, help="Number of concurrent jobs to run")
+			action = _watch
+		elif cmd == '--affected':
+			p = optparse.OptionParser('Usage: gup --affected [OPTIONS] [file [...]]')
+			p.add_option('-c', '--compact', action='store_true', help='Merge recently built targets into the index first')
+			action = _list_affected
+		elif cmd == '--daemon':
+			p = optparse.OptionParser('Usage: gup --daemon [OPTIONS] [dir=.]')
+			action = _run_daemon
+		elif cmd == '--profile-report':
+			p = optparse.OptionParser('Usage: gup --profile-report [OPTIONS] dir')
+			p.add_option('-s', '--sort', default='tottime', help='Sort order, as for python\'s pstats module (default tottime)')
+			p.add_option('-n', '--limit', type='int', default=40, help='Number of functions to show (default 40)')
+			action = _profile_report
+		elif cmd == '--cache-stats':
+			p = optparse.OptionParser('Usage: gup --cache-stats [dir=$GUP_CACHE]')
+			action = _cache_stats
+		elif cmd == '--migrate-metadata':
+			p = optparse.OptionParser('Usage: gup --migrate-metadata [OPTIONS] [dir [...]]')
+			action = _migrate_metadata
 		elif cmd == '--contents':
 			p = optparse.OptionParser('Usage: gup --contents [file=<stdin>]')
 			action = _mark_contents
@@ -133,6 +168,15 @@ def _main(argv):
 			'  --clean      Clean any gup-built targets\n' +
 			'  --buildable  Check if a target is buildable\n' +
 			'  --dirty      Check if one or more targets are out of date\n' +
+			'  --affected   List targets which depend on the given file(s)\n' +
+			'  --watch      Rebuild targets whenever their dependencies change\n' +
+			'  --daemon     Watch a project directory, to speed up checks for clean targets\n' +
+			'  --migrate-metadata\n' +
+			'               Cache the encoded form of existing .gup metadata\n' +
+			'  --profile-report\n' +
+			'               Combine the profiles written by gup processes with $GUP_PROFILE set\n' +
+			'  --cache-stats\n' +
+			'               Show how effective the output cache has been\n' +
 			'\n' +
 			'Actions which can only be called from a buildscript:\n' +
 			'  --always     Mark this target as always-dirty\n' +
@@ -146,6 +190,13 @@ def _main(argv):
 		p.add_option('-j', '--jobs', type='int', default=None, help="Number of concurrent jobs to run")
 		p.add_option('-x', '--trace', action='store_true', help='Trace build script invocations (also sets $GUP_XTRACE=1)')
 		p.add_option('--keep-failed', action='store_true', help='Keep temporary output files on failure')
+		p.add_option('--checksum', metavar='ALGORITHM', help='Hash algorithm for new checksums, from python\'s hashlib (default sha1, also sets $GUP_CHECKSUM)')
+		p.add_option('--hash-sources', action='store_true', help='Only treat source files as modified when their contents change (also sets $GUP_HASH_SOURCES=1)')
+		p.add_option('--speculate', action='store_true', help='Start building the dependencies recorded by each target\'s previous build while its build script runs (with --jobs > 1, also sets $GUP_SPECULATE=1)')
+		p.add_option('--profile-json', metavar='FILE', help='Write a timeline of the build to FILE, in Chrome\'s trace event format (also sets $GUP_PROFILE_JSON)')
+		p.add_option('--summary', action='store_true', help='Print a summary of where time was spent once the build is complete')
+		p.add_option('--cache', metavar='DIR', help='Restore unchanged targets from (and store new outputs in) a cache in DIR (also sets $GUP_CACHE)')
+		p.add_option('--remote-cache', metavar='URL', help='Share the output cache via an HTTP server at URL (also sets $GUP_REMOTE_CACHE)')
 		action = _build
 		verbosity = None
 	else:
@@ -153,14 +204,14 @@ def _main(argv):
 		verbosity = 0
 
 	p.add_option('-q', '--quiet', action='count', default=0, help='Decrease verbosity')
-	p.add_option('-v', '--verbose', action='count', default=DEFAULT_VERBOSITY, help='Increase verbosity')
+	p.add_option('-v', '--verbose', action='count', default=default_verbosity(), help='Increase verbosity')
 
 	opts, args = p.parse_args(argv)
 
 	verbosity = opts.verbose - opts.quiet
 	_init_logging(verbosity)
 
-	if action is _build:
+	if action in (_build, _watch):
 		_bin_init()
 
 	_log.trace('argv: %r, action=%r', argv, action)
@@ -227,6 +278,41 @@ def _test_dirty(opts, args):
 			sys.exit(0)
 	sys.exit(1)
 
+def _list_affected(opts, paths):
+	index = ReverseIndex.find(os.getcwd())
+	if index is None:
+		raise SafeError("No dependency index found (it's written by builds of targets in this project)")
+	if opts.compact or index.needs_compaction():
+		index.compact()
+	for target in index.affected(paths):
+		print(os.path.relpath(target))
+
+def _profile_report(opts, args):
+	if len(args) != 1:
+		raise SafeError("Exactly one directory expected")
+	if not profile_report(args[0], opts.sort, opts.limit, sys.stdout):
+		raise SafeError("No profiles found in %s" % (args[0],))
+
+def _cache_stats(opts, args):
+	if len(args) > 1:
+		raise SafeError("At most one directory expected")
+	root = args[0] if args else cache_dir()
+	if root is None:
+		raise SafeError("No cache directory given (and $GUP_CACHE is not set)")
+	if not os.path.isdir(root):
+		raise SafeError("No such directory: %s" % (root,))
+	cache = OutputCache(os.path.abspath(root))
+	stats = cache.stats()
+	count, size = cache.usage()
+	hits = stats.get('hits', 0)
+	lookups = hits + stats.get('misses', 0)
+	print("%s: %d outputs, %s (limit %s)" % (root, count, format_size(size), format_size(cache_budget())))
+	print("hits: %d of %d lookups (%.1f%%)" % (hits, lookups, 100.0 * hits / lookups if lookups else 0))
+	print("saved: %s and %.1fs of build time" % (format_size(stats.get('bytes_saved', 0)), stats.get('seconds_saved', 0)))
+	print("stored: %d outputs, evicted: %d" % (stats.get('stores', 0), stats.get('evictions', 0)))
+	if stats.get('remote_hits', 0) or stats.get('uploads', 0):
+		print("remote: %d outputs downloaded, %d uploaded" % (stats.get('remote_hits', 0), stats.get('uploads', 0)))
+
 def _print_version(opts, args):
 	assert len(args) == 0, "no arguments expected"
 	print(VERSION)
@@ -289,12 +375,73 @@ def _clean_targets(opts, dests):
 			for hidden in hidden_dirs:
 				dirnames.remove(hidden)
 
+def _watch(opts, targets):
+	if _get_parent_target() is not None:
+		raise SafeError("--watch can't be used from a build script")
+	if len(targets) == 0:
+		targets = ['all']
+	build_args = []
+	if opts.jobs is not None:
+		build_args.append('--jobs=%d' % (opts.jobs,))
+	watch(targets, build_args)
+
+def _run_daemon(opts, dirs):
+	if _get_parent_target() is not None:
+		raise SafeError("--daemon can't be used from a build script")
+	assert len(dirs) <= 1, "at most one directory expected"
+	serve_daemon(dirs[0] if dirs else '.')
+
+def _migrate_metadata(opts, dests):
+	if len(dests) == 0: dests = ['.']
+	migrated = 0
+	for dest in dests:
+		for dirpath, dirnames, filenames in os.walk(dest, followlinks=False):
+			if META_DIR in dirnames:
+				gupdir = os.path.join(dirpath, META_DIR)
+				for target in TargetState.built_targets(gupdir):
+					state = TargetState(os.path.join(dirpath, target))
+					try:
+						if state.migrate():
+							_log.debug("Migrated %s", state.meta_path('deps'))
+							migrated += 1
+					except (ValueError, AssertionError, UnicodeError) as e:
+						_log.warning("Skipping invalid metadata %s: %s", state.meta_path('deps'), e)
+			# filter out hidden directories
+			hidden_dirs = [d for d in dirnames if d.startswith('.')]
+			for hidden in hidden_dirs:
+				dirnames.remove(hidden)
+	_log.info("Migrated %d metadata file%s", migrated, '' if migrated == 1 else 's')
+
 def _build(opts, targets):
 	if opts.trace:
 		set_trace()
 
 	if opts.keep_failed:
 		set_keep_failed_outputs()
+
+	if opts.hash_sources:
+		set_hash_sources()
+
+	if opts.speculate:
+		set_speculate()
+
+	if opts.checksum:
+		# fail early if it's not supported
+		Checksum.check_algorithm(opts.checksum)
+		set_checksum_algorithm(opts.checksum)
+
+	if opts.cache:
+		set_cache_dir(opts.cache)
+	if cache_dir() is not None:
+		# fail early if $GUP_CACHE_SIZE is invalid
+		cache_budget()
+	if opts.remote_cache:
+		set_remote_cache_url(opts.remote_cache)
+	if remote_cache_url() is not None:
+		if cache_dir() is None:
+			raise SafeError("--remote-cache requires a local cache (--cache or $GUP_CACHE)")
+		# fail early if the URL is invalid
+		remote_cache()
 	
 	if len(targets) == 0:
 		targets = ['all']
@@ -304,8 +451,80 @@ def _build(opts, targets):
 	jobs = opts.jobs
 	if jobs is not None:
 		assert jobs > 0 and jobs < 1000
-	setup_jobserver(jobs)
 
+	if opts.profile_json:
+		set_profile_json(opts.profile_json)
+	# the outermost process writing the timeline creates it
+	owns_timeline = profile_json() is not None and (is_root() or bool(opts.profile_json))
+	if owns_timeline:
+		start_timeline(profile_json())
+
+	summary_path = None
+	if opts.summary:
+		import tempfile
+		fd, summary_path = tempfile.mkstemp(prefix='gup-summary-')
+		os.close(fd)
+		set_summary_path(summary_path)
+
+	coordinator = _start_coordinator()
+	try:
+		setup_jobserver(jobs)
+		_run_build(opts, targets, parent_target)
+	finally:
+		if coordinator is not None:
+			coordinator.stop()
+		if owns_timeline:
+			finish_timeline()
+		if summary_path is not None:
+			_report_summary(summary_path)
+
+# the number of targets listed by --summary
+_SUMMARY_TARGETS = 10
+
+def _report_summary(path):
+	summary_journal().save()
+	try:
+		summary = BuildSummary.load(path)
+	finally:
+		os.remove(path)
+	summary.report(_log.info, _SUMMARY_TARGETS)
+
+def _start_coordinator():
+	'''
+	The root process hosts a coordinator (which must be forked
+	before the jobserver is created), so that nested invocations
+	don't need to bootstrap gup themselves.
+	'''
+	if not is_root() or os.environ.get(COORDINATOR_ENV, None) == '0':
+		return None
+	if IS_WINDOWS or not Coordinator.supported():
+		return None
+
+	coordinator = Coordinator(_run_forwarded)
+	try:
+		coordinator.start()
+	except OSError as e:
+		_log.debug("Unable to start build coordinator: %s", e)
+		return None
+	_log.trace("started build coordinator at %s", coordinator.path)
+	return coordinator
+
+def _run_forwarded(argv):
+	'''
+	Runs in a coordinator worker, after it has taken on
+	the cwd and environment of a nested invocation.
+	'''
+	init_env()
+	try:
+		main(argv)
+	except SystemExit as e:
+		if e.code is None: return 0
+		if isinstance(e.code, int): return e.code
+		return 2
+	return 0
+
+def _run_build(opts, targets, parent_target):
+	start = time.time()
 	runner = TaskRunner()
 	for target_path in targets:
 		if resolve_base(target_path) == parent_target:
@@ -335,12 +554,26 @@ def _build(opts, targets):
 	# wait for all tasks to complete
 	runner.run()
 
+	if parent_target is not None:
+		# so that the parent's build time excludes ours
+		TargetState(parent_target).add_dependency(WaitTime(int((time.time() - start) * 1000)))
+
 def _exit_error():
 	sys.exit(2)
 
-def main():
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	start_profile(os.environ.get('GUP_TARGET', None))
 	try:
-		_main(sys.argv[1:])
+		try:
+			_main(argv)
+		finally:
+			flush_dependencies()
+			save_caches()
+			if is_root():
+				wait_for_uploads()
+			save_profile()
 	except KeyboardInterrupt:
 		sys.exit(2)
 	except AssertionError as e:
@@ -0,0 +1,492 @@
+'''
+An optional long-lived process (`gup --daemon`) which watches a project
+tree with inotify, so that `gup -u` can skip checking targets it already
+knows to be clean.
+
+The daemon only vouches for targets which a build has reported as clean
+(after checking them the usual way). It records their transitive
+dependencies, and forgets them as soon as any of those paths change.
+Anything it can't vouch for is checked as normal, so builds behave
+identically (just slower) when there's no daemon.
+
+Since clients trust what the daemon tells them, its socket lives in a
+private (0700) per-user directory, and each end checks that the other
+belongs to the same user (where the platform can tell us).
+'''
+from __future__ import print_function
+import os
+import sys
+import errno
+import socket
+import stat
+import select
+import hashlib
+
+from .log import getLogger
+from .error import SafeError
+from .var import META_DIR, ROOT_CWD
+from .rpc import peer_uid
+from .state import TargetState, BaseFileDependency, BuildTime
+from .watch import Inotify
+_log = getLogger(__name__)
+
+# part of the socket address, so that a daemon speaking
+# a different protocol is simply never found
+PROTOCOL_VERSION = 1
+
+def daemon_dir(create):
+	'''
+	The per-user directory containing daemon sockets,
+	or None if it doesn't exist or isn't private.
+	'''
+	import tempfile
+	uid = os.getuid()
+	path = os.path.join(tempfile.gettempdir(), 'gup-daemon-%d' % (uid,))
+	if create:
+		try:
+			os.mkdir(path, 0o700)
+		except OSError as e:
+			if e.errno != errno.EEXIST: raise
+	try:
+		st = os.lstat(path)
+	except OSError as e:
+		if e.errno != errno.ENOENT: raise
+		return None
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or stat.S_IMODE(st.st_mode) != 0o700:
+		_log.warning("Not using %s, since it's not a private directory", path)
+		return None
+	return path
+
+def daemon_address(dirpath, root):
+	digest = hashlib.sha1(('%d:%s' % (PROTOCOL_VERSION, root)).encode('utf-8')).hexdigest()[:16]
+	return os.path.join(dirpath, digest)
+
+def _check_peer(sock):
+	uid = peer_uid(sock)
+	if uid is not None and uid != os.getuid():
+		raise OSError(errno.EPERM, "connection from another user (uid %d)" % (uid,))
+
+def _encode(fields):
+	return b'\0'.join([os.fsencode(str(field)) for field in fields]) + b'\n'
+
+def _decode(line):
+	return [os.fsdecode(field) for field in line.split(b'\0')]
+
+class _Connection(object):
+	def __init__(self, sock):
+		self.sock = sock
+		self.buffer = b''
+
+	def send(self, fields):
+		self.sock.sendall(_encode(fields))
+
+	def read_messages(self):
+		'''
+		Returns the complete messages received (or None on EOF).
+		'''
+		data = self.sock.recv(64 * 1024)
+		if not data:
+			return None
+		self.buffer += data
+		lines = self.buffer.split(b'\n')
+		self.buffer = lines.pop()
+		return [_decode(line) for line in lines]
+
+	def receive(self):
+		while True:
+			messages = self.read_messages()
+			if messages is None:
+				raise EOFError("daemon closed the connection")
+			if messages:
+				assert len(messages) == 1, "unexpected messages: %r" % (messages,)
+				return messages[0]
+
+	def close(self):
+		self.sock.close()
+
+class DaemonClient(object):
+	'''
+	A connection to the daemon watching the project containing
+	ROOT_CWD (if there is one). Any failure disables the daemon
+	for the remainder of this process.
+	'''
+	TIMEOUT = 2
+
+	def __init__(self):
+		self.enabled = hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid') and os.environ.get('GUP_DAEMON', '1') != '0'
+		self.root = None
+		self.address = None
+		self.located = False
+		self.conn = None
+		self.pid = None
+
+		# The daemon generation when this process first asked about
+		# any target. Results memoized by this process may be as old
+		# as this, so it's used for all of our reports.
+		self.token = None
+
+	def _locate(self):
+		self.located = True
+		dirpath = daemon_dir(create=False)
+		if dirpath is None:
+			return
+		root = os.path.realpath(ROOT_CWD)
+		while True:
+			address = daemon_address(dirpath, root)
+			if os.path.exists(address):
+				_log.trace("found daemon for %s at %s", root, address)
+				self.root = root
+				self.address = address
+				return
+			parent = os.path.dirname(root)
+			if parent == root:
+				return
+			root = parent
+
+	def _usable(self, path):
+		if not self.enabled:
+			return False
+		if not self.located:
+			self._locate()
+		if self.address is None:
+			return False
+		return path.startswith(self.root + os.path.sep) and '\n' not in path and '\0' not in path
+
+	def _connection(self):
+		if self.conn is not None and self.pid == os.getpid():
+			return self.conn
+		# connections aren't shared with forked children
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self.TIMEOUT)
+		try:
+			sock.connect(self.address)
+			_check_peer(sock)
+		except:
+			sock.close()
+			raise
+		self.conn = _Connection(sock)
+		self.pid = os.getpid()
+		return self.conn
+
+	def _disable(self, e):
+		_log.debug("disabling gup daemon at %s: %s", self.address, e)
+		self.enabled = False
+		if self.conn is not None and self.pid == os.getpid():
+			self.conn.close()
+		self.conn = None
+
+	def query(self, path):
+		'''
+		Returns True if the daemon knows `path` is clean, otherwise a
+		token to pass to `report_clean` (None if there's no daemon).
+		'''
+		if not self._usable(path):
+			return None
+		try:
+			conn = self._connection()
+			conn.send(['query', path, _context()])
+			reply, generation = conn.receive()
+			generation = int(generation)
+		except (OSError, EOFError, ValueError, AssertionError) as e:
+			self._disable(e)
+			return None
+		if self.token is None:
+			self.token = generation
+		if reply == 'clean':
+			return True
+		return self.token
+
+	def report_clean(self, path, token):
+		if token is None or not self.enabled:
+			return
+		try:
+			self._connection().send(['clean', path, _context(), token])
+		except OSError as e:
+			self._disable(e)
+
+def _context():
+	# builders may be found on $PATH, so results only apply to
+	# builds with the same $PATH
+	return os.environ.get('PATH', '')
+
+_client = DaemonClient()
+
+def query_daemon(path):
+	return _client.query(path)
+
+def report_clean(path, token):
+	_client.report_clean(path, token)
+
+class DaemonServer(object):
+	# beyond this many recorded changes, forget everything
+	# (which makes all of them irrelevant)
+	MAX_CHANGED = 100000
+
+	def __init__(self, root):
+		self.root = os.path.realpath(root)
+		dirpath = daemon_dir(create=True)
+		if dirpath is None:
+			raise SafeError("Unable to create a private directory for the daemon's socket")
+		self.address = daemon_address(dirpath, self.root)
+		self.inotify = Inotify()
+
+		# incremented for each batch of events
+		self.generation = 0
+
+		# reports for generations before this are ignored
+		self.epoch = 0
+
+		self.watched = {} # dir -> generation when its watch was added
+		self.changed = {} # path -> generation of its last change (since epoch)
+		self.clean = {} # target -> context it was reported clean in
+		self.dependents = {} # path -> clean targets depending on it
+		self.edges = {} # path -> paths it depends on (None if untrackable)
+		self.watch_limit_reached = False
+
+	def watch_tree(self, top):
+		count = 0
+		for dirpath, dirnames, _filenames in os.walk(top, followlinks=False):
+			if os.path.basename(dirpath) == META_DIR:
+				dirnames[:] = []
+			else:
+				dirnames[:] = [d for d in dirnames if d == META_DIR or not d.startswith('.')]
+			if dirpath in self.inotify.wds:
+				continue
+			try:
+				self.inotify.watch(dirpath)
+			except OSError as e:
+				if e.errno != errno.ENOSPC: raise
+				if not self.watch_limit_reached:
+					_log.warning("inotify watch limit reached; targets in unwatched directories will be checked as usual")
+					self.watch_limit_reached = True
+				return count
+			if dirpath in self.inotify.wds:
+				self.watched[dirpath] = self.generation
+				count += 1
+		return count
+
+	def reset(self, reason):
+		_log.info("forgetting all targets: %s", reason)
+		self.generation += 1
+		self.epoch = self.generation
+		self.clean = {}
+		self.dependents = {}
+		self.edges = {}
+		# changes before the epoch can't affect reports
+		# which aren't ignored
+		self.changed = {}
+
+	def process_events(self, timeout):
+		'''
+		Returns whether there were any events.
+		'''
+		events = self.inotify.read_events(timeout)
+		if events is None:
+			self.reset("inotify event queue overflowed")
+			self.watch_tree(self.root)
+			return True
+		if not events:
+			return False
+
+		self.generation += 1
+		changed = []
+		for path, mask in events:
+			name = os.path.basename(path)
+			parent = os.path.dirname(path)
+			if os.path.basename(parent) == META_DIR:
+				if not name.startswith('deps.'):
+					continue
+				# the metadata for a target has changed
+				path = os.path.join(os.path.dirname(parent), name[len('deps.'):])
+				self.edges.pop(path, None)
+			elif name == 'Gupfile' or name == 'gup' or (name.endswith('.gup') and name != META_DIR):
+				# which builder is used for any target may have changed
+				self.reset("%s changed" % (path,))
+			if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+				self.watch_tree(path)
+			elif mask & Inotify.IN_DELETE_SELF:
+				self.watched.pop(path, None)
+			changed.append(path)
+		self.invalidate(changed)
+		if len(self.changed) > self.MAX_CHANGED:
+			self.reset("more than %d changes recorded" % (self.MAX_CHANGED,))
+		return True
+
+	def drain_events(self):
+		while self.process_events(0):
+			pass
+
+	def invalidate(self, paths):
+		pending = list(paths)
+		seen = set()
+		while pending:
+			path = pending.pop()
+			if path in seen:
+				continue
+			seen.add(path)
+			self.changed[path] = self.generation
+			self.edges.pop(path, None)
+			if self.clean.pop(path, None) is not None:
+				_log.debug("dirty: %s", path)
+			# none of its dependents are clean anymore, they'll
+			# be recorded again when they're next reported clean
+			pending.extend(self.dependents.pop(path, ()))
+
+	def _edges(self, path):
+		'''
+		Returns the paths that `path` depends on (an empty list for
+		plain files), or None if it can't be tracked.
+		'''
+		try:
+			return self.edges[path]
+		except KeyError:
+			pass
+		edges = []
+		try:
+			deps = TargetState(path).deps()
+		except (ValueError, AssertionError, UnicodeError) as e:
+			_log.debug("can't read metadata for %s: %s", path, e)
+			deps = edges = None
+		if deps is not None:
+			base = os.path.dirname(path)
+			for rule in deps.rules:
+				if isinstance(rule, BaseFileDependency):
+					edges.append(rule.full_path(base))
+				elif not isinstance(rule, BuildTime):
+					# e.g. --always
+					edges = None
+					break
+		self.edges[path] = edges
+		return edges
+
+	def _trackable(self, path, token):
+		dirpath = os.path.dirname(path)
+		return (
+			path.startswith(self.root + os.path.sep)
+			and dirpath in self.inotify.wds
+			and self.watched.get(dirpath, token + 1) <= token
+			and self.changed.get(path, 0) <= token
+		)
+
+	def closure(self, target, token):
+		'''
+		Returns the edges of `target` and every target it (transitively)
+		depends on, or None if any of them may have changed since `token`.
+		'''
+		edges = {}
+		pending = [target]
+		while pending:
+			path = pending.pop()
+			if path in edges:
+				continue
+			if not self._trackable(path, token):
+				_log.trace("untrackable: %s", path)
+				return None
+			paths = self._edges(path)
+			if paths is None:
+				return None
+			if paths and not self._trackable(os.path.join(os.path.dirname(path), META_DIR, 'deps'), token):
+				return None
+			edges[path] = paths
+			pending.extend(paths)
+		return edges
+
+	def handle(self, conn, message):
+		action = message[0]
+		if action == 'query':
+			_action, target, context = message
+			self.drain_events()
+			clean = self.clean.get(target, None) == context
+			_log.trace("query %s -> %s", target, 'clean' if clean else 'unknown')
+			conn.send(['clean' if clean else 'unknown', self.generation])
+		elif action == 'clean':
+			_action, target, context, token = message
+			token = int(token)
+			self.drain_events()
+			if token < self.epoch:
+				return
+			edges = self.closure(target, token)
+			if edges is None:
+				return
+			_log.trace("clean: %s (%d dependencies)", target, len(edges))
+			self.clean[target] = context
+			for path, paths in edges.items():
+				for dep in paths:
+					self.dependents.setdefault(dep, set()).add(path)
+		else:
+			raise ValueError("unknown message: %r" % (message,))
+
+	def _listen(self):
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			try:
+				server.bind(self.address)
+			except OSError as e:
+				if e.errno != errno.EADDRINUSE: raise
+				probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				try:
+					probe.connect(self.address)
+				except OSError:
+					# left behind by a daemon which didn't exit cleanly
+					os.remove(self.address)
+					server.bind(self.address)
+				else:
+					raise SafeError("A gup daemon is already running for %s" % (self.root,))
+				finally:
+					probe.close()
+			server.listen(64)
+		except:
+			server.close()
+			raise
+		return server
+
+	def serve(self):
+		server = self._listen()
+		connections = {}
+		try:
+			count = self.watch_tree(self.root)
+			_log.info("watching %d directories under %s", count, self.root)
+			sys.stdout.flush()
+			while True:
+				readable, _, _ = select.select([server, self.inotify.fd] + list(connections), [], [])
+				if self.inotify.fd in readable:
+					self.drain_events()
+				if server in readable:
+					sock, _ = server.accept()
+					try:
+						_check_peer(sock)
+					except OSError as e:
+						_log.warning("refusing connection: %s", e)
+						sock.close()
+					else:
+						connections[sock] = _Connection(sock)
+				for sock in readable:
+					conn = connections.get(sock, None)
+					if conn is None:
+						continue
+					try:
+						messages = conn.read_messages()
+						for message in messages or []:
+							self.handle(conn, message)
+					except (OSError, ValueError) as e:
+						_log.debug("dropping client: %s", e)
+						messages = None
+					if messages is None:
+						del connections[sock]
+						conn.close()
+		finally:
+			for conn in connections.values():
+				conn.close()
+			server.close()
+			try:
+				os.remove(self.address)
+			except OSError: pass
+			self.inotify.close()
+
+def serve_daemon(root):
+	import signal
+	def stop(signum, frame):
+		sys.exit(0)
+	# clean up our socket when killed
+	signal.signal(signal.SIGTERM, stop)
+	DaemonServer(root).serve()
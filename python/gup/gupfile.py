@@ -2,12 +2,19 @@ from __future__ import print_function
 import os
 from os import path
 import re
+import errno
+import stat
+import time
+import json
 import itertools
 
 from .whichcraft import which
 from .log import getLogger
 from .error import SafeError
-from .var import INDENT
+from .parallel import Lock
+from .path import project_root
+from .var import indent, META_DIR
+from .summary import summary_count, summary_journal
 _log = getLogger(__name__)
 
 def _default_gup_files(filename):
@@ -22,6 +29,328 @@ def _up_path(n):
 
 GUPFILE = 'Gupfile'
 
+_ABSENT = '-'
+_DIR = 'd'
+_FILE = 'f'
+
+class CacheJournal(object):
+	'''
+	An append-only file of cache records in a project's root .gup directory.
+	Later records for a key supersede earlier ones, and the file is
+	rewritten once most of its records have been superseded.
+
+	Subclasses override _encode / _decode to persist their records
+	(by default, nothing can be persisted).
+	'''
+	# don't persist anything modified this recently,
+	# as another change may not update its mtime
+	RACY_NS = 2 * (10 ** 9)
+
+	# if set, the oldest records are evicted beyond this many
+	MAX_RECORDS = None
+
+	def __init__(self, path):
+		self.path = path
+		self.persisted = None
+
+	@classmethod
+	def is_racy(cls, mtime_ns):
+		return time.time() * (10 ** 9) - mtime_ns < cls.RACY_NS
+
+	def _encode(self, key, value):
+		'''
+		Returns a line representing (key, value), or None if it can't be persisted.
+		'''
+		return None
+
+	def _decode(self, line):
+		'''
+		Returns the (key, value) of a line written by _encode, or None if it's invalid.
+		'''
+		return None
+
+	def _load(self):
+		if self.persisted is None:
+			self.persisted = {}
+			if self.path is None:
+				return self.persisted
+			try:
+				with open(self.path) as f:
+					lines = f.read().splitlines()
+			except (OSError, IOError) as e:
+				if e.errno != errno.ENOENT:
+					_log.debug("Unable to load %s: %s", self.path, e)
+				return self.persisted
+			for line in lines:
+				record = self._decode(line) # pylint: disable=E1128; overridden by subclasses
+				if record is not None:
+					key, value = record
+					self.persisted.pop(key, None)
+					self.persisted[key] = value
+			if self._evict() or len(lines) > 2 * len(self.persisted) + 100:
+				self._compact()
+		return self.persisted
+
+	def _line(self, key, value):
+		line = self._encode(key, value) # pylint: disable=E1128; overridden by subclasses
+		if line is None or '\n' in line: # pylint: disable=E1135
+			# unrepresentable
+			return None
+		return line + '\n'
+
+	def _write(self, lines, mode):
+		if self.path is None or not lines:
+			return
+		meta_dir = os.path.dirname(self.path)
+		if not os.path.isdir(meta_dir):
+			# only persist alongside existing metadata
+			return
+		try:
+			with Lock(self.path + '-lock').write():
+				with open(self.path, mode) as f:
+					f.write(''.join(lines))
+		except (OSError, IOError) as e:
+			_log.debug("Unable to save %s: %s", self.path, e)
+
+	def _evict(self):
+		if self.MAX_RECORDS is None or len(self.persisted) <= self.MAX_RECORDS:
+			return False
+		# drop to 3/4 capacity, so we don't compact on every write
+		excess = len(self.persisted) - (self.MAX_RECORDS * 3 // 4)
+		_log.trace("evicting %d records from %s", excess, self.path)
+		for key in list(itertools.islice(self.persisted, excess)):
+			del self.persisted[key]
+		return True
+
+	def _compact(self):
+		_log.trace("compacting %s", self.path)
+		lines = [self._line(key, value) for key, value in self.persisted.items()]
+		self._write(list(filter(None, lines)), 'w')
+
+	def _append(self, records):
+		persisted = self._load()
+		lines = []
+		for key, value in records:
+			persisted.pop(key, None)
+			persisted[key] = value
+			line = self._line(key, value)
+			if line is not None:
+				lines.append(line)
+		if self._evict():
+			self._compact()
+		else:
+			self._write(lines, 'a')
+
+class ResolutionCache(CacheJournal):
+	'''
+	Remembers which candidate builder paths exist, keyed by directory
+	(including negative entries for `gup/` directories and builders
+	which don't exist). Anything inside a missing directory is known
+	to be missing without touching the filesystem.
+
+	Entries are persisted in the project's root .gup directory and are
+	trusted for as long as their directory's mtime is unchanged (and
+	not recent), so a later invocation only needs to stat each existing
+	directory once.
+	'''
+	def __init__(self, path):
+		super(ResolutionCache, self).__init__(path)
+		self.dirs = {}
+		self.mtimes = {}
+		self.modified = set()
+
+	def clear(self):
+		# called after running a build script, which could have
+		# created or removed anything
+		self.dirs = {}
+		self.mtimes = {}
+		self.modified = set()
+
+	def kind(self, p):
+		p = os.path.abspath(p)
+		dirname, name = os.path.split(p)
+		if not name:
+			return _DIR
+		entries = self._entries(dirname)
+		if entries is None:
+			return _ABSENT
+		kind = entries.get(name, None)
+		if kind is None:
+			kind = self._stat(p)
+			if kind is not None:
+				entries[name] = kind
+				self.modified.add(dirname)
+			else:
+				kind = _ABSENT
+		return kind
+
+	def exists(self, p):
+		return self.kind(p) != _ABSENT
+
+	def _stat(self, p):
+		'''
+		Returns the kind of `p`, or None for a broken symlink
+		(which can't be cached, since its destination may appear
+		without modifying the link's directory).
+		'''
+		try:
+			st = os.stat(p)
+		except OSError as e:
+			if e.errno in (errno.ENOENT, errno.ENOTDIR):
+				return None if os.path.lexists(p) else _ABSENT
+			raise
+		if stat.S_ISDIR(st.st_mode):
+			self.mtimes[p] = st.st_mtime_ns
+			return _DIR
+		return _FILE
+
+	def _entries(self, dirname):
+		try:
+			return self.dirs[dirname]
+		except KeyError:
+			pass
+
+		entries = None
+		if self.kind(dirname) == _DIR:
+			mtime = self.mtimes.get(dirname, None)
+			if mtime is None and self._stat(dirname) == _DIR:
+				# existence came from a persisted entry in the parent
+				mtime = self.mtimes[dirname]
+			if mtime is not None:
+				entries = {}
+				persisted = self._load().get(dirname, None)
+				if persisted is not None and persisted[0] == mtime and not self.is_racy(mtime):
+					entries.update(persisted[1])
+		self.dirs[dirname] = entries
+		return entries
+
+	def _encode(self, dirname, value):
+		mtime, entries = value
+		fields = [str(mtime), dirname]
+		for name, kind in sorted(entries.items()):
+			fields.append(name)
+			fields.append(kind)
+		line = '\t'.join(fields)
+		if line.count('\t') != len(fields) - 1:
+			return None
+		return line
+
+	def _decode(self, line):
+		fields = line.split('\t')
+		if len(fields) < 2 or len(fields) % 2 != 0:
+			return None
+		try:
+			mtime = int(fields[0])
+		except ValueError:
+			return None
+		entries = dict(zip(fields[2::2], fields[3::2]))
+		return fields[1], (mtime, entries)
+
+	def save(self):
+		if not self.modified:
+			return
+		records = []
+		for dirname in self.modified:
+			entries = self.dirs.get(dirname, None)
+			mtime = self.mtimes.get(dirname, None)
+			if entries is None or mtime is None or self.is_racy(mtime):
+				continue
+			records.append((dirname, (mtime, dict(entries))))
+		self.modified = set()
+		self._append(records)
+
+class GupfileCache(CacheJournal):
+	'''
+	Parsed Gupfiles, keyed by path and validated against the
+	file's (size, mtime_ns). Each GupfileMatcher (and the regexes it
+	compiles) is kept for the whole run, and its index is persisted
+	so that other invocations can skip parsing. Persisted records
+	are only decoded when they're used.
+	'''
+	def __init__(self, path):
+		super(GupfileCache, self).__init__(path)
+		self.parsed = {}
+		self.modified = {}
+
+	def matcher(self, path):
+		key = os.path.abspath(path)
+		st = os.stat(key)
+		sig = (st.st_size, st.st_mtime_ns)
+		cached = self.parsed.get(key, None)
+		if cached is not None and cached[0] == sig:
+			return cached[1]
+
+		matcher = None
+		racy = self.is_racy(st.st_mtime_ns)
+		persisted = self._load().get(key, None)
+		if persisted is not None and not racy:
+			try:
+				size, mtime, record = json.loads(persisted)
+				if (size, mtime) == sig:
+					matcher = GupfileMatcher.restore(record)
+			except (ValueError, TypeError, KeyError) as e:
+				_log.debug("Ignoring invalid record for %s: %s", path, e)
+		if matcher is None:
+			with open(key) as f:
+				matcher = GupfileMatcher(parse_gupfile(f))
+			if not racy:
+				self.modified[key] = json.dumps([sig[0], sig[1], matcher.persisted()])
+		else:
+			_log.trace("Loaded parsed gupfile: %s", path)
+		self.parsed[key] = (sig, matcher)
+		return matcher
+
+	def _encode(self, path, value):
+		# `value` is JSON, which is only decoded when used
+		if '\t' in path:
+			return None
+		return '%s\t%s' % (path, value)
+
+	def _decode(self, line):
+		if '\t' not in line:
+			return None
+		return tuple(line.split('\t', 1))
+
+	def save(self):
+		if not self.modified:
+			return
+		records = list(self.modified.items())
+		self.modified = {}
+		self._append(records)
+
+_caches = [summary_journal()]
+
+def register_cache(cache):
+	_caches.append(cache)
+
+def save_caches():
+	for cache in _caches:
+		cache.save()
+
+# (ResolutionCache, GupfileCache) by project root
+_project_caches = {}
+
+def _caches_for(target_path):
+	'''
+	The caches for the project containing `target_path`
+	(which are only persisted if it has a .gup directory).
+	'''
+	root = project_root(os.path.dirname(os.path.abspath(target_path)))
+	caches = _project_caches.get(root, None)
+	if caches is None:
+		meta_dir = None if root is None else os.path.join(root, META_DIR)
+		caches = _project_caches[root] = (
+			ResolutionCache(meta_dir and os.path.join(meta_dir, 'builders')),
+			GupfileCache(meta_dir and os.path.join(meta_dir, 'gupfiles')),
+		)
+		for cache in caches:
+			register_cache(cache)
+	return caches
+
+def clear_resolution_cache():
+	for resolution_cache, _gupfiles in _project_caches.values():
+		resolution_cache.clear()
+
 class BuildCandidate(object):
 	'''
 	A potential builder for a given target.
@@ -31,6 +360,7 @@ class BuildCandidate(object):
 	it may not contain a definition for the given target.
 
 	get_builder() returns the actual Builder, if there is one
+	(using the given ResolutionCache and GupfileCache)
 	'''
 
 	def __init__(self, root, suffix, indirect, target):
@@ -58,8 +388,10 @@ class BuildCandidate(object):
 				parts.append(self.suffix)
 		return parts
 
-	def get_builder(self):
+	def get_builder(self, resolution_cache, gupfile_cache):
 		path = self.guppath
+		if not resolution_cache.exists(path):
+			return None
 		if not os.path.exists(path):
 			return None
 		if os.path.isdir(path):
@@ -82,15 +414,14 @@ class BuildCandidate(object):
 				return None
 			return Builder(path, self.target, build_basedir, parent=None)
 
-		with open(path) as f:
-			try:
-				rules = parse_gupfile(f)
-			except AssertionError as e:
-				reason = str(e)
-				if reason:
-					reason = " (%s)" % (reason,)
-				raise SafeError("Invalid %s: %s%s" % (GUPFILE, path, reason))
-			_log.trace("Parsed gupfile: %r" % rules)
+		try:
+			matcher = gupfile_cache.matcher(path)
+		except AssertionError as e:
+			reason = str(e)
+			if reason:
+				reason = " (%s)" % (reason,)
+			raise SafeError("Invalid %s: %s%s" % (GUPFILE, path, reason))
+		_log.trace("Parsed gupfile: %r", matcher)
 	
 		match_target = self.target
 		# always use `/` as path sep in gupfile patterns
@@ -98,27 +429,27 @@ class BuildCandidate(object):
 			match_target = self.target.replace(os.path.sep, '/')
 
 		def find_matching_rule(matchfn, target, match_target):
-			for script, ruleset in rules:
-				if matchfn(ruleset, match_target):
-					base = os.path.realpath(build_basedir)
-					parent = None
-
-					if script.startswith('!'):
-						script = script[1:]
-						script_path = which(script)
-						if script_path is None:
-							raise SafeError("Build command not found on PATH: %s\n     %s(specified in %s)" % (script, INDENT, path))
-					else:
-						script_path = os.path.join(os.path.dirname(path), script)
-						parent = find_matching_rule(Guprules.match_exactly, script, script)
-						script = os.path.normpath(script)
-					return Builder(
-						script_path,
-						os.path.relpath(os.path.join(build_basedir, target), base),
-						base, parent)
-			return None
-
-		match_fn = Guprules.match_exactly if target_is_builder() else Guprules.match
+			script = matchfn(match_target)
+			if script is None:
+				return None
+			base = os.path.realpath(build_basedir)
+			parent = None
+
+			if script.startswith('!'):
+				script = script[1:]
+				script_path = which(script)
+				if script_path is None:
+					raise SafeError("Build command not found on PATH: %s\n     %s(specified in %s)" % (script, indent(), path))
+			else:
+				script_path = os.path.join(os.path.dirname(path), script)
+				parent = find_matching_rule(matcher.match_exactly, script, script)
+				script = os.path.normpath(script)
+			return Builder(
+				script_path,
+				os.path.relpath(os.path.join(build_basedir, target), base),
+				base, parent)
+
+		match_fn = matcher.match_exactly if target_is_builder() else matcher.match
 		return find_matching_rule(match_fn, self.target, match_target)
 
 class Builder(object):
@@ -140,8 +471,9 @@ class Builder(object):
 
 	@staticmethod
 	def for_target(path):
+		resolution_cache, gupfile_cache = _caches_for(path)
 		for candidate in possible_gup_files(path):
-			builder = candidate.get_builder()
+			builder = candidate.get_builder(resolution_cache, gupfile_cache)
 			if builder is not None:
 				return builder
 		return None
@@ -237,10 +569,152 @@ class Guprules(object):
 		return (
 			any((rule.match_exactly(p) for rule in self.includes))
 		)
+
+	def excluded(self, p):
+		return any((rule.match(p) for rule in self.excludes))
+
+	def patterns(self):
+		return [rule.pattern for rule in self.includes + self.excludes]
 	
 	def __repr__(self):
 		return repr(self.includes + self.excludes)
 
+class GupfileMatcher(object):
+	r'''
+	Finds the first script in a parsed Gupfile whose rules match
+	a target, without testing each MatchRule in turn.
+
+	Literal patterns are looked up in a dict. Each script's wildcard
+	patterns are combined into a single regex (with its exclusions as a
+	negative lookahead), indexed by their literal prefixes (the text
+	before the first `*`). A script's regex is only compiled once a target
+	with one of those prefixes is looked up, and since the index can be
+	persisted, loading a large Gupfile needn't parse or compile anything.
+
+	>>> m = GupfileMatcher(parse_gupfile([
+	...   "a.gup:", " *.c", " !main.c",
+	...   "b.gup:", " main.c", " **/*.c",
+	... ]))
+	>>> m.match('foo.c'), m.match('main.c'), m.match('x/main.c'), m.match('foo.h')
+	('a.gup', 'b.gup', 'b.gup', None)
+	>>> m.match_exactly('**/*.c'), m.match_exactly('x/main.c')
+	('b.gup', None)
+	>>> GupfileMatcher.restore(m.persisted()).match('x/main.c')
+	'b.gup'
+	'''
+	def __init__(self, rules):
+		self._rules = rules
+		# (script, [pattern]), when restored
+		self._patterns = None
+		self._indexed = False
+		self._index = None
+		self._regexes = {}
+		self._exact = None
+
+	@classmethod
+	def restore(cls, record):
+		'''
+		A matcher from the record returned by persisted()
+		'''
+		matcher = cls(None)
+		matcher._patterns = [(script, patterns) for script, patterns in record['rules']]
+		matcher._indexed = True
+		if record['index'] is not None:
+			literals, wildcards = record['index']
+			matcher._index = (literals, [(i, prefixes, source) for i, prefixes, source in wildcards])
+		return matcher
+
+	def persisted(self):
+		'''
+		A JSON-serializable record of this matcher
+		'''
+		return {
+			'rules': [(script, ruleset.patterns()) for script, ruleset in self.rules],
+			'index': self._get_index(),
+		}
+
+	@property
+	def rules(self):
+		if self._rules is None:
+			self._rules = [(script, Guprules(MatchRule(text) for text in patterns)) for script, patterns in self._patterns]
+		return self._rules
+
+	def __repr__(self):
+		return repr(self.rules)
+
+	def _get_index(self):
+		if not self._indexed:
+			self._indexed = True
+			try:
+				self._index = self._build_index()
+			except ValueError as e:
+				# invalid pattern; fall back to checking rules in order
+				# so that it only fails if it's actually reached
+				_log.trace("Unable to index gupfile rules: %s", e)
+		return self._index
+
+	def _build_index(self):
+		literals = {}
+		wildcards = []
+		for i, (script, ruleset) in enumerate(self.rules):
+			sources = []
+			prefixes = []
+			for rule in ruleset.includes:
+				if rule.is_literal:
+					indexes = literals.setdefault(rule.text, [])
+					if i not in indexes:
+						indexes.append(i)
+				else:
+					sources.append(rule.regex_source())
+					prefix = rule.text.split('*', 1)[0]
+					if prefix not in prefixes:
+						prefixes.append(prefix)
+			if not sources:
+				continue
+			source = '(?:%s)$' % ('|'.join(sources),)
+			if ruleset.excludes:
+				excludes = '|'.join(rule.regex_source() for rule in ruleset.excludes)
+				source = '(?!(?:%s)$)%s' % (excludes, source)
+			wildcards.append((i, prefixes, source))
+		return literals, wildcards
+
+	def _regex(self, i, source):
+		regex = self._regexes.get(i, None)
+		if regex is None:
+			regex = self._regexes[i] = re.compile(source)
+		return regex
+
+	def match(self, p):
+		index = self._get_index()
+		if index is None:
+			for script, ruleset in self.rules:
+				if ruleset.match(p):
+					return script
+			return None
+
+		_log.trace("Matching %r against %d rules" % (p, len(self.rules)))
+		literals, wildcards = index
+		best = None
+		for i in literals.get(p, ()):
+			if not self.rules[i][1].excluded(p):
+				best = i
+				break
+		for i, prefixes, source in wildcards:
+			if best is not None and i >= best:
+				break
+			if any(p.startswith(prefix) for prefix in prefixes) and self._regex(i, source).match(p):
+				best = i
+				break
+		return None if best is None else self.rules[best][0]
+
+	def match_exactly(self, p):
+		if self._exact is None:
+			self._exact = {}
+			for script, ruleset in self.rules:
+				for rule in ruleset.includes:
+					self._exact.setdefault(rule.text, script)
+		return self._exact.get(p, None)
+
 def parse_gupfile(f):
 	r'''
 	>>> parse_gupfile([
@@ -257,6 +731,7 @@ def parse_gupfile(f):
 	... ])
 	[('foo.gup', [MatchRule('foo1'), MatchRule('foo2')]), ('bar.gup', [MatchRule('bar1'), MatchRule('bar2')])]
 	'''
+	summary_count('gupfiles_parsed')
 	rules = []
 	current_gupfile = None
 	current_matches = None
@@ -298,21 +773,27 @@ class MatchRule(object):
 		_log.trace("Exact-matching %r exactly against %r" % (self.text, f))
 		return self.text == f
 
-	def match(self, f): # pylint: disable=E0202; method intentilnally shadowed later
-		regexp = '^'
+	@property
+	def is_literal(self):
+		return '*' not in self.text
+
+	def regex_source(self):
+		regexp = ''
 		for i, part in enumerate(re.split(self._splitter, self.text)):
 			if i % 2 == 0:
 				# raw part
 				regexp += re.escape(part)
 			else:
 				if part == '*':
-					regexp += "([^/]*)"
+					regexp += "(?:[^/]*)"
 				elif part == '**':
-					regexp += "(.*)"
+					regexp += "(?:.*)"
 				else:
 					raise ValueError("Invalid pattern: %s" % (self.text))
-		regexp += '$'
-		regexp = re.compile(regexp)
+		return regexp
+
+	def match(self, f): # pylint: disable=E0202; method intentilnally shadowed later
+		regexp = re.compile('^' + self.regex_source() + '$')
 		_log.trace("Compiled %r -> %r" % (self.text, regexp.pattern))
 		def match(f):
 			_log.trace("Matching %r against %r" % (f, regexp.pattern))
@@ -320,11 +801,14 @@ class MatchRule(object):
 		self.match = match
 		return self.match(f)
 
-	def __repr__(self):
-		text = self.text
+	@property
+	def pattern(self):
 		if self.invert:
-			text = '!' + text
-		return 'MatchRule(%r)' % (text,)
+			return '!' + self.text
+		return self.text
+
+	def __repr__(self):
+		return 'MatchRule(%r)' % (self.pattern,)
 
 
 if __name__ == '__main__':
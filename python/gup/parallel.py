@@ -2,6 +2,9 @@ import tempfile
 
 from .log import getLogger
 from .error import SafeError, UNKNOWN_ERROR_CODE
+from .timeline import timeline_span
+from .summary import summary_count
+from .selfprofile import save_profile
 _log = getLogger(__name__)
 _debug = _log.trace
 
@@ -36,12 +39,20 @@ class SerialJobserver(object):
 		jobfn()
 		done(0)
 
+	def try_start_job(self, jobfn, done):
+		return False
+
+	def wait_jobs(self, timeout):
+		return 0
+
 class Job:
-	def __init__(self, name, pid, donefunc):
+	def __init__(self, name, pid, donefunc, borrowed=False):
 		self.name = name
 		self.pid = pid
 		self.rv = None
 		self.donefunc = donefunc
+		# whether this job runs on a token read just for it
+		self.borrowed = borrowed
 		
 	def __repr__(self):
 		return 'Job(%s,%d)' % (self.name, self.pid)
@@ -68,12 +79,14 @@ class FDJobserver(object):
 		os.write(self.fds[1], b't')
 		self.tokens -= 1
 
-	def wait(self, want_token):
+	def wait(self, want_token, timeout=None):
 		rfds = list(self.waitfds.keys())
 		if want_token:
 			rfds.append(self.fds[0])
 		assert(rfds)
-		r,w,x = select.select(rfds, [], [])
+		r,w,x = select.select(rfds, [], [], timeout)
+		if not r:
+			return
 		_debug('self.fds=%r; wfds=%r; readable: %r' % (self.fds, self.waitfds, r))
 		for fd in r:
 			if self.fds and fd == self.fds[0]:
@@ -81,13 +94,15 @@ class FDJobserver(object):
 			else:
 				pd = self.waitfds[fd]
 				_debug("done: %r" % pd.name)
-				self._release(1)
+				if pd.borrowed:
+					os.write(self.fds[1], b't')
+				else:
+					self._release(1)
 				os.close(fd)
 				del self.waitfds[fd]
-				rv = os.waitpid(pd.pid, 0)
-				assert(rv[0] == pd.pid)
-				_debug("done1: rv=%r" % (rv,))
-				rv = rv[1]
+				pid, rv, usage = os.wait4(pd.pid, 0)
+				assert(pid == pd.pid)
+				_debug("done1: rv=%r, cpu=%.3fs, maxrss=%dKiB" % (rv, usage.ru_utime + usage.ru_stime, usage.ru_maxrss))
 				if os.WIFEXITED(rv):
 					pd.rv = os.WEXITSTATUS(rv)
 				else:
@@ -98,12 +113,14 @@ class FDJobserver(object):
 	def _get_token(self, reason):
 		"Ensure we have one token available."
 		assert(self.tokens <= 1)
+		if self.tokens >= 1:
+			_debug('(%r) used my own token...' % reason)
+			return
+		with timeline_span('wait for token', 'jobserver', reason=str(reason)):
+			self._wait_for_token(reason)
+
+	def _wait_for_token(self, reason):
 		while 1:
-			if self.tokens >= 1:
-				_debug("self.tokens is %d" % self.tokens)
-				assert(self.tokens == 1)
-				_debug('(%r) used my own token...' % reason)
-				break
 			assert(self.tokens < 1)
 			_debug('(%r) waiting for tokens...' % reason)
 			self.wait(want_token=1)
@@ -162,31 +179,61 @@ class FDJobserver(object):
 		assert(self.tokens >= 1)
 		assert(self.tokens == 1)
 		self.tokens -= 1
+		self._fork(reason, jobfunc, donefunc)
+
+	def try_start_job(self, jobfunc, donefunc):
+		"""
+		Start a job only if a token is free right now (our own token is
+		never used, as it may be in use by a build script).
+		Returns whether the job was started.
+		"""
+		if not self._try_read(1):
+			return False
+		self._fork('speculative build', jobfunc, donefunc, borrowed=True, speculative=True)
+		return True
+
+	def wait_jobs(self, timeout):
+		"Reap any jobs which finish within `timeout`, returning the number still running"
+		if self._running():
+			self.wait(want_token=0, timeout=timeout)
+		return self._running()
+
+	def _fork(self, reason, jobfunc, donefunc, borrowed=False, speculative=False):
 		r,w = os.pipe()
 		pid = os.fork()
 		if pid == 0:
 			# child
 			os.close(r)
+			# our parent's jobs are not ours to wait for
+			for fd in self.waitfds:
+				os.close(fd)
+			self.waitfds = {}
 			rv = 201
 			try:
 				try:
 					rv = jobfunc() or 0
 					_debug('jobfunc completed (%r, %r)' % (jobfunc,rv))
 				except SafeError as e:
-					_log.error("%s" % (str(e),))
+					# a speculative build may fail where the real one
+					# wouldn't, which will report any real failure
+					(_log.debug if speculative else _log.error)("%s" % (str(e),))
 					rv = SafeError.exitcode
 				except KeyboardInterrupt:
 					rv = SafeError.exitcode
 				except Exception:
-					import traceback
-					traceback.print_exc()
+					if speculative:
+						_log.debug("speculative build failed", exc_info=True)
+					else:
+						import traceback
+						traceback.print_exc()
 					rv = UNKNOWN_ERROR_CODE
 			finally:
 				_debug('exit: %d' % rv)
+				save_profile()
 				os._exit(rv)
 		_close_on_exec(r, True)
 		os.close(w)
-		pd = Job(reason, pid, donefunc)
+		pd = Job(reason, pid, donefunc, borrowed)
 		self.waitfds[r] = pd
 
 	def wait_all(self):
@@ -253,6 +300,8 @@ class NamedPipeJobserver(object):
 				os.remove(self.path)
 
 	def start_job(self, *a): self.server.start_job(*a)
+	def try_start_job(self, *a): return self.server.try_start_job(*a)
+	def wait_jobs(self, *a): return self.server.wait_jobs(*a)
 
 
 
@@ -319,6 +368,15 @@ def wait_all():
 def start_job(jobfunc, donefunc):
 	return _jobserver.start_job(jobfunc, donefunc)
 
+def try_start_job(jobfunc, donefunc):
+	return _jobserver.try_start_job(jobfunc, donefunc)
+
+def wait_jobs(timeout):
+	return _jobserver.wait_jobs(timeout)
+
+def is_parallel():
+	return _jobserver is not None and not isinstance(_jobserver, SerialJobserver)
+
 
 try:
 	import fcntl
@@ -427,12 +485,20 @@ else:
 					raise
 			else:
 				_log.trace("%s lock (try)", self.name)
+				summary_count('locks')
 				self.owned = kind
 
 		def waitlock(self, kind=fcntl.LOCK_EX):
 			assert(self.owned != kind)
 			_log.trace("%s lock (wait)", self.name)
-			fcntl.lockf(self.lockfile, kind, 0, 0)
+			try:
+				fcntl.lockf(self.lockfile, kind|fcntl.LOCK_NB, 0, 0)
+			except IOError as e:
+				if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+				# only contended locks are worth profiling
+				with timeline_span('wait for lock', 'lock', target=self.name):
+					fcntl.lockf(self.lockfile, kind, 0, 0)
+			summary_count('locks')
 			self.owned = kind
 
 		def unlock(self):
@@ -1,7 +1,7 @@
 import os
 import errno
 from .log import getLogger
-from .var import IS_WINDOWS
+from .var import IS_WINDOWS, META_DIR
 
 # _log = getLogger(__name__)
 
@@ -11,6 +11,31 @@ def resolve_base(p):
 		os.path.basename(p)
 	)
 
+_project_roots = {}
+
+def project_root(dir):
+	'''
+	The outermost directory containing `dir` (inclusive) which has
+	a .gup metadata directory, or None. Caches which cover a whole
+	project are kept in its .gup directory.
+	'''
+	dir = os.path.abspath(dir)
+	root = _project_roots.get(dir, None)
+	if root is not None:
+		return root
+	candidate = dir
+	while True:
+		if os.path.isdir(os.path.join(candidate, META_DIR)):
+			root = candidate
+		parent = os.path.dirname(candidate)
+		if parent == candidate:
+			break
+		candidate = parent
+	if root is not None:
+		# (a missing root isn't remembered, since a build may create it)
+		_project_roots[dir] = root
+	return root
+
 def traverse_from(base, rel, resolve_final=False):
 	if IS_WINDOWS:
 		# yeah, nah
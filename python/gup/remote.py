@@ -0,0 +1,364 @@
+'''
+A remote backend for the output cache (enabled by $GUP_REMOTE_CACHE),
+using a simple HTTP protocol:
+
+	GET /traces/<key>    the traces recorded for a builder (see cache.py)
+	GET /outputs/<key>   a cached output, as a tar archive
+	PUT (to either)      store it
+
+A GET for anything which isn't stored returns 404. `python -m gup.cache_server`
+is a minimal server, but anything which can store and serve files by path
+(e.g. a WebDAV server) will do.
+
+Downloads run on a small pool of threads (each keeping its connection
+alive), so that they overlap with building. Uploads are handed to a
+background process when each `gup` invocation finishes, so that they're
+not on the critical path - only the root invocation waits for them.
+Archives are streamed through temporary files rather than being held
+in memory.
+
+If the remote fails, it's not used for the rest of the build (by this
+process or any it starts), via $GUP_REMOTE_CACHE_DISABLED.
+'''
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from .log import getLogger
+from .error import SafeError
+from .util import rmtree, mkdirp, try_remove
+from .var import RUN_ID, cache_dir, remote_cache_url, disable_remote_cache
+from .parallel import Lock
+from .gupfile import register_cache
+_log = getLogger(__name__)
+
+_BUFFER_SIZE = 256 * 1024
+
+def pack_entry(entry, f):
+	'''
+	Write a cache entry (directory) to `f` as a tar stream
+	'''
+	with tarfile.open(fileobj=f, mode='w|') as tar:
+		for name in ('meta', 'deps', 'target'):
+			tar.add(os.path.join(entry, name), arcname=name)
+
+def unpack_entry(f, dest):
+	'''
+	Extract a tar stream written by pack_entry into `dest`
+	'''
+	with tarfile.open(fileobj=f, mode='r|') as tar:
+		for member in tar:
+			parts = member.name.split('/')
+			if parts[0] not in ('meta', 'deps', 'target') or '..' in parts or (
+				len(parts) > 1 and parts[0] != 'target'
+			) or not (member.isfile() or member.isdir() or member.issym()):
+				raise ValueError("Unexpected archive member: %s" % (member.name,))
+			if hasattr(tarfile, 'tar_filter'):
+				tar.extract(member, dest, filter='tar')
+			else:
+				tar.extract(member, dest)
+
+class RemoteCache(object):
+	WORKERS = 4
+	TIMEOUT = 30
+	# an unreachable server shouldn't hold up the build
+	CONNECT_TIMEOUT = 3
+
+	def __init__(self, url):
+		try:
+			from urllib.parse import urlparse
+		except ImportError:
+			from urlparse import urlparse
+		parsed = urlparse(url)
+		if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+			raise SafeError("Unsupported remote cache URL: %s" % (url,))
+		self.url = url
+		self.https = parsed.scheme == 'https'
+		self.netloc = parsed.netloc
+		self.prefix = parsed.path.rstrip('/')
+		self.failed = False
+		self._reset()
+
+	def _reset(self):
+		self.connections = threading.local()
+		self.pool = None
+		# (fn, args) of uploads, handed off by save()
+		self.queued = []
+		# output key -> future of an extracted download
+		self.downloads = {}
+		# trace key -> future of the remote traces
+		self.traces = {}
+
+	def after_fork(self):
+		# the pool's threads don't exist in a forked child
+		self._reset()
+
+	def _submit(self, fn, *args):
+		if self.pool is None:
+			from concurrent.futures import ThreadPoolExecutor
+			self.pool = ThreadPoolExecutor(max_workers=self.WORKERS)
+		return self.pool.submit(self._guard, fn, *args)
+
+	def _guard(self, fn, *args):
+		if self.failed:
+			return None
+		try:
+			return fn(*args)
+		except Exception as e: # pylint: disable=W0703; a broken remote must not break the build
+			if not self.failed:
+				self.failed = True
+				disable_remote_cache(self.url)
+				_log.warning("Not using remote cache %s: %s", self.url, e)
+			return None
+
+	def _connect(self):
+		import http.client
+		cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+		connection = cls(self.netloc, timeout=self.CONNECT_TIMEOUT)
+		connection.connect()
+		connection.sock.settimeout(self.TIMEOUT)
+		return connection
+
+	def _request(self, method, kind, key, body=None, headers={}):
+		import http.client
+		path = '%s/%s/%s' % (self.prefix, kind, key)
+		while True:
+			connection = getattr(self.connections, 'current', None)
+			if connection is None:
+				# failures connecting aren't retried
+				connection = self.connections.current = self._connect()
+				reused = False
+			else:
+				reused = True
+			try:
+				if body is not None:
+					body.seek(0)
+				connection.request(method, path, body=body, headers=headers)
+				return connection.getresponse()
+			except (http.client.HTTPException, OSError) as e:
+				connection.close()
+				self.connections.current = None
+				if not reused:
+					raise
+				# most likely a kept-alive connection which the server closed
+				_log.trace("Retrying %s %s: %s", method, path, e)
+
+	def _get(self, kind, key, dest):
+		'''
+		Download into the file `dest`, returning whether it exists.
+		'''
+		response = self._request('GET', kind, key)
+		try:
+			if response.status == 404:
+				return False
+			if response.status != 200:
+				raise IOError("GET %s/%s: %s %s" % (kind, key, response.status, response.reason))
+			shutil.copyfileobj(response, dest, _BUFFER_SIZE)
+			return True
+		finally:
+			# so the connection can be reused
+			response.read()
+
+	def _put(self, kind, key, src):
+		size = os.fstat(src.fileno()).st_size
+		response = self._request('PUT', kind, key, body=src, headers={
+			'Content-Length': str(size),
+			'Content-Type': 'application/octet-stream',
+		})
+		response.read()
+		if response.status not in (200, 201, 204):
+			raise IOError("PUT %s/%s: %s %s" % (kind, key, response.status, response.reason))
+		_log.trace("Uploaded %s/%s (%d bytes)", kind, key, size)
+
+	def _get_traces(self, key):
+		with tempfile.TemporaryFile() as f:
+			if not self._get('traces', key, f):
+				return []
+			f.seek(0)
+			return f.read().decode('utf-8').splitlines()
+
+	def prefetch_traces(self, key):
+		'''
+		Start fetching the traces stored remotely for `key`, if it's not already.
+		'''
+		if key not in self.traces and not self.failed:
+			self.traces[key] = self._submit(self._get_traces, key)
+
+	def trace_lines(self, key):
+		'''
+		Returns the trace lines stored remotely for `key` (each fetched once).
+		'''
+		self.prefetch_traces(key)
+		future = self.traces.get(key, None)
+		return [] if future is None else (future.result() or [])
+
+	def _download(self, key, tmp_root):
+		tmp = tempfile.mkdtemp(dir=tmp_root)
+		try:
+			with tempfile.TemporaryFile(dir=tmp_root) as f:
+				if not self._get('outputs', key, f):
+					rmtree(tmp)
+					return None
+				f.seek(0)
+				unpack_entry(f, tmp)
+		except:
+			rmtree(tmp)
+			raise
+		_log.trace("Downloaded output %s", key)
+		return tmp
+
+	def prefetch(self, key, tmp_root):
+		'''
+		Start downloading an output in the background, if it's not already.
+		'''
+		if key not in self.downloads and not self.failed:
+			self.downloads[key] = self._submit(self._download, key, tmp_root)
+
+	def download(self, key, tmp_root):
+		'''
+		Returns a directory (in tmp_root) containing the extracted
+		output, or None if it's not stored remotely.
+		'''
+		self.prefetch(key, tmp_root)
+		future = self.downloads.pop(key, None)
+		return None if future is None else future.result()
+
+	def _upload_output(self, key, archive):
+		try:
+			with open(archive, 'rb') as f:
+				self._put('outputs', key, f)
+		finally:
+			os.remove(archive)
+
+	def upload_output(self, key, entry, tmp_root):
+		'''
+		Upload a cache entry in the background. The entry is archived
+		immediately, so it may be removed once this returns.
+		'''
+		if self.failed:
+			return
+		fd, archive = tempfile.mkstemp(dir=tmp_root)
+		with os.fdopen(fd, 'wb') as f:
+			pack_entry(entry, f)
+		self.queued.append((self._upload_output, (key, archive)))
+
+	def _upload_trace(self, key, line):
+		lines = self._get_traces(key)
+		if line in lines:
+			return
+		with tempfile.TemporaryFile() as f:
+			f.write(''.join(existing + '\n' for existing in lines + [line]).encode('utf-8'))
+			f.flush()
+			self._put('traces', key, f)
+
+	def upload_trace(self, key, line):
+		'''
+		Add a trace line to those stored remotely (in the background).
+		Concurrent uploads for the same key may lose lines, which only
+		causes a cache miss.
+		'''
+		if not self.failed:
+			self.queued.append((self._upload_trace, (key, line.rstrip('\n'))))
+
+	def save(self):
+		'''
+		Hand queued uploads to a background process (or perform them,
+		where that's not possible), and discard unused downloads.
+		'''
+		downloads, self.downloads = self.downloads, {}
+		for future in downloads.values():
+			if not future.cancel():
+				future.add_done_callback(_discard_download)
+		queued, self.queued = self.queued, []
+		if not queued:
+			return
+		if hasattr(os, 'fork'):
+			self._detach(queued)
+		else:
+			self._upload(queued)
+
+	def _upload(self, queued):
+		for future in [self._submit(fn, *args) for fn, args in queued]:
+			future.result()
+
+	def _detach(self, queued):
+		'''
+		Upload in a (double forked) background process, once it holds
+		the shared lock which wait_for_uploads() waits on.
+		'''
+		lock_path = _uploads_lock_path()
+		mkdirp(os.path.dirname(lock_path))
+		# no threads may be running when we fork (downloads
+		# have been discarded by save(), so this is brief)
+		pool, self.pool = self.pool, None
+		if pool is not None:
+			pool.shutdown(wait=True)
+		r, w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				os.close(r)
+				if os.fork() != 0:
+					os._exit(0)
+				# don't hold the build's stdio open (but report failures)
+				devnull = os.open(os.devnull, os.O_RDWR)
+				os.dup2(devnull, 0)
+				os.dup2(devnull, 1)
+				os.close(devnull)
+				lock = Lock(lock_path)
+				lock.waitlock(lock.shared)
+				os.close(w)
+				self._upload(queued)
+			except Exception: # pylint: disable=W0703; nothing to report to
+				_log.debug("uploading failed", exc_info=True)
+				status = 1
+			finally:
+				os._exit(status)
+		os.close(w)
+		# returns once the uploader holds the lock (or has died)
+		os.read(r, 1)
+		os.close(r)
+		os.waitpid(pid, 0)
+
+def _discard_download(future):
+	tmp = None if future.cancelled() else future.result()
+	if tmp is not None:
+		rmtree(tmp)
+
+def _uploads_lock_path():
+	return os.path.join(cache_dir(), 'tmp', 'uploads-%s.lock' % (RUN_ID,))
+
+def wait_for_uploads():
+	'''
+	Wait for uploads started by this build (including nested
+	invocations) to finish. Only called by the root invocation.
+	'''
+	if cache_dir() is None:
+		return
+	lock_path = _uploads_lock_path()
+	if not os.path.exists(lock_path):
+		return
+	lock = Lock(lock_path)
+	with lock.write():
+		pass
+	try_remove(lock_path)
+
+_remotes = {}
+
+def remote_cache():
+	'''
+	The RemoteCache for $GUP_REMOTE_CACHE, or None if it's not set.
+	'''
+	url = remote_cache_url()
+	if url is None:
+		return None
+	remote = _remotes.get(url, None)
+	if remote is None:
+		remote = _remotes[url] = RemoteCache(url)
+		register_cache(remote)
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=remote.after_fork)
+	return remote
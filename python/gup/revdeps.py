@@ -0,0 +1,220 @@
+'''
+An index of which targets depend on each path, for `gup --affected`.
+
+Whenever a target's dependencies are committed, its (direct) dependency
+paths are appended to a log in its project's root .gup directory (see
+path.project_root). The log is merged into a sorted index by
+`gup --affected --compact`, or by whichever build (or query) finds it
+larger than COMPACT_THRESHOLD, so it doesn't grow without bound.
+Queries search the index in place, so they only read the entries
+they need.
+'''
+import os
+import errno
+import mmap
+
+from .log import getLogger
+from .parallel import Lock
+from .path import project_root
+from .gupfile import register_cache
+from .var import META_DIR
+_log = getLogger(__name__)
+
+class ReverseIndex(object):
+	HEADER = b'gup-deps-index 1\n'
+
+	# the log is merged into the index beyond this size
+	COMPACT_THRESHOLD = 1024 * 1024
+
+	def __init__(self, meta_dir):
+		self.meta_dir = meta_dir
+		self.index_path = os.path.join(meta_dir, 'deps-index')
+		self.log_path = os.path.join(meta_dir, 'deps-index-log')
+		self.pending = []
+		self.pid = os.getpid()
+
+	@classmethod
+	def find(cls, dir):
+		'''
+		Returns the index of the project containing `dir`, or None.
+		'''
+		root = project_root(dir)
+		if root is None:
+			return None
+		index = cls(os.path.join(root, META_DIR))
+		if os.path.exists(index.log_path) or os.path.exists(index.index_path):
+			return index
+		return None
+
+	def _lock(self):
+		return Lock(os.path.join(self.meta_dir, 'deps-index-lock'))
+
+	def record(self, target, paths):
+		if self.pid != os.getpid():
+			# records are saved by the process which made them
+			self.pid = os.getpid()
+			self.pending = []
+		fields = [os.fsencode(os.path.abspath(target))] + [os.fsencode(path) for path in dict.fromkeys(paths)]
+		line = b'\t'.join(fields)
+		if b'\n' in line or line.count(b'\t') != len(fields) - 1:
+			_log.trace("can't index dependencies of %s", target)
+			return
+		self.pending.append(line + b'\n')
+
+	def save(self):
+		if self.pid != os.getpid() or not self.pending:
+			return
+		data = b''.join(self.pending)
+		self.pending = []
+		if not os.path.isdir(self.meta_dir):
+			# only persist alongside existing metadata
+			return
+		try:
+			with self._lock().write():
+				with open(self.log_path, 'ab') as f:
+					f.write(data)
+					size = f.tell()
+			if size > self.COMPACT_THRESHOLD:
+				self.compact()
+		except (OSError, IOError) as e:
+			_log.debug("Unable to save %s: %s", self.log_path, e)
+
+	def _read_log(self):
+		try:
+			with open(self.log_path, 'rb') as f:
+				data = f.read()
+		except (OSError, IOError) as e:
+			if e.errno != errno.ENOENT: raise
+			return []
+		# a trailing partial line is from an interrupted write
+		return [line.split(b'\t') for line in data.split(b'\n')[:-1]]
+
+	def _open_index(self):
+		try:
+			with open(self.index_path, 'rb') as f:
+				if os.fstat(f.fileno()).st_size <= len(self.HEADER):
+					return None
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, IOError) as e:
+			if e.errno != errno.ENOENT: raise
+			return None
+		if data[:len(self.HEADER)] != self.HEADER:
+			_log.warning("Ignoring invalid index: %s", self.index_path)
+			return None
+		return data
+
+	def _lookup(self, data, key):
+		'''
+		Returns the targets listed for `key` in the (sorted) index.
+		'''
+		# binary search for the first line whose key is >= `key`
+		# (`lo` and `hi` are always at the start of a line)
+		lo = len(self.HEADER)
+		hi = len(data)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start = data.rfind(b'\n', lo, mid) + 1
+			if start == 0:
+				start = lo
+			end = data.find(b'\n', start)
+			line_key = data[start:data.find(b'\t', start, end)]
+			if line_key < key:
+				lo = end + 1
+			else:
+				hi = start
+		if lo >= len(data):
+			return []
+		end = data.find(b'\n', lo)
+		fields = data[lo:end].split(b'\t')
+		if fields[0] != key:
+			return []
+		return fields[1:]
+
+	def affected(self, paths):
+		'''
+		Returns every target which (transitively) depends on any of `paths`.
+		'''
+		with self._lock().read():
+			records = self._read_log()
+			index = self._open_index()
+
+		# log records supersede everything indexed for their target
+		overlay = {}
+		for record in records:
+			overlay[record[0]] = record[1:]
+		overlay_dependents = {}
+		for target, deps in overlay.items():
+			for dep in deps:
+				overlay_dependents.setdefault(dep, []).append(target)
+
+		def dependents(path):
+			result = overlay_dependents.get(path, [])
+			if index is not None:
+				result = result + [target for target in self._lookup(index, path) if target not in overlay]
+			return result
+
+		seen = set()
+		affected = set()
+		pending = [os.fsencode(os.path.abspath(path)) for path in paths]
+		while pending:
+			path = pending.pop()
+			if path in seen:
+				continue
+			seen.add(path)
+			for target in dependents(path):
+				affected.add(target)
+				pending.append(target)
+		if index is not None:
+			index.close()
+		return sorted(os.fsdecode(target) for target in affected)
+
+	def needs_compaction(self):
+		try:
+			return os.stat(self.log_path).st_size > self.COMPACT_THRESHOLD
+		except OSError:
+			return False
+
+	def compact(self):
+		'''
+		Merge the log into the index.
+		'''
+		with self._lock().write():
+			dependencies = {}
+			index = self._open_index()
+			if index is not None:
+				for line in index[len(self.HEADER):].split(b'\n')[:-1]:
+					fields = line.split(b'\t')
+					for target in fields[1:]:
+						dependencies.setdefault(target, []).append(fields[0])
+				index.close()
+			records = self._read_log()
+			for record in records:
+				dependencies[record[0]] = record[1:]
+
+			dependents = {}
+			for target, deps in dependencies.items():
+				for dep in deps:
+					dependents.setdefault(dep, []).append(target)
+
+			temp = self.index_path + '.tmp'
+			with open(temp, 'wb') as f:
+				f.write(self.HEADER)
+				for dep in sorted(dependents):
+					f.write(b'\t'.join([dep] + dependents[dep]) + b'\n')
+			os.rename(temp, self.index_path)
+			with open(self.log_path, 'wb'):
+				pass
+		_log.debug("compacted %d log records into %s (%d paths)", len(records), self.index_path, len(dependents))
+
+# project root -> ReverseIndex
+_reverse_indexes = {}
+
+def record_dependencies(target, paths):
+	root = project_root(os.path.dirname(os.path.abspath(target)))
+	if root is None:
+		return
+	index = _reverse_indexes.get(root, None)
+	if index is None:
+		index = _reverse_indexes[root] = ReverseIndex(os.path.join(root, META_DIR))
+		register_cache(index)
+	index.record(target, paths)
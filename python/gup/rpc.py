@@ -0,0 +1,284 @@
+'''
+The root gup process hosts a build coordinator on a unix socket,
+advertised to build scripts via $GUP_COORDINATOR.
+
+Nested `gup` invocations forward their arguments, working directory,
+environment and stdio to the coordinator instead of bootstrapping
+all of gup themselves. The coordinator forks a worker (which already
+has gup loaded) to perform the build on their behalf, and reports
+back its exit status.
+
+The socket lives in a private (0700) directory created by the coordinator,
+and connections from other users are refused (where the platform can
+tell us who's connecting), since the coordinator will run anything it's
+asked to.
+
+This module is loaded first (both in bin/gup and in the python package),
+so it must only depend on the standard library.
+'''
+from __future__ import print_function
+import os
+import sys
+import errno
+import struct
+import socket
+
+COORDINATOR_ENV = 'GUP_COORDINATOR'
+
+# options which may precede targets in a build invocation
+# (anything else starting with `--` is an action which runs locally)
+_BUILD_FLAGS = ('--update', '--ifchange', '--jobs', '--trace', '--keep-failed', '--speculate', '--quiet', '--verbose')
+
+_MAX_FDS = 3
+_forward_attempted = False
+
+def _encode_request(argv):
+	umask = os.umask(0)
+	os.umask(umask)
+	parts = [os.getcwd(), str(umask), str(len(argv))] + list(argv)
+	parts.extend(['%s=%s' % item for item in os.environ.items()])
+	return b'\0'.join([os.fsencode(part) for part in parts])
+
+def _decode_request(payload):
+	parts = [os.fsdecode(part) for part in payload.split(b'\0')]
+	cwd = parts[0]
+	umask = int(parts[1])
+	argc = int(parts[2])
+	argv = parts[3:3+argc]
+	env = dict([item.split('=', 1) for item in parts[3+argc:]])
+	return (cwd, umask, argv, env)
+
+def _is_build(argv):
+	for arg in argv:
+		if arg == '--':
+			break
+		if arg.startswith('--') and arg.split('=', 1)[0] not in _BUILD_FLAGS:
+			return False
+	return True
+
+def _recv_all(sock):
+	chunks = []
+	while True:
+		chunk = sock.recv(4096)
+		if not chunk: break
+		chunks.append(chunk)
+	return b''.join(chunks)
+
+def forward(argv):
+	'''
+	Forward a build invocation to the coordinator.
+	Returns the exit status, or None if this invocation
+	must run locally.
+	'''
+	global _forward_attempted
+	if _forward_attempted:
+		return None
+	_forward_attempted = True
+
+	path = os.environ.get(COORDINATOR_ENV, None)
+	if not path or path == '0' or not _is_build(argv):
+		return None
+
+	# jobserver fds inherited from `make` can't be shared with the coordinator
+	if 'GUP_JOBSERVER' not in os.environ:
+		return None
+
+	import array
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		try:
+			sock.connect(path)
+			payload = _encode_request(argv)
+			# the first byte carries our stdio
+			sock.sendmsg([payload[:1]], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', range(_MAX_FDS)))])
+		except (OSError, ValueError):
+			return None
+		sock.sendall(payload[1:])
+		sock.shutdown(socket.SHUT_WR)
+		response = _recv_all(sock)
+	finally:
+		sock.close()
+
+	try:
+		return int(response)
+	except ValueError:
+		# the worker died without reporting a status
+		return 2
+
+def forward_and_exit(argv):
+	'''
+	Exit with the result of a forwarded build, or return
+	if this invocation must run locally.
+	'''
+	try:
+		status = forward(argv)
+	except KeyboardInterrupt:
+		sys.exit(2)
+	if status is not None:
+		sys.exit(status)
+
+def peer_uid(conn):
+	'''
+	The uid of the process at the other end of a unix socket,
+	or None if this platform doesn't support SO_PEERCRED.
+	'''
+	if not hasattr(socket, 'SO_PEERCRED'):
+		return None
+	creds = struct.Struct('3i')
+	_pid, uid, _gid = creds.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size))
+	return uid
+
+class Coordinator(object):
+	'''
+	A forking server (in a child of the root process).
+	`handler(argv)` runs in a fresh worker process for each
+	forwarded request, and returns its exit status.
+	'''
+	def __init__(self, handler):
+		self.handler = handler
+		self.dir = None
+		self.path = None
+		self.pid = None
+		self.control = None
+
+	@classmethod
+	def supported(cls):
+		return hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+
+	def start(self):
+		import tempfile
+		# only accessible by us (mkdtemp creates it with mode 0700)
+		self.dir = tempfile.mkdtemp(prefix='gup-rpc-')
+		self.path = os.path.join(self.dir, 'socket')
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			server.bind(self.path)
+			server.listen(64)
+		except:
+			server.close()
+			self._remove()
+			raise
+
+		r, w = os.pipe()
+		sys.stdout.flush()
+		sys.stderr.flush()
+		pid = os.fork()
+		if pid == 0:
+			os.close(w)
+			status = 0
+			try:
+				self._serve(server, r)
+			except KeyboardInterrupt:
+				pass
+			except Exception:
+				import traceback
+				traceback.print_exc()
+				status = 1
+			finally:
+				os._exit(status)
+		os.close(r)
+		server.close()
+		self.pid = pid
+		self.control = w
+		os.environ[COORDINATOR_ENV] = self.path
+
+	def stop(self):
+		if self.pid is None: return
+		# closing the control pipe tells the coordinator to exit
+		os.close(self.control)
+		os.waitpid(self.pid, 0)
+		self.pid = None
+		del os.environ[COORDINATOR_ENV]
+		# (in case the coordinator died without cleaning up)
+		self._remove()
+
+	def _remove(self):
+		for remove, path in [(os.remove, self.path), (os.rmdir, self.dir)]:
+			try:
+				remove(path)
+			except OSError as e:
+				if e.errno != errno.ENOENT: raise
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.stop()
+
+	def _serve(self, server, control):
+		import select
+		try:
+			while True:
+				try:
+					readable, _, _ = select.select([server, control], [], [])
+				except InterruptedError:
+					continue
+				self._reap()
+				if control in readable:
+					break
+				conn, _ = server.accept()
+				uid = peer_uid(conn)
+				if uid is not None and uid != os.getuid():
+					conn.close()
+					continue
+				pid = os.fork()
+				if pid == 0:
+					server.close()
+					os.close(control)
+					try:
+						self._handle(conn)
+					except KeyboardInterrupt:
+						pass
+					except Exception:
+						import traceback
+						traceback.print_exc()
+					finally:
+						os._exit(0)
+				conn.close()
+		finally:
+			server.close()
+			self._remove()
+
+	def _reap(self):
+		while True:
+			try:
+				pid, _ = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				return
+			if pid == 0:
+				return
+
+	def _handle(self, conn):
+		fds = []
+		data, ancdata, _, _ = conn.recvmsg(4096, socket.CMSG_SPACE(_MAX_FDS * 4))
+		for level, kind, fd_data in ancdata:
+			if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+				import array
+				received = array.array('i')
+				received.frombytes(fd_data[:len(fd_data) - (len(fd_data) % received.itemsize)])
+				fds.extend(received)
+		if not data or len(fds) != _MAX_FDS:
+			for fd in fds: os.close(fd)
+			return
+
+		cwd, umask, argv, env = _decode_request(data + _recv_all(conn))
+		if not _is_build(argv):
+			# never sent by `forward`
+			for fd in fds: os.close(fd)
+			return
+
+		sys.stdout.flush()
+		sys.stderr.flush()
+		for target_fd, fd in enumerate(fds):
+			if fd != target_fd:
+				os.dup2(fd, target_fd)
+				os.close(fd)
+		os.chdir(cwd)
+		os.umask(umask)
+		os.environ.clear()
+		os.environ.update(env)
+
+		status = self.handler(argv)
+		conn.sendall(str(status).encode('ascii'))
+		conn.close()
@@ -0,0 +1,79 @@
+'''
+Profiling of gup itself: when $GUP_PROFILE is set to a directory, every
+gup process (including forked jobs) runs under cProfile, and writes its
+stats to <pid>-<target>.pstats in that directory when it's done.
+`gup --profile-report <dir>` combines them.
+'''
+import os
+import re
+import sys
+
+from .var import ROOT_CWD, profile_dir
+
+class SelfProfile(object):
+	def __init__(self):
+		self.profiler = None
+		# the target this process is working on
+		self.label = None
+
+	def start(self):
+		if self.profiler is not None or profile_dir() is None:
+			return
+		import cProfile
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+
+	def after_fork(self):
+		if self.profiler is not None:
+			# start afresh, so that the parent's stats aren't duplicated
+			self.profiler.disable()
+			self.profiler = None
+			self.start()
+
+	def _filename(self):
+		label = 'root'
+		if self.label is not None:
+			label = re.sub(r'[^A-Za-z0-9._-]+', '_', os.path.relpath(self.label, ROOT_CWD)).strip('_')
+		return '%d-%s.pstats' % (os.getpid(), label)
+
+	def save(self):
+		if self.profiler is None:
+			return
+		self.profiler.disable()
+		directory = profile_dir()
+		try:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			self.profiler.dump_stats(os.path.join(directory, self._filename()))
+		except OSError as e:
+			sys.stderr.write("Unable to save profile: %s\n" % (e,))
+		self.profiler = None
+
+_self_profile = SelfProfile()
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_self_profile.after_fork)
+
+def start_profile(label=None):
+	'''
+	Start profiling this process (if $GUP_PROFILE is set).
+	'''
+	if label is not None:
+		_self_profile.label = label
+	_self_profile.start()
+
+def set_profile_label(label):
+	_self_profile.label = label
+
+def save_profile():
+	_self_profile.save()
+
+def profile_report(directory, sort, limit, stream):
+	import glob, pstats
+	paths = sorted(glob.glob(os.path.join(directory, '*.pstats')))
+	if not paths:
+		return False
+	stats = pstats.Stats(*paths, stream=stream)
+	stream.write("Combined profile of %d gup processes\n" % (len(paths),))
+	stats.sort_stats(sort).print_stats(limit)
+	return True
@@ -1,26 +1,128 @@
 import os
+import re
 import logging
 import errno
+import struct
+import binascii
+import threading
+import collections
+import io
 
 from .util import *
 from .log import getLogger
-from .gupfile import Builder
+from .gupfile import Builder, CacheJournal, register_cache
+from .revdeps import record_dependencies
 from .parallel import Lock
 from .path import resolve_base
-from .var import RUN_ID
+from .var import RUN_ID, ROOT_CWD, META_DIR, checksum_algorithm
 from .error import SafeError
+from .summary import summary_count, summary_target
 _log = getLogger(__name__)
 
-META_DIR = '.gup'
-
 class VersionMismatch(ValueError): pass
 
 class _dirty_args(object):
-	def __init__(self, deps, base, builder_path, build_dependency):
+	def __init__(self, deps, base, builder_path, build_dependency, prefetch=None):
 		self.deps = deps
 		self.base = base
 		self.builder_path = builder_path
-		self.build_dependency = build_dependency
+		self._build_dependency = build_dependency
+		self.prefetch = prefetch
+
+	def build_dependency(self, path):
+		built = self._build_dependency(path)
+		if built and self.prefetch is not None:
+			# the build may have modified anything
+			self.prefetch.invalidate()
+		return built
+
+	def get_mtime(self, path):
+		if self.prefetch is not None:
+			return self.prefetch.get_mtime(path)
+		return get_mtime(path)
+
+class _SharedPool(object):
+	'''
+	A thread pool for blocking filesystem work (stat()s and hashing),
+	created when first used. It's shut down before gup forks, so that
+	no threads are running (or holding locks) when it does, and
+	recreated when next used.
+	'''
+	WORKERS = 8
+
+	def __init__(self):
+		self.pool = None
+		self.lock = threading.Lock()
+
+	def get(self):
+		with self.lock:
+			if self.pool is None:
+				from concurrent.futures import ThreadPoolExecutor
+				self.pool = ThreadPoolExecutor(max_workers=self.WORKERS)
+			return self.pool
+
+	def before_fork(self):
+		with self.lock:
+			pool, self.pool = self.pool, None
+		if pool is not None:
+			# (queued work is finished, not cancelled)
+			pool.shutdown(wait=True)
+
+_shared_pool = _SharedPool()
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(before=_shared_pool.before_fork)
+
+class MtimePrefetch(object):
+	'''
+	Iterates over dependency rules while stat()ing the paths of
+	upcoming rules on the shared thread pool, so that checking
+	many file dependencies isn't bound by the latency of each stat.
+
+	Rules are still checked in order (stopping at the first dirty one),
+	and only up to WINDOW rules ahead are prefetched.
+	'''
+	# don't bother for fewer rules than this
+	MIN_RULES = 16
+	WINDOW = 64
+
+	def __init__(self, rules, base):
+		self.rules = rules
+		self.base = base
+		self.futures = {}
+
+	def __iter__(self):
+		pending = collections.deque()
+		rules = iter(self.rules)
+		def fill():
+			while len(pending) < self.WINDOW:
+				rule = next(rules, None)
+				if rule is None:
+					return
+				if isinstance(rule, BaseFileDependency):
+					path = rule.full_path(self.base)
+					if path not in self.futures:
+						# (the pool may have been replaced since the last fork)
+						self.futures[path] = _shared_pool.get().submit(get_mtime, path)
+				pending.append(rule)
+		fill()
+		while pending:
+			yield pending.popleft()
+			fill()
+
+	def get_mtime(self, path):
+		future = self.futures.pop(path, None)
+		if future is None:
+			return get_mtime(path)
+		return future.result()
+
+	def invalidate(self):
+		for future in self.futures.values():
+			future.cancel()
+		self.futures = {}
+
+	def close(self):
+		# (the pool is shared, and kept for later checks)
+		self.invalidate()
 
 def dirty_check_with_dep(path, check_fn, args): # -> (did_build, is_dirty)
 	dirty = check_fn()
@@ -33,9 +135,36 @@ def dirty_check_with_dep(path, check_fn, args): # -> (did_build, is_dirty)
 	else:
 		return (False, False)
 
+# dependencies recorded by this process, by target path
+_pending_deps = {}
+_pending_pid = None
+
+def _pending():
+	global _pending_deps, _pending_pid
+	if _pending_pid != os.getpid():
+		# a forked child mustn't write dependencies buffered by its parent
+		_pending_deps = {}
+		_pending_pid = os.getpid()
+	return _pending_deps
+
+def flush_dependencies():
+	'''
+	Write out all dependencies buffered by add_dependency.
+	Must be called before this invocation exits.
+	'''
+	pending = _pending()
+	for path in list(pending.keys()):
+		TargetState(path).flush()
+
 class TargetState(object):
 	_dep_lock = None
 
+	# the ResourceUsage of the current build (if measured)
+	usage = None
+
+	# Dependencies loaded by stats(), reused by the next deps() if unchanged
+	_preloaded = None
+
 	def __init__(self, p):
 		self.path = p
 	
@@ -72,19 +201,27 @@ class TargetState(object):
 	def deps(self):
 		rv = None
 		deps_path = self.meta_path('deps')
+		preloaded, self._preloaded = self._preloaded, None
+		if preloaded is not None:
+			try:
+				if _file_sig(os.stat(deps_path)) == preloaded.sig:
+					return preloaded
+			except OSError as e:
+				if e.errno != errno.ENOENT: raise
 		if not os.path.exists(deps_path):
 			_log.trace("Not loading missing deps at %s", deps_path)
 			return rv
 
 		with self._ensure_dep_lock().read():
 			try:
-				f = open(deps_path)
+				f = open(deps_path, 'rb')
 			except IOError as e:
 				if e.errno != errno.ENOENT: raise
 			else:
+				summary_count('deps_read')
 				try:
 					with f:
-						rv = Dependencies(self.path, f)
+						rv = self._read(f)
 				except VersionMismatch as e:
 					_log.debug("Ignoring stored dependencies from incompatible version: %s", deps_path)
 				except Exception as e:
@@ -93,16 +230,171 @@ class TargetState(object):
 		return rv
 
 	def add_dependency(self, dep):
-		lock = Lock(self.meta_path('deps2-lock'))
+		'''
+		Buffered until flush() / flush_dependencies()
+		'''
 		_log.debug('add dep: %s -> %s' % (self.path, dep))
+		_pending().setdefault(self.path, []).append(dep)
+
+	def flush(self):
+		deps = _pending().pop(self.path, None)
+		if not deps:
+			return
+		buf = io.StringIO()
+		for dep in deps:
+			dep.append_to(buf)
+		lock = Lock(self.meta_path('deps2-lock'))
 		with lock.write():
 			with open(self.meta_path('deps2'), 'a') as f:
-				dep.append_to(f)
+				f.write(buf.getvalue())
 	
+	def _cached(self, sig):
+		'''
+		The BinaryDeps cached for the deps file with signature `sig`, or None.
+		'''
+		try:
+			with open(self.meta_path('deps-cache'), 'rb') as f:
+				data = f.read()
+		except (OSError, IOError) as e:
+			if e.errno not in (errno.ENOENT, errno.ENOTDIR): raise
+			return None
+		try:
+			return BinaryDeps.of_file(data, sig)
+		except (ValueError, struct.error) as e:
+			_log.trace("Ignoring invalid %s: %s", self.meta_path('deps-cache'), e)
+			return None
+
+	def _cache(self, deps, sig=None):
+		'''
+		Store the BinaryDeps encoding of `deps` alongside the deps file,
+		which must not change while this runs (i.e. the lock is held).
+		Returns whether it was written.
+		'''
+		deps_path = self.meta_path('deps')
+		try:
+			if sig is None:
+				sig = _file_sig(os.stat(deps_path))
+			data = BinaryDeps.encode(deps, sig)
+			temp = self.meta_path('deps-cache2')
+			with open(temp, 'wb') as f:
+				f.write(data)
+			rename(temp, self.meta_path('deps-cache'))
+		except Exception as e:
+			_log.debug("Unable to cache %s: %s", deps_path, e)
+			return False
+		deps.sig = sig
+		return True
+
+	def _commit_deps(self, temp):
+		'''
+		Dependencies are appended to `temp` in the text format while building.
+		Once complete, they're rewritten in their final form (along with
+		their cached encoding) and moved into place.
+		Returns the committed Dependencies (or None if they couldn't be loaded).
+		'''
+		self.flush()
+		with Lock(self.meta_path('deps2-lock')).write():
+			with open(temp, 'rb') as f:
+				data = f.read()
+			try:
+				deps = Dependencies(self.path, data)
+				if self.usage is not None:
+					deps.stats = self._build_stats(deps)
+				data = deps.encode()
+			except Exception as e:
+				# leave it as-is, it'll be treated as dirty when loaded
+				_log.debug("Unable to load %s: %s", temp, e)
+				deps = None
+			else:
+				with open(temp, 'wb') as f:
+					f.write(data)
+		rename(temp, self.meta_path('deps'))
+		if deps is not None:
+			self._cache(deps)
+			base = os.path.dirname(os.path.abspath(self.path))
+			record_dependencies(self.path, [rule.full_path(base) for rule in deps.rules if isinstance(rule, BaseFileDependency)])
+		return deps
+
+	def _build_stats(self, deps):
+		usage = self.usage
+		wall = int(usage.wall * 1000)
+		# time spent in nested `gup` calls is already
+		# accounted for by the dependencies they built
+		own = max(0, wall - deps.waited)
+		summary_target(self.path, usage.wall, own / 1000.0)
+		return BuildStats(wall, int(usage.cpu * 1000), usage.maxrss, own + deps.critical)
+
+	def _read(self, f):
+		sig = _file_sig(os.fstat(f.fileno()))
+		cached = self._cached(sig)
+		data = None if cached is not None else f.read()
+		rv = Dependencies(self.path, data, cached)
+		rv.sig = sig
+		return rv
+
+	def stats(self):
+		'''
+		The BuildStats recorded by the last build, or None.
+		The loaded dependencies are kept for the next call to deps().
+		'''
+		# no locking needed, deps files are replaced atomically
+		try:
+			with open(self.meta_path('deps'), 'rb') as f:
+				summary_count('deps_read')
+				self._preloaded = self._read(f)
+		except (OSError, IOError) as e:
+			if e.errno not in (errno.ENOENT, errno.ENOTDIR): raise
+			return None
+		except Exception as e:
+			_log.trace("Unable to load stats for %s: %s", self.path, e)
+			return None
+		return self._preloaded.stats
+
+	def save_refreshed(self, deps):
+		'''
+		Store updated mtimes for ContentDependency rules whose
+		contents were unchanged, unless the deps have since been rewritten.
+		'''
+		deps_path = self.meta_path('deps')
+		with self._ensure_dep_lock().write():
+			try:
+				sig = _file_sig(os.stat(deps_path))
+			except OSError as e:
+				if e.errno != errno.ENOENT: raise
+				return
+			if deps.sig is None or sig != deps.sig:
+				_log.trace("Not refreshing modified deps at %s", deps_path)
+				return
+			temp = self.meta_path('deps-refresh')
+			with open(temp, 'wb') as f:
+				f.write(deps.encode())
+			rename(temp, deps_path)
+			self._cache(deps)
+		_log.trace("Refreshed stored mtimes in %s", deps_path)
+
+	def migrate(self):
+		'''
+		Cache the encoded form of stored dependencies,
+		if it's missing or out of date.
+		Returns whether anything was written.
+		'''
+		with self._ensure_dep_lock().write():
+			with open(self.meta_path('deps'), 'rb') as f:
+				sig = _file_sig(os.fstat(f.fileno()))
+				if self._cached(sig) is not None:
+					return False
+				data = f.read()
+			return self._cache(Dependencies(self.path, data), sig)
+
 	def mark_clobbers(self):
 		self.add_dependency(ClobbersTarget())
 	
-	def perform_build(self, builder, do_build):
+	def perform_build(self, builder, do_build, after_commit=None):
+		'''
+		Runs do_build(previous_deps) with this target locked. If it returns
+		true, the new dependencies are committed and passed to after_commit
+		(while the lock is still held).
+		'''
 		exe = builder.path
 		if not os.path.exists(exe):
 			raise SafeError("Build script not found: %s" % (exe))
@@ -131,47 +423,120 @@ class TargetState(object):
 				raise
 			else:
 				if built:
+					summary_count('built')
 					# always track the build time
 					built_time = get_mtime(self.path)
 					if built_time is not None:
 						with open(temp, 'a') as f:
 							BuildTime(built_time).append_to(f)
-					rename(temp, self.meta_path('deps'))
+					deps = self._commit_deps(temp)
+					if deps is not None and after_commit is not None:
+						after_commit(deps)
 				return built
 
+def _file_sig(st):
+	'''
+	Identifies a version of a (deps) file, which is always replaced by rename().
+	'''
+	return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
 class Dependencies(object):
-	FORMAT_VERSION = 3
-	def __init__(self, path, file):
+	'''
+	Stored dependencies are text, and shared with the OCaml implementation.
+	FORMAT_VERSION adds lines only this implementation writes (content:,
+	stats:, waited:, critical:), and is only used when they're present.
+	For faster loading, the BinaryDeps encoding of each deps file is cached
+	alongside it.
+	'''
+	FORMAT_VERSION = 4
+	BASE_FORMAT_VERSION = 3
+
+	def __init__(self, path, data, cached=None):
 		self.path = path
 		self.rules = []
 		self.checksum = None
 		self.clobbers = False
 		self.runid = None
+		self.stats = None
+
+		# the _file_sig of the deps file (if loaded from one)
+		self.sig = None
+
+		# total time spent in nested `gup` invocations (while building)
+		self.waited = 0
+
+		# the longest critical path of a built dependency (while building)
+		self.critical = 0
+
+		# set when a rule's stored mtime has been updated by is_dirty
+		self.refreshed = False
+
+		if cached is not None:
+			cached.load_into(self)
+			return
 
-		if file is None:
+		if data is None:
 			self.rules.append(NeverBuilt())
+			return
+
+		file_version = self.version_of(data)
+		if file_version not in (self.BASE_FORMAT_VERSION, self.FORMAT_VERSION):
+			raise VersionMismatch("can't read format version %s" % (file_version,))
+		self._load_text(data)
+
+	@staticmethod
+	def version_of(data):
+		version_line = data.split(b'\n', 1)[0].decode('ascii').strip()
+		_log.trace("version_line: %s" % (version_line,))
+		if not version_line.startswith('version:'): raise ValueError("Invalid file")
+		_, file_version = version_line.split(' ')
+		return int(file_version)
+
+	def _load_text(self, data):
+		for line in data.decode('utf-8').splitlines()[1:]:
+			dep = Dependency.parse(line.rstrip())
+			self._add(dep)
+
+	def _add(self, dep):
+		if isinstance(dep, Checksum):
+			assert self.checksum is None
+			self.checksum = dep.value
+		elif isinstance(dep, RunId):
+			assert self.runid is None
+			self.runid = dep
+		elif isinstance(dep, ClobbersTarget):
+			self.clobbers = True
+		elif isinstance(dep, BuildStats):
+			self.stats = dep
+		elif isinstance(dep, WaitTime):
+			self.waited += dep.value
+		elif isinstance(dep, CriticalPath):
+			self.critical = max(self.critical, dep.value)
 		else:
-			version_line = file.readline().strip()
-			_log.trace("version_line: %s" % (version_line,))
-			if not version_line.startswith('version:'): raise ValueError("Invalid file")
-			_, file_version = version_line.split(' ')
-			if int(file_version) != self.FORMAT_VERSION:
-				raise VersionMismatch("can't read format version %s" % (file_version,))
-
-			while True:
-				line = file.readline()
-				if not line: break
-				dep = Dependency.parse(line.rstrip())
-				if isinstance(dep, Checksum):
-					assert self.checksum is None
-					self.checksum = dep.value
-				elif isinstance(dep, RunId):
-					assert self.runid is None
-					self.runid = dep
-				elif isinstance(dep, ClobbersTarget):
-					self.clobbers = True
-				else:
-					self.rules.append(dep)
+			self.rules.append(dep)
+
+	def encode(self):
+		'''
+		The text to store, which is BASE_FORMAT_VERSION unless it needs more.
+		'''
+		deps = []
+		if self.runid is not None:
+			deps.append(self.runid)
+		if self.checksum is not None:
+			deps.append(Checksum(self.checksum))
+		if self.clobbers:
+			deps.append(ClobbersTarget())
+		if self.stats is not None:
+			deps.append(self.stats)
+		deps.extend(self.rules)
+		version = self.BASE_FORMAT_VERSION
+		if any(isinstance(dep, (ContentDependency, BuildStats)) for dep in deps):
+			version = self.FORMAT_VERSION
+		buf = io.StringIO()
+		buf.write('version: %s\n' % (version,))
+		for dep in deps:
+			dep.append_to(buf)
+		return buf.getvalue().encode('utf-8')
 	
 	def is_dirty(self, builder, build_dependency):
 		assert isinstance(builder, Builder)
@@ -182,12 +547,21 @@ class Dependencies(object):
 		base = os.path.dirname(self.path)
 		builder_path = os.path.relpath(builder.realpath, base)
 
-		dirty_args = _dirty_args(deps=self, base=base, builder_path=builder_path, build_dependency=build_dependency)
-		for rule in self.rules:
-			d = rule.is_dirty(dirty_args)
-			if d:
-				_log.trace('DIRTY: %s (from rule %r)', self.path, rule)
-				return True
+		rules = self.rules
+		prefetch = None
+		if len(rules) >= MtimePrefetch.MIN_RULES:
+			rules = prefetch = MtimePrefetch(rules, base)
+
+		dirty_args = _dirty_args(deps=self, base=base, builder_path=builder_path, build_dependency=build_dependency, prefetch=prefetch)
+		try:
+			for rule in rules:
+				d = rule.is_dirty(dirty_args)
+				if d:
+					_log.trace('DIRTY: %s (from rule %r)', self.path, rule)
+					return True
+		finally:
+			if prefetch is not None:
+				prefetch.close()
 		_log.trace('is_dirty: %s returning %r', self.path, False)
 		return False
 	
@@ -196,12 +570,226 @@ class Dependencies(object):
 
 	@classmethod
 	def init_file(cls, f):
-		f.write('version: %s\n' % (cls.FORMAT_VERSION,))
+		f.write('version: %s\n' % (cls.BASE_FORMAT_VERSION,))
 		RunId.current().append_to(f)
 	
 	def __repr__(self):
 		return 'Dependencies<runid=%r, checksum=%s, %r>' % (self.runid, self.checksum, self.rules)
 
+class BinaryDeps(object):
+	'''
+	The encoding cached for each deps file (see Dependencies), which
+	follows a `cache: <sig>` line identifying the deps file it was made from:
+
+		header:   flags, runid, checksum, string count, record count (u32)
+		stats:    wall, cpu, maxrss, critical (u32, only present with HAS_STATS)
+		records:  kind (u8), flags (u8), path (u32), checksum (u32), mtime (i64)
+		strings:  end offset of each string (u32), followed by their contents
+
+	Paths, run ids and checksums are indexes into the string table,
+	and are only decoded when used. Records are likewise decoded
+	as they're iterated, so a dirty check which stops at the first
+	dirty dependency doesn't decode the rest.
+	Hex checksums are stored as raw bytes (prefixed by the algorithm
+	and a NUL byte, for tagged checksums).
+	'''
+	HEADER = struct.Struct('<5I')
+	STATS = struct.Struct('<4I')
+	RECORD = struct.Struct('<BBxxIIq')
+
+	# header flags
+	CLOBBERS = 1
+	HAS_RUNID = 2
+	# (shared with record flags)
+	HAS_CHECKSUM = 4
+	HEX_CHECKSUM = 8
+	TAGGED_CHECKSUM = 32
+	HAS_STATS = 64
+	# record flags
+	HAS_MTIME = 16
+
+	FILE = 1
+	BUILDER = 2
+	ALWAYS = 3
+	BUILT = 4
+	CONTENT = 5
+
+	_hex = re.compile(r'^(?:([a-z0-9_]+):)?((?:[0-9a-f]{2})+)$')
+
+	def __init__(self, data):
+		self.data = data
+		self.offset = data.index(b'\n') + 1
+		self.flags, self.runid, self.checksum, num_strings, self.num_records = \
+			self.HEADER.unpack_from(data, self.offset)
+		self.records_offset = self.offset + self.HEADER.size
+		self.stats = None
+		if self.flags & self.HAS_STATS:
+			self.stats = BuildStats(*self.STATS.unpack_from(data, self.records_offset))
+			self.records_offset += self.STATS.size
+		offsets_start = self.records_offset + self.num_records * self.RECORD.size
+		self.string_offsets = struct.unpack_from('<%dI' % num_strings, data, offsets_start)
+		self.strings_offset = offsets_start + 4 * num_strings
+		if self.strings_offset + (self.string_offsets[-1] if num_strings else 0) != len(data):
+			raise ValueError("Invalid file (length mismatch)")
+		self.strings = [None] * num_strings
+
+	@staticmethod
+	def _sig_line(sig):
+		return ('cache: %s\n' % (' '.join(map(str, sig)),)).encode('ascii')
+
+	@classmethod
+	def of_file(cls, data, sig):
+		'''
+		The cached encoding in `data`, or None if it's not for the deps file `sig`
+		'''
+		line = cls._sig_line(sig)
+		if not data.startswith(line):
+			return None
+		return cls(data)
+
+	def _bytes(self, i):
+		start = self.string_offsets[i - 1] if i > 0 else 0
+		return self.data[self.strings_offset + start : self.strings_offset + self.string_offsets[i]]
+
+	def string(self, i):
+		rv = self.strings[i]
+		if rv is None:
+			rv = self.strings[i] = self._bytes(i).decode('utf-8')
+		return rv
+
+	def checksum_string(self, i, flags):
+		if flags & self.HEX_CHECKSUM:
+			b = self._bytes(i)
+			prefix = ''
+			if flags & self.TAGGED_CHECKSUM:
+				tag, b = b.split(b'\0', 1)
+				prefix = tag.decode('ascii') + ':'
+			return prefix + binascii.hexlify(b).decode('ascii')
+		return self.string(i)
+
+	def record(self, n):
+		kind, flags, path, checksum, mtime = self.RECORD.unpack_from(self.data, self.records_offset + n * self.RECORD.size)
+		if kind == self.ALWAYS:
+			return AlwaysRebuild()
+		if kind == self.BUILT:
+			return BuildTime(mtime)
+		if kind == self.FILE:
+			cls = FileDependency
+		elif kind == self.BUILDER:
+			cls = BuilderDependency
+		elif kind == self.CONTENT:
+			cls = ContentDependency
+		else:
+			raise ValueError("unknown dependency kind: %r" % (kind,))
+		return cls(
+			mtime if flags & self.HAS_MTIME else None,
+			self.checksum_string(checksum, flags) if flags & self.HAS_CHECKSUM else None,
+			self.string(path))
+
+	def load_into(self, deps):
+		if self.flags & self.HAS_RUNID:
+			deps.runid = RunId(self.string(self.runid))
+		if self.flags & self.HAS_CHECKSUM:
+			deps.checksum = self.checksum_string(self.checksum, self.flags)
+		deps.clobbers = bool(self.flags & self.CLOBBERS)
+		deps.stats = self.stats
+		deps.rules = BinaryRules(self)
+
+	@classmethod
+	def encode(cls, deps, sig):
+		strings = []
+		indexes = {}
+		def add_string(b):
+			try:
+				return indexes[b]
+			except KeyError:
+				strings.append(b)
+				i = indexes[b] = len(strings) - 1
+				return i
+
+		def add_checksum(value):
+			match = cls._hex.match(value)
+			if match is None:
+				return add_string(value.encode('utf-8')), cls.HAS_CHECKSUM
+			tag, digest = match.groups()
+			digest = binascii.unhexlify(digest)
+			if tag is None:
+				return add_string(digest), cls.HAS_CHECKSUM | cls.HEX_CHECKSUM
+			return add_string(tag.encode('ascii') + b'\0' + digest), cls.HAS_CHECKSUM | cls.HEX_CHECKSUM | cls.TAGGED_CHECKSUM
+
+		flags = runid = checksum = 0
+		if deps.clobbers:
+			flags |= cls.CLOBBERS
+		if deps.runid is not None:
+			flags |= cls.HAS_RUNID
+			runid = add_string(deps.runid.value.encode('utf-8'))
+		if deps.checksum is not None:
+			checksum, checksum_flags = add_checksum(deps.checksum)
+			flags |= checksum_flags
+		stats = b''
+		if deps.stats is not None:
+			flags |= cls.HAS_STATS
+			stats = cls.STATS.pack(*deps.stats.values)
+
+		records = []
+		for rule in deps.rules:
+			path = cs = mtime = rule_flags = 0
+			if isinstance(rule, AlwaysRebuild):
+				kind = cls.ALWAYS
+			elif isinstance(rule, BuildTime):
+				kind = cls.BUILT
+				mtime = rule.value
+			else:
+				assert isinstance(rule, BaseFileDependency), "Unknown dependency: %r" % (rule,)
+				if isinstance(rule, BuilderDependency):
+					kind = cls.BUILDER
+				elif isinstance(rule, ContentDependency):
+					kind = cls.CONTENT
+				else:
+					kind = cls.FILE
+				path = add_string(rule.path.encode('utf-8'))
+				if rule.mtime is not None:
+					rule_flags |= cls.HAS_MTIME
+					mtime = rule.mtime
+				if rule.checksum is not None:
+					cs, checksum_flags = add_checksum(rule.checksum)
+					rule_flags |= checksum_flags
+			records.append(cls.RECORD.pack(kind, rule_flags, path, cs, mtime))
+
+		offsets = []
+		end = 0
+		for b in strings:
+			end += len(b)
+			offsets.append(end)
+
+		return b''.join([
+			cls._sig_line(sig),
+			cls.HEADER.pack(flags, runid, checksum, len(strings), len(records)),
+			stats,
+			b''.join(records),
+			struct.pack('<%dI' % len(offsets), *offsets),
+		] + strings)
+
+class BinaryRules(object):
+	'''
+	The (lazily decoded) rules of a BinaryDeps file
+	'''
+	def __init__(self, deps):
+		self.deps = deps
+		self.decoded = []
+
+	def __len__(self):
+		return self.deps.num_records
+
+	def __iter__(self):
+		for i in range(self.deps.num_records):
+			if i == len(self.decoded):
+				self.decoded.append(self.deps.record(i))
+			yield self.decoded[i]
+
+	def __repr__(self):
+		return repr(list(self))
+
 class Dependency(object):
 	recursive = False
 
@@ -215,11 +803,15 @@ class Dependency(object):
 		_log.trace("parsing line: %s" % (line,))
 		for candidate in [
 				FileDependency,
+				ContentDependency,
 				BuilderDependency,
 				AlwaysRebuild,
 				Checksum,
 				RunId,
 				ClobbersTarget,
+				BuildStats,
+				WaitTime,
+				CriticalPath,
 				BuildTime]:
 			if line.startswith(candidate.tag):
 				cls = candidate
@@ -295,8 +887,8 @@ class BaseFileDependency(Dependency):
 		if os.path.isabs(self.path): return self.path
 		return os.path.normpath(os.path.join(base, self.path))
 
-	def mtime_mismatch(self, path):
-		current_mtime = get_mtime(path)
+	def mtime_mismatch(self, path, args):
+		current_mtime = args.get_mtime(path)
 		if current_mtime != self.mtime:
 			_log.debug("DIRTY: %s (stored mtime is %r, current is %r)" % (self.path, self.mtime, current_mtime))
 			return True
@@ -317,7 +909,7 @@ class FileDependency(BaseFileDependency):
 		path = self.full_path(base)
 
 		def is_dirty_mtime():
-			return self.mtime_mismatch(path)
+			return self.mtime_mismatch(path, args)
 
 		built, mtime_dirty = dirty_check_with_dep(path, is_dirty_mtime, args)
 
@@ -341,6 +933,49 @@ class FileDependency(BaseFileDependency):
 		else:
 			return False
 
+class ContentDependency(BaseFileDependency):
+	'''
+	A source file recorded along with a checksum of its contents
+	(see `--hash-sources`). A changed mtime only makes it dirty if
+	its contents have changed too, otherwise the stored mtime is updated.
+	'''
+	tag = 'content:'
+	recursive = True
+
+	def __init__(self, mtime, checksum, path):
+		self.path = path
+		self.checksum = checksum
+		self.mtime = mtime
+
+	@classmethod
+	def of_file(cls, target, mtime, path):
+		rv = cls.relative_to_target(target, mtime=mtime, path=path)
+		rv.checksum = Checksum.from_file(path).value
+		return rv
+
+	def is_dirty(self, args):
+		path = self.full_path(args.base)
+
+		def is_dirty_contents():
+			current_mtime = args.get_mtime(path)
+			if current_mtime == self.mtime:
+				return False
+			if current_mtime is None or not os.path.isfile(path):
+				_log.debug("DIRTY: %s (no longer a file)", self.path)
+				return True
+			# use the stored algorithm, in case the default has since changed
+			checksum = Checksum.from_file(path, Checksum.algorithm_of(self.checksum)).value
+			if checksum != self.checksum:
+				_log.debug("DIRTY: %s (stored checksum is %s, current is %s)", self.path, self.checksum, checksum)
+				return True
+			_log.trace("%s: mtime changed but contents are unchanged", self.path)
+			self.mtime = current_mtime
+			args.deps.refreshed = True
+			return False
+
+		_built, dirty = dirty_check_with_dep(path, is_dirty_contents, args)
+		return dirty
+
 class BuilderDependency(BaseFileDependency):
 	tag = 'builder:'
 	recursive = False
@@ -369,39 +1004,230 @@ class BuilderDependency(BaseFileDependency):
 			_log.debug("DIRTY: builder changed from %s -> %s" % (self.path, builder_path))
 			return True
 
-		return self.mtime_mismatch(self.full_path(args.base))
+		return self.mtime_mismatch(self.full_path(args.base), args)
 
 class Checksum(Dependency):
 	tag = 'checksum:'
 	num_fields = 1
 
+	# checksums without an `algorithm:` prefix (as
+	# written by older versions) use this algorithm
+	UNTAGGED_ALGORITHM = 'sha1'
+
+	BUFFER_SIZE = 256 * 1024
+	MMAP_THRESHOLD = 4 * 1024 * 1024
+
 	def __init__(self, cs):
 		self.value = cs
 		self.fields = [cs]
-	
-	@staticmethod
-	def _add_file(sh, f):
-		if sh is None:
-			import hashlib
-			sh = hashlib.sha1()
-		while True:
-			b = f.read(4096)
-			if not b: break
-			sh.update(b)
+
+	@classmethod
+	def algorithm_of(cls, value):
+		if ':' in value:
+			return value.split(':', 1)[0]
+		return cls.UNTAGGED_ALGORITHM
+
+	@classmethod
+	def check_algorithm(cls, algorithm):
+		'''
+		Raises SafeError if `algorithm` can't be used
+		'''
+		cls._new(algorithm)
+
+	@classmethod
+	def _new(cls, algorithm):
+		import hashlib
+		try:
+			sh = hashlib.new(algorithm)
+		except ValueError:
+			sh = None
+		if sh is None or not sh.digest_size or ':' in algorithm:
+			# variable-length digests (shake_*) aren't supported
+			raise SafeError("Unsupported checksum algorithm: %s" % (algorithm,))
 		return sh
 
+	@classmethod
+	def _value(cls, algorithm, sh):
+		if algorithm == cls.UNTAGGED_ALGORITHM:
+			return sh.hexdigest()
+		return '%s:%s' % (algorithm, sh.hexdigest())
+
+	@classmethod
+	def _add_stream(cls, sh, f):
+		buf = bytearray(cls.BUFFER_SIZE)
+		view = memoryview(buf)
+		while True:
+			n = f.readinto(buf)
+			if not n: break
+			sh.update(view[:n])
+
+	@classmethod
+	def _add_file(cls, sh, f):
+		if os.fstat(f.fileno()).st_size >= cls.MMAP_THRESHOLD:
+			import mmap
+			try:
+				contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (ValueError, EnvironmentError) as e:
+				_log.trace("Can't mmap %s: %s", f.name, e)
+			else:
+				with contents:
+					sh.update(contents)
+				return
+		cls._add_stream(sh, f)
+
 	@classmethod
 	def from_stream(cls, f):
-		sh = cls._add_file(None, f)
-		return cls(sh.hexdigest())
-	
+		algorithm = checksum_algorithm()
+		sh = cls._new(algorithm)
+		cls._add_stream(sh, f)
+		return cls(cls._value(algorithm, sh))
+
 	@classmethod
-	def from_files(cls, filenames):
-		sh = None
-		for filename in filenames:
+	def from_file(cls, filename, algorithm=None):
+		if algorithm is None:
+			algorithm = checksum_algorithm()
+		st = os.stat(filename)
+		value = _hash_cache.lookup(st, algorithm)
+		if value is None:
+			sh = cls._new(algorithm)
 			with open(filename, 'rb') as f:
-				sh = cls._add_file(sh, f)
-		return cls(sh.hexdigest())
+				cls._add_file(sh, f)
+			value = cls._value(algorithm, sh)
+			_hash_cache.store(filename, st, value)
+		return cls(value)
+
+	@classmethod
+	def from_files(cls, filenames, algorithm=None):
+		if len(filenames) == 1:
+			return cls.from_file(filenames[0], algorithm)
+
+		if algorithm is None:
+			algorithm = checksum_algorithm()
+		if algorithm == cls.UNTAGGED_ALGORITHM:
+			# the hash of their concatenated contents,
+			# as in older versions and the OCaml implementation
+			sh = cls._new(algorithm)
+			for filename in filenames:
+				with open(filename, 'rb') as f:
+					cls._add_file(sh, f)
+			return cls(cls._value(algorithm, sh))
+
+		# tagged checksums are only written by this implementation, so
+		# hash each file independently (using the hash cache), then
+		# combine them in the order given
+		values = list(_shared_pool.get().map(lambda filename: cls.from_file(filename, algorithm).value, filenames))
+		sh = cls._new(algorithm)
+		for value in values:
+			sh.update(value.encode('ascii') + b'\n')
+		return cls(cls._value(algorithm, sh))
+
+class _HashJournal(CacheJournal):
+	'''
+	One shard of a HashCache. Values are the (undecoded) fields
+	following the key: size, mtime_ns, ctime_ns and checksum.
+	'''
+	def __init__(self, path, max_records):
+		super(_HashJournal, self).__init__(path)
+		self.MAX_RECORDS = max_records
+		self.modified = {}
+		# the position of each persisted key, oldest first
+		self.ages = None
+
+	def get(self, key):
+		value = self.modified.get(key, None)
+		if value is None:
+			persisted = self._load()
+			value = persisted.get(key, None)
+			if value is not None:
+				if self.ages is None:
+					self.ages = dict((key, i) for i, key in enumerate(persisted))
+				if self.ages.get(key, len(self.ages)) < len(self.ages) // 2:
+					# rewrite entries which are used, so that
+					# they're not the first to be evicted
+					self.modified[key] = value
+		return value
+
+	def _encode(self, key, value):
+		return '%s\t%s' % (key, value)
+
+	def _decode(self, line):
+		if line.count('\t') != 4:
+			return None
+		return tuple(line.split('\t', 1))
+
+	def save(self):
+		if not self.modified:
+			return
+		records = list(self.modified.items())
+		self.modified = {}
+		self._append(records)
+
+class HashCache(object):
+	'''
+	Checksums of files, keyed by (device, inode) and valid while
+	the file's (size, mtime_ns, ctime_ns) are unchanged.
+
+	Records are split between SHARDS journals by inode, each of which
+	is only loaded when one of its files is looked up. Each keeps
+	its most recently used (MAX_RECORDS / SHARDS) records.
+	'''
+	SHARDS = 16
+	MAX_RECORDS = 50000
+
+	def __init__(self, path):
+		self.path = path
+		self.shards = {}
+		# Checksum.from_files hashes files concurrently
+		self.lock = threading.Lock()
+
+	def _shard(self, st):
+		i = st.st_ino % self.SHARDS
+		shard = self.shards.get(i, None)
+		if shard is None:
+			shard = self.shards[i] = _HashJournal('%s-%x' % (self.path, i), self.MAX_RECORDS // self.SHARDS)
+		return shard
+
+	@staticmethod
+	def _key(st):
+		return '%d:%d' % (st.st_dev, st.st_ino)
+
+	@staticmethod
+	def _sig(st):
+		return '%d\t%d\t%d\t' % (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+	def lookup(self, st, algorithm):
+		key = self._key(st)
+		with self.lock:
+			cached = self._shard(st).get(key)
+		sig = self._sig(st)
+		if cached is not None and cached.startswith(sig):
+			value = cached[len(sig):]
+			if Checksum.algorithm_of(value) == algorithm:
+				_log.trace("hash cache hit for %s", key)
+				return value
+		return None
+
+	def store(self, path, st, value):
+		# A change to a file with an old mtime sets a new one, so only the
+		# mtime needs to be older than the racy window (the ctime is still
+		# compared, but e.g. `touch -d` leaves it recent)
+		if CacheJournal.is_racy(st.st_mtime_ns) or '\t' in value:
+			return
+		try:
+			if self._sig(os.stat(path)) != self._sig(st):
+				# modified while we were reading it
+				return
+		except OSError:
+			return
+		with self.lock:
+			self._shard(st).modified[self._key(st)] = self._sig(st) + value
+
+	def save(self):
+		for shard in list(self.shards.values()):
+			shard.save()
+
+_hash_cache = HashCache(os.path.join(ROOT_CWD, META_DIR, 'hashes'))
+register_cache(_hash_cache)
 
 class BuildTime(Dependency):
 	tag = 'built:'
@@ -431,6 +1257,68 @@ class BuildTime(Dependency):
 			return True
 		return False
 
+ResourceUsage = collections.namedtuple('ResourceUsage', 'wall cpu maxrss')
+ResourceUsage.__doc__ = '''
+Measured for each build script: wall and cpu are in seconds, maxrss in KiB.
+'''
+
+def critical_path(state):
+	'''
+	The length (ms) of the longest chain of builds ending in the target of
+	`state` (a TargetState), as of its last build. i.e. how long it would take
+	to build from scratch with unlimited parallelism. Zero for unknown targets
+	and plain files.
+	'''
+	stats = state.stats()
+	return 0 if stats is None else stats.critical
+
+class BuildStats(Dependency):
+	'''
+	Resources used by the last build: wall and cpu
+	time (ms), max RSS (KiB) and critical path (ms).
+	'''
+	tag = 'stats:'
+	num_fields = 4
+
+	def __init__(self, wall, cpu, maxrss, critical):
+		self.values = (wall, cpu, maxrss, critical)
+		self.wall, self.cpu, self.maxrss, self.critical = self.values
+		self.fields = [str(value) for value in self.values]
+
+	@classmethod
+	def deserialize(cls, *fields):
+		return cls(*map(int, fields))
+
+class WaitTime(Dependency):
+	'''
+	Time (ms) spent by a build script waiting on a nested `gup` invocation
+	'''
+	tag = 'waited:'
+	num_fields = 1
+
+	def __init__(self, value):
+		self.value = value
+		self.fields = [str(value)]
+
+	@classmethod
+	def deserialize(cls, value):
+		return cls(int(value))
+
+class CriticalPath(Dependency):
+	'''
+	The critical path (ms) of a target built by a build script
+	'''
+	tag = 'critical:'
+	num_fields = 1
+
+	def __init__(self, value):
+		self.value = value
+		self.fields = [str(value)]
+
+	@classmethod
+	def deserialize(cls, value):
+		return cls(int(value))
+
 class RunId(Dependency):
 	tag = 'run:'
 	num_fields = 1
@@ -0,0 +1,119 @@
+'''
+Counters for the end-of-build summary (`gup --summary`).
+
+Each gup process counts what it does, and appends its totals to the file
+named by $GUP_SUMMARY (as a line of JSON) when it saves its caches. The
+process which was given --summary reads them all back once the build
+is complete.
+'''
+import os
+import json
+import threading
+import collections
+
+from .var import summary_path
+
+def _cpu_time():
+	times = os.times()
+	return times.user + times.system
+
+class BuildSummary(object):
+	def __init__(self):
+		self.counts = collections.Counter()
+		# counts are also updated by pool threads (e.g. lstats while prefetching)
+		self.lock = threading.Lock()
+		# (path, wall, own) seconds, for each target built
+		self.targets = []
+		self.builders = 0.0
+		self.cpu = 0.0
+		self.pids = set()
+		# CPU time already reported by this process
+		self.cpu_saved = 0.0
+
+	def _clear(self):
+		self.counts = collections.Counter()
+		self.targets = []
+		self.builders = 0.0
+
+	def after_fork(self):
+		self._clear()
+		self.lock = threading.Lock()
+		# CPU times are also reset by fork
+		self.cpu_saved = 0.0
+
+	def save(self):
+		path = summary_path()
+		if path is None:
+			return
+		cpu = _cpu_time()
+		record = {
+			'pid': os.getpid(),
+			'counts': self.counts,
+			'targets': self.targets,
+			'builders': self.builders,
+			'cpu': cpu - self.cpu_saved,
+		}
+		self._clear()
+		self.cpu_saved = cpu
+		try:
+			fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+		except OSError:
+			# the build is over (e.g. a leftover speculative job)
+			return
+		try:
+			os.write(fd, (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+		finally:
+			os.close(fd)
+
+	@classmethod
+	def load(cls, path):
+		'''
+		Returns the totals recorded by every process.
+		'''
+		total = cls()
+		with open(path) as f:
+			for line in f.read().splitlines():
+				record = json.loads(line)
+				total.counts.update(record['counts'])
+				total.targets.extend(record['targets'])
+				total.builders += record['builders']
+				total.cpu += record['cpu']
+				total.pids.add(record['pid'])
+		return total
+
+	def report(self, log, num_targets):
+		counts = self.counts
+		log("%d targets checked, %d up to date, %d built",
+			counts['checked'], counts['clean'], counts['built'])
+		log("build scripts took %.2fs, gup used %.2fs CPU in %d processes",
+			self.builders, self.cpu, len(self.pids))
+		log("read %d deps files and %d Gupfiles, %d lstat calls, %d locks acquired",
+			counts['deps_read'], counts['gupfiles_parsed'], counts['lstat'], counts['locks'])
+		if counts['cache_hits'] or counts['cache_misses']:
+			log("output cache: %d restored, %d missed, %d stored",
+				counts['cache_hits'], counts['cache_misses'], counts['cache_stores'])
+		slowest = sorted(self.targets, key=lambda target: target[2], reverse=True)[:num_targets]
+		if slowest:
+			log("slowest targets:")
+		for path, wall, own in slowest:
+			log("  %6.2fs  %s (%.2fs including dependencies)", own, os.path.relpath(path), wall)
+
+_summary = BuildSummary()
+
+if hasattr(os, 'register_at_fork'):
+	# a forked child reports only its own work
+	os.register_at_fork(after_in_child=_summary.after_fork)
+
+def summary_count(name, n=1):
+	with _summary.lock:
+		_summary.counts[name] += n
+
+def summary_target(path, wall, own):
+	_summary.targets.append((path, wall, own))
+	_summary.builders += own
+
+def summary_journal():
+	'''
+	The current process' summary (which has a `save` method, like caches)
+	'''
+	return _summary
@@ -2,12 +2,14 @@ from __future__ import print_function
 import os
 import errno
 from .builder import prepare_build
+from .gupfile import save_caches
 from .log import getLogger
 from .util import get_mtime
-from .state import FileDependency, TargetState
+from .state import FileDependency, ContentDependency, CriticalPath, TargetState, critical_path, flush_dependencies
 from .error import Unbuildable, TargetFailed, SafeError
 from .path import traverse_from
-from .var import IS_ROOT
+from .var import is_root, hash_sources
+from .selfprofile import set_profile_label
 
 _log = getLogger(__name__)
 
@@ -20,6 +22,7 @@ class Task(object):
 		self.target_path = target_path
 		self.opts = opts
 		self.parent_target = parent_target
+		self.pid = os.getpid()
 	
 	def prepare(self):
 		'''
@@ -63,19 +66,34 @@ class Task(object):
 		'''
 		self.built = self.target.build_or_update(update=self.opts.update)
 		self.complete()
+		if os.getpid() != self.pid:
+			# running in a job process, which exits without returning to main()
+			flush_dependencies()
+			set_profile_label(self.target.path)
+		save_caches()
 
 	def complete(self):
 		if self.parent_target is not None:
 			intermediate_paths, target_path = traverse_from(os.getcwd(), self.target_path)
 			mtime = get_mtime(target_path)
 
+			critical = None
 			if self.target:
+				stats = self.target.state.stats()
+				# reuses the deps just loaded by stats()
 				dep = FileDependency.of_target(self.parent_target, self.target, mtime=mtime)
+				if stats is not None:
+					critical = CriticalPath(stats.critical)
+			elif hash_sources() and os.path.isfile(target_path):
+				dep = ContentDependency.of_file(self.parent_target, mtime=mtime, path=target_path)
 			else:
 				dep = FileDependency.relative_to_target(self.parent_target, mtime=mtime, path=self.target_path)
 
 			state = TargetState(self.parent_target)
 			state.add_dependency(dep)
+			if critical is not None:
+				# so the parent needn't load our deps to compute its own
+				state.add_dependency(critical)
 			if intermediate_paths or True:
 				_log.trace("adding intermediate paths: %r", intermediate_paths)
 				for intermediate in intermediate_paths:
@@ -96,7 +114,7 @@ class Task(object):
 			raise RuntimeError("unknown error in child process - exit status %s" % rv)
 
 	def report_nobuild(self):
-		if IS_ROOT:
+		if is_root():
 			_log.info("%s: up to date", self.target_path)
 		else:
 			_log.trace("%s: up to date", self.target_path)
@@ -110,7 +128,11 @@ class TaskRunner(object):
 		self.tasks.append(fn)
 
 	def run(self):
-		from .parallel import start_job, wait_all
+		from .parallel import start_job, wait_all, is_parallel
+		if is_parallel() and len(self.tasks) > 1:
+			# start the longest chains of builds first
+			self.tasks.sort(key=lambda task: critical_path(task.target.state), reverse=True)
+			_log.trace("scheduled tasks: %r", [task.target_path for task in self.tasks])
 		while self.tasks:
 			task = self.tasks.pop(0)
 			start_job(task.build, task.handle_result)
@@ -0,0 +1,110 @@
+'''
+A timeline of what each gup process is doing (with --profile-json), in
+the Chrome trace event format. Every process in the build appends its
+events to the same file, which can be loaded into chrome://tracing or
+https://ui.perfetto.dev (each gup process is shown as a separate thread).
+'''
+import os
+import json
+import time
+
+from .var import ROOT_CWD, profile_json
+
+# the (fake) process id shared by all events
+_PID = 1
+
+class Timeline(object):
+	def __init__(self):
+		self.path = None
+		self.fd = None
+		# the process which last described itself (forked children must do so again)
+		self.named_pid = None
+
+	def _open(self, path, flags):
+		if self.fd is not None:
+			os.close(self.fd)
+		self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | flags, 0o666)
+		self.path = path
+
+	def _write(self, text):
+		# O_APPEND writes of a single line don't interleave with other processes
+		os.write(self.fd, text.encode('utf-8'))
+
+	def _encode(self, event):
+		event['pid'] = _PID
+		event['tid'] = os.getpid()
+		return json.dumps(event, separators=(',', ':'))
+
+	def start(self, path):
+		self._open(path, os.O_TRUNC)
+		self._write('[\n')
+
+	def finish(self):
+		# (the closing bracket is optional, but makes it valid JSON)
+		self._write(self._encode({'name': 'process_name', 'ph': 'M', 'args': {'name': 'gup'}}) + '\n]\n')
+		os.close(self.fd)
+		self.fd = self.path = None
+
+	def emit(self, event):
+		path = profile_json()
+		if path != self.path:
+			self._open(path, 0)
+		if self.named_pid != os.getpid():
+			self.named_pid = os.getpid()
+			self._write(self._encode({'name': 'thread_name', 'ph': 'M', 'args': {'name': _process_name()}}) + ',\n')
+		self._write(self._encode(event) + ',\n')
+
+def _process_name():
+	name = 'gup [%d]' % (os.getpid(),)
+	parent = os.environ.get('GUP_TARGET', None)
+	if parent is not None:
+		name += ' for %s' % (os.path.relpath(parent, ROOT_CWD),)
+	return name
+
+def _us(seconds):
+	return int(seconds * 1000000)
+
+class _Span(object):
+	def __init__(self, name, cat, args):
+		self.name = name
+		self.cat = cat
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.time()
+
+	def __exit__(self, type, value, traceback):
+		end = time.time()
+		event = {'name': self.name, 'cat': self.cat, 'ph': 'X', 'ts': _us(self.start), 'dur': _us(end - self.start)}
+		if type is not None:
+			self.args['error'] = type.__name__
+		if self.args:
+			event['args'] = self.args
+		try:
+			_timeline.emit(event)
+		except OSError:
+			pass # don't fail the build over a profile
+
+class _NoSpan(object):
+	def __enter__(self): pass
+	def __exit__(self, type, value, traceback): pass
+
+_no_span = _NoSpan()
+_timeline = Timeline()
+
+def timeline_span(name, cat, target=None, **args):
+	'''
+	A context manager which records its duration, when --profile-json
+	is in use. `target` (a path) is appended to the event name.
+	'''
+	if profile_json() is None:
+		return _no_span
+	if target is not None:
+		name += ' ' + os.path.relpath(target, ROOT_CWD)
+	return _Span(name, cat, args)
+
+def start_timeline(path):
+	_timeline.start(path)
+
+def finish_timeline():
+	_timeline.finish()
@@ -3,6 +3,7 @@ import errno
 import logging
 from .log import getLogger
 from .var import IS_WINDOWS
+from .summary import summary_count
 
 __all__ = ['mkdirp', 'get_mtime', 'try_remove', 'samefile', 'rename', 'rmtree', 'lisdir']
 
@@ -17,6 +18,7 @@ def get_mtime(path):
 	Note: we return a microsecond int as this serializes to / from strings better
 	'''
 	try:
+		summary_count('lstat')
 		return int(os.lstat(path).st_mtime * (10 ** 3))
 	except OSError as e:
 		if e.errno == errno.ENOENT:
@@ -4,8 +4,7 @@ import time
 
 IS_WINDOWS = sys.platform.startswith('win')
 
-INDENT = os.environ.get('GUP_INDENT', '')
-os.environ['GUP_INDENT'] = INDENT + '  '
+META_DIR = '.gup'
 
 def init_root(is_root):
 	global IS_ROOT, ROOT_CWD, RUN_ID
@@ -18,15 +17,39 @@ def init_root(is_root):
 		assert 'GUP_RUNID' in os.environ, "GUP_ROOT is set (to %s), but not GUP_RUNID" % (ROOT_CWD)
 		RUN_ID = os.environ['GUP_RUNID']
 
-init_root('GUP_ROOT' not in os.environ)
+def init_env():
+	'''
+	Load per-process settings from the environment.
+
+	This happens once at startup, and again whenever a forked
+	coordinator worker takes over the environment of a nested invocation.
+	'''
+	global INDENT, XTRACE, DEFAULT_VERBOSITY
+	INDENT = os.environ.get('GUP_INDENT', '')
+	os.environ['GUP_INDENT'] = INDENT + '  '
+	init_root('GUP_ROOT' not in os.environ)
+	XTRACE = os.environ.get('GUP_XTRACE', '0') == '1'
+	DEFAULT_VERBOSITY = int(os.environ.get('GUP_VERBOSE', '0'))
+
+init_env()
+
+def indent():
+	return INDENT
+
+def is_root():
+	return IS_ROOT
+
+def xtrace():
+	return XTRACE
 
-XTRACE = os.environ.get('GUP_XTRACE', '0') == '1'
 def set_trace():
 	global XTRACE
 	XTRACE = True
 	os.environ['GUP_XTRACE'] = '1'
 
-DEFAULT_VERBOSITY = int(os.environ.get('GUP_VERBOSE', '0'))
+def default_verbosity():
+	return DEFAULT_VERBOSITY
+
 def set_verbosity(val):
 	os.environ['GUP_VERBOSE'] = str(val)
 
@@ -35,3 +58,58 @@ def set_keep_failed_outputs():
 
 def keep_failed_outputs():
 	return os.environ.get('GUP_KEEP_FAILED', '0') == '1'
+
+def set_checksum_algorithm(name):
+	os.environ['GUP_CHECKSUM'] = name
+
+def checksum_algorithm():
+	return os.environ.get('GUP_CHECKSUM', 'sha1')
+
+def set_hash_sources():
+	os.environ['GUP_HASH_SOURCES'] = '1'
+
+def hash_sources():
+	return os.environ.get('GUP_HASH_SOURCES', '0') == '1'
+
+def set_speculate():
+	os.environ['GUP_SPECULATE'] = '1'
+
+def speculate():
+	return os.environ.get('GUP_SPECULATE', '0') == '1'
+
+def set_profile_json(path):
+	os.environ['GUP_PROFILE_JSON'] = os.path.abspath(path)
+
+def profile_json():
+	return os.environ.get('GUP_PROFILE_JSON', None)
+
+def set_summary_path(path):
+	os.environ['GUP_SUMMARY'] = path
+
+def summary_path():
+	return os.environ.get('GUP_SUMMARY', None)
+
+def profile_dir():
+	return os.environ.get('GUP_PROFILE', None) or None
+
+def set_cache_dir(path):
+	os.environ['GUP_CACHE'] = os.path.abspath(path)
+
+def cache_dir():
+	return os.environ.get('GUP_CACHE', None) or None
+
+def cache_size():
+	return os.environ.get('GUP_CACHE_SIZE', None) or None
+
+def set_remote_cache_url(url):
+	os.environ['GUP_REMOTE_CACHE'] = url
+
+def remote_cache_url():
+	url = os.environ.get('GUP_REMOTE_CACHE', None) or None
+	if url is not None and os.environ.get('GUP_REMOTE_CACHE_DISABLED', None) == url:
+		return None
+	return url
+
+def disable_remote_cache(url):
+	# (for this process and the rest of the build)
+	os.environ['GUP_REMOTE_CACHE_DISABLED'] = url
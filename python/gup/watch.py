@@ -0,0 +1,263 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import subprocess
+
+from .log import getLogger
+from .error import SafeError
+from .state import TargetState, BaseFileDependency, AlwaysRebuild
+from .var import META_DIR
+_log = getLogger(__name__)
+
+class Inotify(object):
+	'''
+	Minimal ctypes binding for linux's inotify.
+	Watches are registered on directories, so that files
+	replaced via rename (as many editors do) are still noticed.
+	'''
+	IN_MODIFY = 0x2
+	IN_ATTRIB = 0x4
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_DELETE_SELF = 0x400
+	IN_MOVE_SELF = 0x800
+	IN_Q_OVERFLOW = 0x4000
+	IN_IGNORED = 0x8000
+	IN_ONLYDIR = 0x1000000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+
+	WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+		| IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+	EVENT = struct.Struct('=iIII')
+
+	def __init__(self):
+		import ctypes, ctypes.util
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+			self._add_watch = libc.inotify_add_watch
+			init = libc.inotify_init1
+		except (OSError, AttributeError):
+			raise SafeError("inotify is not available (linux only)")
+		self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		self._get_errno = ctypes.get_errno
+		self.fd = init(self.IN_CLOEXEC)
+		if self.fd < 0:
+			raise self._error('inotify_init1')
+		self.dirs = {}
+		self.wds = {}
+
+	def _error(self, desc):
+		err = self._get_errno()
+		return OSError(err, "%s: %s" % (desc, os.strerror(err)))
+
+	def close(self):
+		os.close(self.fd)
+
+	def watch(self, dirpath):
+		if dirpath in self.wds:
+			return
+		wd = self._add_watch(self.fd, dirpath.encode(sys.getfilesystemencoding()), self.WATCH_MASK)
+		if wd < 0:
+			err = self._error('inotify_add_watch %s' % (dirpath,))
+			if err.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+				_log.debug("%s", err)
+				return
+			raise err
+		self.dirs[wd] = dirpath
+		self.wds[dirpath] = wd
+
+	def read(self, timeout):
+		'''
+		Returns a list of changed paths (or None, if the event
+		queue overflowed) once any are available, or an empty
+		list after `timeout` seconds.
+		'''
+		events = self.read_events(timeout)
+		if events is None:
+			return None
+		return [path for path, _mask in events]
+
+	def read_events(self, timeout):
+		'''
+		Like `read`, but returns (path, mask) pairs.
+		'''
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return []
+		data = os.read(self.fd, 64 * 1024)
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+			offset += self.EVENT.size
+			name = data[offset:offset+length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+			offset += length
+			if mask & self.IN_Q_OVERFLOW:
+				return None
+			dirpath = self.dirs.get(wd, None)
+			if dirpath is None:
+				continue
+			if mask & self.IN_IGNORED:
+				# watch was removed (directory deleted)
+				del self.dirs[wd]
+				del self.wds[dirpath]
+				continue
+			events.append((os.path.join(dirpath, name) if name else dirpath, mask))
+		return events
+
+class DependencyGraph(object):
+	'''
+	The recorded (transitive) dependencies of a set of targets,
+	loaded from their .gup metadata.
+	'''
+	def __init__(self, targets):
+		self.targets = targets
+		self.dependents = {}
+		self.built = set()
+
+	def load(self):
+		self.dependents = {}
+		self.built = set()
+		seen = set()
+		pending = list(self.targets)
+		while pending:
+			target = pending.pop()
+			if target in seen:
+				continue
+			seen.add(target)
+			deps = TargetState(target).deps()
+			if deps is None:
+				continue
+			self.built.add(target)
+			base = os.path.dirname(target)
+			for rule in deps.rules:
+				if isinstance(rule, AlwaysRebuild):
+					_log.debug("%s is always rebuilt, but will only be rebuilt by --watch when its dependencies change", target)
+				if not isinstance(rule, BaseFileDependency):
+					continue
+				path = rule.full_path(base)
+				self.dependents.setdefault(path, set()).add(target)
+				pending.append(path)
+		_log.trace("loaded %d dependencies of %d targets", len(self.dependents), len(self.built))
+
+	def paths(self):
+		return self.dependents.keys()
+
+	def affected(self, paths):
+		'''
+		Returns the requested targets which (transitively)
+		depend on any of `paths`.
+		'''
+		seen = set()
+		pending = list(paths)
+		while pending:
+			path = pending.pop()
+			if path in seen:
+				continue
+			seen.add(path)
+			pending.extend(self.dependents.get(path, ()))
+		return [target for target in self.targets if target in seen]
+
+class Watcher(object):
+	# wait this long after the last event before rebuilding
+	DEBOUNCE = 0.1
+
+	def __init__(self, targets, build_args):
+		self.targets = [os.path.abspath(target) for target in targets]
+		self.build_args = build_args
+		self.graph = DependencyGraph(self.targets)
+		self.inotify = Inotify()
+
+	def _env(self):
+		# each cycle is a separate root invocation
+		env = os.environ.copy()
+		for key in ('GUP_ROOT', 'GUP_RUNID', 'GUP_INDENT', 'GUP_TARGET'):
+			env.pop(key, None)
+		return env
+
+	def build(self, targets):
+		start = time.time()
+		args = ['gup', '-u'] + self.build_args + [os.path.relpath(target) for target in targets]
+		_log.trace("running %r", args)
+		status = subprocess.call(args, env=self._env())
+		elapsed = time.time() - start
+		self.graph.load()
+		self.update_watches()
+		result = 'built' if status == 0 else 'failed (status %d)' % (status,)
+		_log.info("%s %d target%s in %.2fs (watching %d files)",
+			result, len(targets), '' if len(targets) == 1 else 's', elapsed, len(self.graph.dependents))
+
+	def update_watches(self):
+		start = time.time()
+		dirs = set(os.path.dirname(path) for path in self.graph.paths())
+		for dirpath in dirs:
+			self.inotify.watch(dirpath)
+		_log.trace("updated %d watches in %.3fs", len(dirs), time.time() - start)
+
+	def wait_for_changes(self, changed):
+		'''
+		Blocks until something changes (unless `changed` is nonempty), then
+		returns all changes until DEBOUNCE seconds pass without any more.
+		'''
+		changed = set(changed)
+		timeout = self.DEBOUNCE if changed else None
+		while True:
+			paths = self.inotify.read(timeout)
+			if paths is None:
+				_log.warning("too many changes, rebuilding everything")
+				return None
+			if not paths and timeout is not None:
+				return changed
+			changed.update(path for path in paths if not self._ignored(path))
+			if changed:
+				timeout = self.DEBOUNCE
+
+	def _ignored(self, path):
+		return os.path.basename(os.path.dirname(path)) == META_DIR
+
+	def discard_target_changes(self):
+		'''
+		Drop events caused by the previous build writing its targets
+		(but keep changes made to sources in the meantime).
+		'''
+		while True:
+			paths = self.inotify.read(0)
+			if paths is None:
+				return list(self.targets)
+			if not paths:
+				return []
+			sources = [path for path in paths if path not in self.graph.built and not self._ignored(path)]
+			if sources:
+				return sources
+
+	def run(self):
+		self.build(self.targets)
+		pending = self.discard_target_changes()
+		while True:
+			changed = self.wait_for_changes(pending)
+			pending = []
+			start = time.time()
+			if changed is None:
+				affected = self.targets
+			else:
+				affected = self.graph.affected(changed)
+			_log.trace("%d changes affected %d targets (in %.3fs)", len(changed or []), len(affected), time.time() - start)
+			if affected:
+				self.build(affected)
+				pending = self.discard_target_changes()
+
+def watch(targets, build_args):
+	watcher = Watcher(targets, build_args)
+	try:
+		watcher.run()
+	finally:
+		watcher.inotify.close()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+'''
+Benchmarks gup against synthetic projects of various shapes.
+
+For each scenario, a fresh project is generated and timed for:
+
+ - cold:  building everything (with no .gup metadata)
+ - noop:  rebuilding when nothing has changed
+ - touch: rebuilding after a single source file changes
+ - clean: `gup --clean -f`
+
+with both -j1 and -jN. Results are written as JSON, so that runs from
+different commits can be compared (see --compare).
+
+Usage: test/perf/bench.py [--gup python/bin/gup] [--output results.json]
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import platform
+import tempfile
+import subprocess
+import collections
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(here))
+
+OPERATIONS = ('cold', 'noop', 'touch', 'clean')
+
+# seconds, and peak RSS of any single process (in KB)
+Sample = collections.namedtuple('Sample', 'wall cpu maxrss')
+
+def _script(body):
+	return '#!/bin/sh\nset -eu\n' + body.strip() + '\n'
+
+def _leaf(prefix):
+	# builds `<prefix><n>` from src/<n>
+	return _script('''
+		n=${2##*%s}
+		gup -u "src/$n"
+		cat "src/$n" > "$1"
+	''' % (prefix,))
+
+def _all(targets):
+	return _script('gup -u %s\necho ok > "$1"' % (' '.join(targets),))
+
+def _sources(count):
+	return dict(('src/%d' % (i,), '%d\n' % (i,)) for i in range(count))
+
+class Scenario(object):
+	'''
+	A synthetic project. `files` maps paths to contents, and the
+	`touch` operation modifies src/0.
+	'''
+	def __init__(self, name, params, files):
+		self.name = name
+		self.params = params
+		self.files = files
+
+	def write(self, dest):
+		for path, contents in self.files.items():
+			path = os.path.join(dest, path)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'w') as f:
+				f.write(contents)
+			if contents.startswith('#!'):
+				os.chmod(path, 0o755)
+
+def fanout(width):
+	'''`all` depends directly on `width` leaves'''
+	files = _sources(width)
+	files['all.gup'] = _all(['out/leaf-%d' % (i,) for i in range(width)])
+	files['Gupfile'] = 'leaf.gup:\n\tout/leaf-*\n'
+	files['leaf.gup'] = _leaf('leaf-')
+	return Scenario('fanout', {'width': width}, files)
+
+def chain(depth):
+	'''a chain of `depth` targets, each depending on the next'''
+	files = _sources(1)
+	files['all.gup'] = _all(['out/link-0'])
+	files['Gupfile'] = 'link.gup:\n\tout/link-*\n'
+	files['link.gup'] = _script('''
+		n=${2##*link-}
+		if [ "$n" -lt %d ]; then
+			dep="out/link-$((n + 1))"
+		else
+			dep=src/0
+		fi
+		gup -u "$dep"
+		cat "$dep" > "$1"
+	''' % (depth - 1,))
+	return Scenario('chain', {'depth': depth}, files)
+
+def diamond(width, depth):
+	'''
+	`depth` layers of `width` targets, where each
+	depends on two targets in the next layer
+	'''
+	files = _sources(width)
+	files['all.gup'] = _all(['out/node-0-%d' % (i,) for i in range(width)])
+	files['Gupfile'] = 'node.gup:\n\tout/node-*\n'
+	files['node.gup'] = _script('''
+		name=${2##*node-}
+		layer=${name%%-*}
+		i=${name#*-}
+		if [ "$layer" -lt %(last)d ]; then
+			next=$((layer + 1))
+			deps="out/node-$next-$i out/node-$next-$(( (i + 1) %% %(width)d ))"
+		else
+			deps="src/$i"
+		fi
+		gup -u $deps
+		cat $deps > "$1"
+	''' % {'last': depth - 1, 'width': width})
+	return Scenario('diamond', {'width': width, 'depth': depth}, files)
+
+def gupfile(patterns, targets):
+	'''
+	A Gupfile with `patterns` rules (each for a different builder),
+	and `targets` targets spread across them
+	'''
+	files = _sources(targets)
+	rules = []
+	for i in range(patterns):
+		rules.append('rule-%d.gup:\n\tout/rule-%d-*\n' % (i, i))
+		files['rule-%d.gup' % (i,)] = _leaf('-')
+	files['Gupfile'] = '\n'.join(rules)
+	step = max(1, patterns // targets)
+	files['all.gup'] = _all(['out/rule-%d-%d' % ((patterns - 1 - i * step) % patterns, i) for i in range(targets)])
+	return Scenario('gupfile', {'patterns': patterns, 'targets': targets}, files)
+
+def shadow(depth, width):
+	'''
+	`width` targets nested `depth` directories deep, whose builder is
+	found via the outermost gup/Gupfile (after checking every other
+	possible location)
+	'''
+	files = _sources(width)
+	dir = '/'.join('d%d' % (i,) for i in range(depth))
+	files['all.gup'] = _all(['%s/t%d' % (dir, i) for i in range(width)])
+	files['gup/Gupfile'] = 'target.gup:\n\t%s/t*\n' % (dir,)
+	files['gup/target.gup'] = _leaf('/t')
+	return Scenario('shadow', {'depth': depth, 'width': width}, files)
+
+def scenarios(scale):
+	def n(value):
+		return max(1, int(value * scale))
+	return [
+		fanout(width=n(100)),
+		chain(depth=n(30)),
+		diamond(width=n(8), depth=n(6)),
+		gupfile(patterns=n(300), targets=n(30)),
+		shadow(depth=n(8), width=n(20)),
+	]
+
+class Runner(object):
+	def __init__(self, gup, tempdir):
+		self.gup = os.path.abspath(gup)
+		self.tempdir = tempdir
+		env = os.environ.copy()
+		for key in list(env.keys()):
+			if key == 'MAKEFLAGS' or key.startswith('GUP_'):
+				del env[key]
+		# builders find the same `gup` on $PATH
+		env['PATH'] = os.pathsep.join([os.path.dirname(self.gup), env.get('PATH', '')])
+		self.env = env
+
+	def run(self, cwd, *args):
+		'''
+		Returns a Sample for a single gup invocation.
+		'''
+		with tempfile.TemporaryFile() as output:
+			start = time.time()
+			proc = subprocess.Popen([self.gup] + list(args), cwd=cwd, env=self.env,
+				stdout=output, stderr=subprocess.STDOUT)
+			# unlike getrusage(RUSAGE_CHILDREN), this
+			# only counts this invocation (and its children)
+			_pid, status, usage = os.wait4(proc.pid, 0)
+			wall = time.time() - start
+			proc.returncode = os.waitstatus_to_exitcode(status)
+			if proc.returncode != 0:
+				output.seek(0)
+				raise AssertionError("gup %s failed in %s:\n%s" % (' '.join(args), cwd, output.read().decode('utf-8', 'replace')))
+		maxrss = usage.ru_maxrss
+		if sys.platform == 'darwin':
+			maxrss //= 1024
+		return Sample(wall, usage.ru_utime + usage.ru_stime, maxrss)
+
+	def measure(self, scenario, jobs):
+		'''
+		Returns {operation: Sample} for a freshly generated project.
+		'''
+		dest = tempfile.mkdtemp(prefix=scenario.name + '-', dir=self.tempdir)
+		try:
+			scenario.write(dest)
+			jobs_arg = '-j%d' % (jobs,)
+			times = {}
+			times['cold'] = self.run(dest, jobs_arg, '-u', 'all')
+			times['noop'] = self.run(dest, jobs_arg, '-u', 'all')
+			with open(os.path.join(dest, 'src', '0'), 'a') as f:
+				f.write('touched\n')
+			times['touch'] = self.run(dest, jobs_arg, '-u', 'all')
+			times['clean'] = self.run(dest, '--clean', '-f')
+			return times
+		finally:
+			shutil.rmtree(dest)
+
+def _median(values):
+	values = sorted(values)
+	mid = len(values) // 2
+	if len(values) % 2:
+		return values[mid]
+	return (values[mid - 1] + values[mid]) / 2.0
+
+def _git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root, stderr=subprocess.DEVNULL).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def benchmark(runner, scenarios, job_counts, repeat, log):
+	results = []
+	for scenario in scenarios:
+		for jobs in job_counts:
+			samples = dict((operation, []) for operation in OPERATIONS)
+			for _ in range(repeat):
+				for operation, sample in runner.measure(scenario, jobs).items():
+					samples[operation].append(sample)
+			for operation in OPERATIONS:
+				walls = [sample.wall for sample in samples[operation]]
+				cpus = [sample.cpu for sample in samples[operation]]
+				result = {
+					'scenario': scenario.name,
+					'params': scenario.params,
+					'jobs': jobs,
+					'operation': operation,
+					'wall': walls,
+					'cpu': cpus,
+					'maxrss': max(sample.maxrss for sample in samples[operation]),
+					'min': min(walls),
+					'median': _median(walls),
+				}
+				log("%-8s %-32s -j%-3d %-6s %8.3fs (%.3fs cpu)" % (
+					scenario.name, _describe(scenario.params), jobs, operation, result['min'], _median(cpus)))
+				results.append(result)
+	return results
+
+def _describe(params):
+	return ' '.join('%s=%s' % item for item in sorted(params.items()))
+
+def _key(result):
+	return (result['scenario'], _describe(result['params']), result['jobs'], result['operation'])
+
+def compare(baseline, results, log):
+	'''
+	Log the change in (minimum) wall time since `baseline`.
+	'''
+	previous = dict((_key(result), result) for result in baseline['results'])
+	for result in results:
+		old = previous.get(_key(result), None)
+		if old is None:
+			continue
+		change = (result['min'] - old['min']) / old['min'] * 100 if old['min'] else 0
+		log("%-8s %-32s -j%-3d %-6s %8.3fs -> %8.3fs (%+.1f%%)" % (_key(result) + (old['min'], result['min'], change)))
+
+def main():
+	p = optparse.OptionParser('Usage: %prog [OPTIONS]')
+	p.add_option('--gup', default=os.path.join(root, 'python', 'bin', 'gup'), help='gup executable to benchmark (default %default)')
+	p.add_option('-j', '--jobs', type='int', default=None, help='Job count for parallel runs (default: number of CPUs)')
+	p.add_option('-s', '--scenario', action='append', default=[], help='Only run this scenario (may be repeated)')
+	p.add_option('--scale', type='float', default=1.0, help='Multiply the size of each project by this')
+	p.add_option('-n', '--repeat', type='int', default=3, help='Number of runs of each benchmark (default %default)')
+	p.add_option('-o', '--output', help='Write JSON results to this file (default stdout)')
+	p.add_option('--compare', metavar='FILE', help='Compare results to those in FILE')
+	opts, args = p.parse_args()
+	if args:
+		p.error("unexpected arguments: %r" % (args,))
+
+	def log(line):
+		print(line, file=sys.stderr)
+
+	selected = scenarios(opts.scale)
+	if opts.scenario:
+		names = set(scenario.name for scenario in selected)
+		for name in opts.scenario:
+			if name not in names:
+				p.error("unknown scenario: %s (expected one of %s)" % (name, ', '.join(sorted(names))))
+		selected = [scenario for scenario in selected if scenario.name in opts.scenario]
+
+	jobs = opts.jobs or os.cpu_count() or 1
+	job_counts = [1] if jobs == 1 else [1, jobs]
+
+	tempdir = tempfile.mkdtemp(prefix='gup-bench-')
+	try:
+		results = benchmark(Runner(opts.gup, tempdir), selected, job_counts, opts.repeat, log)
+	finally:
+		shutil.rmtree(tempdir)
+
+	report = {
+		'gup': opts.gup,
+		'commit': _git_commit(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'host': platform.node(),
+		'python': platform.python_version(),
+		'cpus': os.cpu_count(),
+		'repeat': opts.repeat,
+		'results': results,
+	}
+	if opts.compare:
+		with open(opts.compare) as f:
+			compare(json.load(f), results, log)
+
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if opts.output:
+		with open(opts.output, 'w') as f:
+			f.write(output + '\n')
+	else:
+		print(output)
+
+if __name__ == '__main__':
+	main()
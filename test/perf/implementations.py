@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+Compares the python and OCaml implementations of gup on the
+synthetic projects from bench.py, reporting (side by side):
+
+ - startup: running `gup --features`
+ - cold:    a full build with -jN
+ - noop:    a rebuild with -jN when nothing has changed
+
+along with the peak memory used by any single gup process.
+
+Usage: test/perf/implementations.py [--python python/bin/gup] [--ocaml ocaml/bin/gup]
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import platform
+import tempfile
+
+from bench import Runner, scenarios, _median, _git_commit, root
+
+IMPLEMENTATIONS = ('python', 'ocaml')
+
+# operations from Runner.measure which are reported
+OPERATIONS = ('cold', 'noop')
+
+STARTUP_RUNS = 20
+
+def _summarize(samples):
+	walls = [sample.wall for sample in samples]
+	return {
+		'wall': walls,
+		'cpu': [sample.cpu for sample in samples],
+		'maxrss': max(sample.maxrss for sample in samples),
+		'min': min(walls),
+		'median': _median(walls),
+	}
+
+def measure(runners, selected, jobs, repeat, log):
+	'''
+	Returns a list of results, each with a
+	summary of samples for each implementation.
+	'''
+	results = []
+	def add(name, params, operation, samples_by_impl):
+		result = {
+			'scenario': name,
+			'params': params,
+			'jobs': jobs,
+			'operation': operation,
+		}
+		for impl, samples in samples_by_impl.items():
+			result[impl] = _summarize(samples)
+		log(_format(result))
+		results.append(result)
+
+	startup = {}
+	for impl, runner in runners.items():
+		startup[impl] = [runner.run(runner.tempdir, '--features') for _ in range(STARTUP_RUNS)]
+	add('startup', {}, 'startup', startup)
+
+	for scenario in selected:
+		samples = dict((impl, dict((operation, []) for operation in OPERATIONS)) for impl in runners)
+		for _ in range(repeat):
+			# interleave implementations, so that neither
+			# benefits more from a quiet machine
+			for impl, runner in runners.items():
+				for operation, sample in runner.measure(scenario, jobs).items():
+					if operation in samples[impl]:
+						samples[impl][operation].append(sample)
+		for operation in OPERATIONS:
+			add(scenario.name, scenario.params, operation,
+				dict((impl, samples[impl][operation]) for impl in runners))
+	return results
+
+def _describe(result):
+	params = ' '.join('%s=%s' % item for item in sorted(result['params'].items()))
+	return ('%s %s' % (result['scenario'], params)).strip()
+
+def _format(result):
+	columns = ['%-36s %-8s' % (_describe(result), result['operation'])]
+	for impl in IMPLEMENTATIONS:
+		if impl in result:
+			columns.append('%s %8.3fs %7.1fMB' % (impl, result[impl]['min'], result[impl]['maxrss'] / 1024.0))
+	if all(impl in result for impl in IMPLEMENTATIONS) and result['ocaml']['min']:
+		columns.append('(%.1fx)' % (result['python']['min'] / result['ocaml']['min'],))
+	return '  '.join(columns)
+
+def main():
+	p = optparse.OptionParser('Usage: %prog [OPTIONS]')
+	p.add_option('--python', default=os.path.join(root, 'python', 'bin', 'gup'), help='python gup executable (default %default)')
+	p.add_option('--ocaml', default=os.path.join(root, 'ocaml', 'bin', 'gup'), help='OCaml gup executable (default %default)')
+	p.add_option('-j', '--jobs', type='int', default=None, help='Job count for builds (default: number of CPUs)')
+	p.add_option('-s', '--scenario', action='append', default=[], help='Only run this scenario (may be repeated)')
+	p.add_option('--scale', type='float', default=1.0, help='Multiply the size of each project by this')
+	p.add_option('-n', '--repeat', type='int', default=3, help='Number of runs of each benchmark (default %default)')
+	p.add_option('-o', '--output', help='Write JSON results to this file (default stdout)')
+	opts, args = p.parse_args()
+	if args:
+		p.error("unexpected arguments: %r" % (args,))
+
+	def log(line):
+		print(line, file=sys.stderr)
+
+	exes = {'python': opts.python, 'ocaml': opts.ocaml}
+	for impl, exe in sorted(exes.items()):
+		if not os.path.exists(exe):
+			p.error("%s gup not found at %s (try `make %s`)" % (impl, exe, impl))
+
+	selected = scenarios(opts.scale)
+	if opts.scenario:
+		names = set(scenario.name for scenario in selected)
+		for name in opts.scenario:
+			if name not in names:
+				p.error("unknown scenario: %s (expected one of %s)" % (name, ', '.join(sorted(names))))
+		selected = [scenario for scenario in selected if scenario.name in opts.scenario]
+
+	jobs = opts.jobs or os.cpu_count() or 1
+
+	tempdir = tempfile.mkdtemp(prefix='gup-bench-')
+	try:
+		runners = {}
+		for impl in IMPLEMENTATIONS:
+			impl_dir = os.path.join(tempdir, impl)
+			os.mkdir(impl_dir)
+			runners[impl] = Runner(exes[impl], impl_dir)
+		results = measure(runners, selected, jobs, opts.repeat, log)
+	finally:
+		shutil.rmtree(tempdir)
+
+	report = {
+		'gup': exes,
+		'commit': _git_commit(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'host': platform.node(),
+		'python': platform.python_version(),
+		'cpus': os.cpu_count(),
+		'repeat': opts.repeat,
+		'results': results,
+	}
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if opts.output:
+		with open(opts.output, 'w') as f:
+			f.write(output + '\n')
+	else:
+		print(output)
+
+if __name__ == '__main__':
+	main()
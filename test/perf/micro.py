@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+'''
+Microbenchmarks of gup's (python) internals.
+
+Each benchmark runs a single function against the fixed fixtures in
+test/perf/fixtures (or files generated identically on each run), and
+reports the best time per call. Like bench.py, results are written
+as JSON, and --compare shows the change since an earlier run.
+
+Usage: test/perf/micro.py [-b NAME] [--output results.json]
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import optparse
+import platform
+import tempfile
+
+from bench import _median, _git_commit, root
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def _fixture(name, mode='r'):
+	with open(os.path.join(fixtures, name), mode) as f:
+		return f.read()
+
+def _write(path, contents, mtime=None):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		f.write(contents)
+	if mtime is not None:
+		os.utime(path, (mtime, mtime))
+
+# targets matched against the fixture Gupfile
+TARGETS = [
+	'src/file-0.c',
+	'out/3/foo',
+	'out/3/a/b/c.json',
+	'lib/x/y/gen-7-thing.min.js',
+	'docs/target-4',
+	'assets/img/nothing.png',
+	'vendor/foo/bar/baz.txt',
+	'gen/proto/a-136.pb.go',
+	'tests/unit/other-145.html',
+	'unmatched',
+]
+
+# Each benchmark is a function of (tempdir) which returns a
+# function to time, with any setup done outside of the timing.
+BENCHMARKS = []
+
+def benchmark(name):
+	def register(fn):
+		BENCHMARKS.append((name, fn))
+		return fn
+	return register
+
+@benchmark('possible_gup_files')
+def _possible_gup_files(tmp):
+	from gup.gupfile import possible_gup_files
+	return lambda: list(possible_gup_files('/a/b/c/d/e/f/g/target.o'))
+
+@benchmark('parse_gupfile')
+def _parse_gupfile(tmp):
+	from gup.gupfile import parse_gupfile
+	lines = _fixture('Gupfile').splitlines(True)
+	return lambda: parse_gupfile(lines)
+
+@benchmark('MatchRule.match')
+def _match_rule(tmp):
+	# every rule in the Gupfile, against each target
+	from gup.gupfile import parse_gupfile
+	rules = parse_gupfile(_fixture('Gupfile').splitlines(True))
+	def run():
+		for target in TARGETS:
+			for _script, ruleset in rules:
+				ruleset.match(target)
+	run()
+	return run
+
+@benchmark('GupfileMatcher.match')
+def _gupfile_matcher(tmp):
+	from gup.gupfile import parse_gupfile, GupfileMatcher
+	matcher = GupfileMatcher(parse_gupfile(_fixture('Gupfile').splitlines(True)))
+	def run():
+		for target in TARGETS:
+			matcher.match(target)
+	run()
+	return run
+
+def _gupfile_cache(tmp, persisted):
+	'''
+	Getting a matcher for the fixture Gupfile (and using it once),
+	as each gup process does. Compiled regexes are purged each time,
+	since they're not shared between processes.
+	'''
+	import re
+	from gup.gupfile import GupfileCache
+	gupfile = os.path.join(tmp, 'Gupfile')
+	_write(gupfile, _fixture('Gupfile', 'rb'), mtime=1500000000)
+	journal = None
+	if persisted:
+		journal = os.path.join(tmp, '.gup', 'gupfiles')
+		os.makedirs(os.path.dirname(journal))
+		cache = GupfileCache(journal)
+		cache.matcher(gupfile)
+		cache.save()
+	def run():
+		re.purge()
+		GupfileCache(journal).matcher(gupfile).match(TARGETS[0])
+	return run
+
+@benchmark('GupfileCache.matcher (parsed)')
+def _gupfile_cache_parsed(tmp):
+	return _gupfile_cache(tmp, False)
+
+@benchmark('GupfileCache.matcher (persisted)')
+def _gupfile_cache_persisted(tmp):
+	return _gupfile_cache(tmp, True)
+
+@benchmark('Dependency.parse')
+def _dependency_parse(tmp):
+	from gup.state import Dependency
+	lines = _fixture('deps').splitlines()[1:]
+	def run():
+		for line in lines:
+			Dependency.parse(line)
+	return run
+
+@benchmark('Dependencies.__init__ (text)')
+def _dependencies_text(tmp):
+	from gup.state import Dependencies
+	data = _fixture('deps', 'rb')
+	return lambda: Dependencies('target', data)
+
+def _load_cached_deps():
+	'''
+	A function loading the fixture deps from their cached (binary) encoding
+	'''
+	from gup.state import Dependencies, BinaryDeps
+	sig = (1, 2, 3, 4)
+	data = BinaryDeps.encode(Dependencies('target', _fixture('deps', 'rb')), sig)
+	return lambda: Dependencies('target', None, BinaryDeps.of_file(data, sig))
+
+@benchmark('Dependencies.__init__ (binary)')
+def _dependencies_binary(tmp):
+	return _load_cached_deps()
+
+@benchmark('Dependencies.__init__ (binary, all rules)')
+def _dependencies_binary_rules(tmp):
+	load = _load_cached_deps()
+	return lambda: list(load().rules)
+
+def _clean_deps(tmp, num_files):
+	'''
+	A clean target (in `tmp`) depending on `num_files` source files
+	'''
+	from gup.gupfile import Builder
+	from gup.state import Dependencies, FileDependency, BuilderDependency
+	from gup.util import get_mtime
+	builder = os.path.join(tmp, 'target.gup')
+	_write(builder, b'#!/bin/sh\n', mtime=1500000000)
+	_write(os.path.join(tmp, 'target'), b'', mtime=1500000000)
+	lines = [b'version: 3', ('%s %d - target.gup' % (BuilderDependency.tag, get_mtime(builder))).encode('ascii')]
+	for i in range(num_files):
+		path = os.path.join(tmp, 'src', str(i // 100), '%d.c' % (i,))
+		_write(path, b'', mtime=1500000000 + i)
+		lines.append(('%s %d - %s' % (FileDependency.tag, get_mtime(path), os.path.relpath(path, tmp))).encode('utf-8'))
+	deps = Dependencies(os.path.join(tmp, 'target'), b'\n'.join(lines) + b'\n')
+	builder = Builder(builder, 'target', tmp, None)
+	def run():
+		assert not deps.is_dirty(builder, lambda path: False)
+	return run
+
+@benchmark('Dependencies.is_dirty (8 files)')
+def _is_dirty_small(tmp):
+	return _clean_deps(tmp, 8)
+
+@benchmark('Dependencies.is_dirty (500 files)')
+def _is_dirty_large(tmp):
+	return _clean_deps(tmp, 500)
+
+@benchmark('traverse_from')
+def _traverse_from(tmp):
+	from gup.path import traverse_from
+	_write(os.path.join(tmp, 'real', 'a', 'b', 'c', 'd', 'e', 'f', 'file'), b'')
+	os.symlink(os.path.join('real', 'a'), os.path.join(tmp, 'a'))
+	os.symlink('d', os.path.join(tmp, 'real', 'a', 'b', 'c', 'link'))
+	# (as used by --ifcreate)
+	os.symlink(os.path.join(tmp, 'a', 'b', 'c', 'link', 'e', 'f', 'pending'), os.path.join(tmp, 'real', 'pending'))
+	def run():
+		traverse_from(tmp, 'a/b/c/link/e/f/file')
+		traverse_from(tmp, 'real/pending', resolve_final=True)
+		traverse_from(tmp, 'a/b/c/missing/x/y')
+	return run
+
+def _checksum_files(tmp, count, size, mtime, algorithm=None):
+	from gup.state import Checksum
+	block = bytes(bytearray(range(256))) * 4096
+	paths = []
+	for i in range(count):
+		path = os.path.join(tmp, 'file-%d' % (i,))
+		_write(path, (block * (size // len(block) + 1))[:size], mtime=mtime)
+		paths.append(path)
+	return lambda: Checksum.from_files(paths, algorithm)
+
+# modification times in the future are never cached
+_UNCACHEABLE = time.time() + 24 * 60 * 60
+
+@benchmark('Checksum.from_files (8 x 256KB)')
+def _checksum_small(tmp):
+	return _checksum_files(tmp, 8, 256 * 1024, _UNCACHEABLE)
+
+@benchmark('Checksum.from_files (1 x 8MB)')
+def _checksum_large(tmp):
+	return _checksum_files(tmp, 1, 8 * 1024 * 1024, _UNCACHEABLE)
+
+@benchmark('Checksum.from_files (8 x 256KB, cached)')
+def _checksum_cached(tmp):
+	# (files with old mtimes are cached, but only
+	# tagged algorithms combine per-file checksums)
+	run = _checksum_files(tmp, 8, 256 * 1024, 1500000000, 'blake2b')
+	run()
+	return run
+
+def measure(fn, repeat):
+	'''
+	Returns (number, [seconds per call]) for `repeat` runs
+	of `fn`, each long enough to be measured reliably.
+	'''
+	timer = timeit.Timer(fn)
+	number, _ = timer.autorange()
+	return number, [elapsed / number for elapsed in timer.repeat(repeat, number)]
+
+def _key(result):
+	return result['name']
+
+def compare(baseline, results, log):
+	previous = dict((_key(result), result) for result in baseline['results'])
+	for result in results:
+		old = previous.get(_key(result), None)
+		if old is None:
+			continue
+		change = (result['min'] - old['min']) / old['min'] * 100 if old['min'] else 0
+		log("%-42s %10.1fus -> %10.1fus (%+.1f%%)" % (result['name'], old['min'] * 1e6, result['min'] * 1e6, change))
+
+def main():
+	p = optparse.OptionParser('Usage: %prog [OPTIONS]')
+	p.add_option('--path', default=os.path.join(root, 'python'), help='Import gup from this directory (default %default)')
+	p.add_option('-b', '--benchmark', action='append', default=[], help='Only run benchmarks whose name contains this (may be repeated)')
+	p.add_option('-n', '--repeat', type='int', default=5, help='Number of runs of each benchmark (default %default)')
+	p.add_option('-l', '--list', action='store_true', help='List benchmarks')
+	p.add_option('-o', '--output', help='Write JSON results to this file (default stdout)')
+	p.add_option('--compare', metavar='FILE', help='Compare results to those in FILE')
+	opts, args = p.parse_args()
+	if args:
+		p.error("unexpected arguments: %r" % (args,))
+
+	def log(line):
+		print(line, file=sys.stderr)
+
+	selected = [(name, fn) for name, fn in BENCHMARKS
+		if not opts.benchmark or any(part in name for part in opts.benchmark)]
+	if opts.list:
+		for name, _fn in selected:
+			print(name)
+		return
+
+	# gup records its root (and caches) in the working directory
+	# when first imported, so keep that out of the way
+	for key in list(os.environ.keys()):
+		if key.startswith('GUP_'):
+			del os.environ[key]
+	tempdir = os.path.realpath(tempfile.mkdtemp(prefix='gup-micro-'))
+	cwd = os.getcwd()
+	os.chdir(tempdir)
+	sys.path.insert(0, os.path.abspath(os.path.join(cwd, opts.path)))
+	import gup
+
+	results = []
+	try:
+		for i, (name, setup) in enumerate(selected):
+			dest = os.path.join(tempdir, str(i))
+			os.mkdir(dest)
+			number, times = measure(setup(dest), opts.repeat)
+			result = {
+				'name': name,
+				'number': number,
+				'times': times,
+				'min': min(times),
+				'median': _median(times),
+			}
+			log("%-42s %10.1fus (%d loops)" % (name, result['min'] * 1e6, number))
+			results.append(result)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tempdir)
+
+	report = {
+		'gup': os.path.dirname(os.path.abspath(gup.__file__)),
+		'commit': _git_commit(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'host': platform.node(),
+		'python': platform.python_version(),
+		'repeat': opts.repeat,
+		'results': results,
+	}
+	if opts.compare:
+		with open(opts.compare) as f:
+			compare(json.load(f), results, log)
+
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if opts.output:
+		with open(opts.output, 'w') as f:
+			f.write(output + '\n')
+	else:
+		print(output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,193 @@
+from .util import *
+
+@unittest.skipIf(IS_OCAML, 'python only')
+class TestOutputCache(TestCase):
+	def setUp(self):
+		super(TestOutputCache, self).setUp()
+		self.write('src', 'source\n')
+
+	def build_cached(self, *targets):
+		return self.build('--cache', 'cache', '-u', *targets, include_logging=True)
+
+	def runs(self):
+		# each build script appends its name to `runs`
+		if not self.exists('runs'):
+			return []
+		return self.read('runs').split()
+
+	def clean(self):
+		self.build('--clean', '-f')
+		os.remove(self.path('runs'))
+
+	def test_restores_targets_after_clean(self):
+		self.write('all.gup', BASH + 'echo $2 >> runs; gup -u intermediate; cat intermediate > "$1"')
+		self.write('intermediate.gup', BASH + 'echo $2 >> runs; gup -u src; cat src > "$1"; echo built >> "$1"')
+		self.build_cached('all')
+		self.assertEqual(sorted(self.runs()), ['all', 'intermediate'])
+
+		self.clean()
+		self.assertFalse(self.exists('all'))
+		output = self.build_cached('all')
+		self.assertEqual(self.runs(), [])
+		self.assertEqual(self.read('all'), 'source\nbuilt')
+		self.assertIn('all (cached)', '\n'.join(output))
+
+		# the restored dependencies are up to date
+		self.build_u('all')
+		self.assertEqual(self.runs(), [])
+		self.write('src', 'modified\n')
+		self.build_cached('all')
+		self.assertEqual(sorted(self.runs()), ['all', 'intermediate'])
+		self.assertEqual(self.read('all'), 'modified\nbuilt')
+
+		# and each version is kept
+		self.write('src', 'source\n')
+		self.build_cached('all')
+		self.assertEqual(sorted(self.runs()), ['all', 'intermediate'])
+		self.assertEqual(self.read('all'), 'source\nbuilt')
+
+	def test_restores_symlinks_and_directories(self):
+		self.write('link.gup', BASH + 'echo $2 >> runs; gup -u src; ln -s src "$1"')
+		self.write('dir.gup', BASH + 'echo $2 >> runs; gup -u src; mkdir -p "$1/nested"; cp src "$1/nested/file"; ln -s nested/file "$1/link"')
+		self.build_cached('link', 'dir')
+		self.clean()
+
+		self.build_cached('link', 'dir')
+		self.assertEqual(self.runs(), [])
+		self.assertEqual(os.readlink(self.path('link')), 'src')
+		self.assertEqual(self.read('dir/nested/file'), 'source')
+		self.assertEqual(os.readlink(self.path('dir/link')), 'nested/file')
+
+	def test_builder_changes_are_not_restored(self):
+		self.write('target.gup', BASH + 'echo $2 >> runs; echo one > "$1"')
+		self.build_cached('target')
+		self.clean()
+		self.write('target.gup', BASH + 'echo $2 >> runs; echo two > "$1"')
+		self.build_cached('target')
+		self.assertEqual(self.runs(), ['target'])
+		self.assertEqual(self.read('target'), 'two')
+
+	def test_does_not_cache_targets_which_are_always_rebuilt(self):
+		self.write('target.gup', BASH + 'echo $2 >> runs; gup --always; echo ok > "$1"')
+		self.build_cached('target')
+		self.clean()
+		self.build_cached('target')
+		self.assertEqual(self.runs(), ['target'])
+
+	def test_forced_builds_run_the_build_script(self):
+		self.write('target.gup', BASH + 'echo $2 >> runs; echo ok > "$1"')
+		self.build_cached('target')
+		self.build('--cache', 'cache', 'target')
+		self.assertEqual(self.runs(), ['target', 'target'])
+
+	def test_evicts_least_recently_used_outputs(self):
+		for name in ['a', 'b', 'c']:
+			self.write(name + '.gup', BASH + 'echo $2 >> runs; head -c 4000 /dev/zero > "$1"')
+		self.build_cached('a', 'b')
+		# use `a` more recently than `b`
+		self.clean()
+		time.sleep(1)
+		self.build_cached('a')
+
+		# too small for all three outputs, and evicting down to
+		# 3/4 of the budget leaves room for two
+		self.write('all.gup', BASH + 'GUP_CACHE_SIZE=11000 gup --cache cache -u c')
+		self.build_u('all')
+		self.clean()
+		self.build_cached('a', 'b', 'c')
+		self.assertEqual(sorted(self.runs()), ['b'])
+
+	def test_keeps_outputs_used_while_evicting(self):
+		for name in ['a', 'b']:
+			self.write(name + '.gup', BASH + 'head -c 4000 /dev/zero > "$1"')
+		self.build_cached('a', 'b')
+		from gup.cache import OutputCache
+		cache = OutputCache(self.path('cache'))
+		scan = cache._entries
+		def scan_then_use():
+			entries = list(scan())
+			for entry in entries:
+				yield entry
+			# a concurrent build uses every output once the scan is done
+			for _used, _size, entry in entries:
+				os.utime(os.path.join(entry, 'meta'), (0, time.time() + 10))
+		cache._entries = scan_then_use
+		self.assertEqual(cache.evict(1), (8000, 0))
+		self.assertEqual(cache.usage(), (2, 8000))
+
+	def test_reports_cache_stats(self):
+		self.write('target.gup', BASH + 'echo $2 >> runs; echo ok > "$1"')
+		self.build_cached('target')
+		self.clean()
+		self.build_cached('target')
+		stats = '\n'.join(self.build('--cache-stats', 'cache'))
+		self.assertIn('1 outputs, 3B', stats)
+		self.assertIn('hits: 1 of 2 lookups (50.0%)', stats)
+		self.assertIn('saved: 3B', stats)
+
+@unittest.skipIf(IS_OCAML, 'python only')
+class TestRemoteCache(TestCase):
+	def setUp(self):
+		super(TestRemoteCache, self).setUp()
+		self.write('src', 'source\n')
+		import gup
+		env = os.environ.copy()
+		env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(gup.__file__)))
+		self.mkdirp('server')
+		self.server = subprocess.Popen([sys.executable, '-m', 'gup.cache_server', self.path('server')],
+			stdout=subprocess.PIPE, env=env)
+		self.url = self.server.stdout.readline().decode('ascii').strip()
+		self.assertTrue(self.url.startswith('http://'), self.url)
+
+	def tearDown(self):
+		self.server.terminate()
+		self.server.wait()
+		self.server.stdout.close()
+		super(TestRemoteCache, self).tearDown()
+
+	def build_remote(self, cache, *targets):
+		return self.build('--cache', cache, '--remote-cache', self.url, '-u', *targets, include_logging=True)
+
+	def runs(self):
+		if not self.exists('runs'):
+			return []
+		return self.read('runs').split()
+
+	def clean(self):
+		self.build('--clean', '-f')
+		os.remove(self.path('runs'))
+
+	def test_restores_outputs_from_another_cache(self):
+		self.write('all.gup', BASH + 'echo $2 >> runs; gup -u intermediate; cat intermediate/file > "$1"')
+		self.write('intermediate.gup', BASH + 'echo $2 >> runs; gup -u src; mkdir "$1"; cp src "$1/file"')
+		self.build_remote('cache-a', 'all')
+		self.assertEqual(sorted(self.runs()), ['all', 'intermediate'])
+
+		self.clean()
+		output = self.build_remote('cache-b', 'all')
+		self.assertEqual(self.runs(), [])
+		self.assertEqual(self.read('all'), 'source')
+		self.assertEqual(self.read('intermediate/file'), 'source')
+		self.assertIn('all (cached)', '\n'.join(output))
+
+		# and they're now stored locally
+		self.assertIn('remote: 2 outputs downloaded', '\n'.join(self.build('--cache-stats', 'cache-b')))
+		self.assertIn('remote: 0 outputs downloaded, 2 uploaded', '\n'.join(self.build('--cache-stats', 'cache-a')))
+
+	def test_builds_when_the_remote_is_unavailable(self):
+		self.server.terminate()
+		self.server.wait()
+		self.write('target.gup', BASH + 'echo $2 >> runs; echo ok > "$1"')
+		output = self.build_remote('cache', 'target')
+		self.assertEqual(self.runs(), ['target'])
+		self.assertEqual(self.read('target'), 'ok')
+		self.assertIn('Not using remote cache', '\n'.join(output))
+
+	def test_nested_builds_dont_retry_a_failed_remote(self):
+		self.server.terminate()
+		self.server.wait()
+		self.write('all.gup', BASH + 'echo $2 >> runs; gup -u intermediate; cat intermediate > "$1"')
+		self.write('intermediate.gup', BASH + 'echo $2 >> runs; echo ok > "$1"')
+		output = '\n'.join(self.build_remote('cache', 'all'))
+		self.assertEqual(sorted(self.runs()), ['all', 'intermediate'])
+		self.assertEqual(output.count('Not using remote cache'), 1, output)
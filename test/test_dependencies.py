@@ -151,6 +151,75 @@ class TestDependencies(TestCase):
 		self.assertEqual(self.read("a/counter"), "4")
 
 	
+	def test_diamond_dependencies(self):
+		self.write('shared.gup', BASH + 'gup -u input; cat input > "$1"')
+		self.write('left.gup', echo_file_contents('shared'))
+		self.write('right.gup', echo_file_contents('shared'))
+		self.write('top.gup', BASH + 'gup -u left right; cat left right > "$1"')
+
+		self.write('input', '1')
+		self.build_u('top')
+		self.assertEqual(self.read('top'), '11')
+
+		self.write('input', '2')
+		self.build_u('top')
+		self.assertEqual(self.read('top'), '22')
+
+	@unittest.skipIf(IS_OCAML, "python-specific logging")
+	def test_shared_dependency_is_checked_once_per_run(self):
+		self.write('shared.gup', BASH + 'gup -u input; cat input > "$1"')
+		self.write('left.gup', echo_file_contents('shared'))
+		self.write('right.gup', echo_file_contents('shared'))
+		self.write('top.gup', BASH + 'gup -u left right; cat left right > "$1"')
+		self.write('input', '1')
+		self.build_u('top')
+
+		lines = self.build_u('top', include_logging=True)
+		shared_checks = [line for line in lines if re.search(r"build_target_if_dirty: Target\('.*/shared'\)", line)]
+		self.assertEqual(len(shared_checks), 1, '\n'.join(shared_checks))
+
+	def test_records_every_dependency_of_a_parallel_invocation(self):
+		inputs = ['input%d' % i for i in range(6)]
+		for name in inputs:
+			self.write(name, name)
+		self.write('built.gup', echo_file_contents('input0'))
+		self.write('parent.gup', BASH + 'gup -u -j3 built %s; echo ok > "$1"' % ' '.join(inputs[1:]))
+
+		for name in inputs:
+			self.assertRebuilds('parent', lambda: self.write(name, 'changed'))
+
+	def test_target_with_many_dependencies(self):
+		inputs = ['input%02d' % i for i in range(40)]
+		for name in inputs:
+			self.write(name, name)
+		self.write('child.gup', BASH + 'gup -u input00; cat input00 > "$1"')
+		self.write('parent.gup', BASH + 'gup -u %s child; cat child > "$1"' % ' '.join(inputs[1:]))
+
+		self.build_u('parent')
+		self.assertNotRebuilds('parent', lambda: None)
+		self.assertRebuilds('parent', lambda: self.write('input20', 'changed'))
+		self.assertRebuilds('parent', lambda: self.write('input39', 'changed'))
+		self.assertRebuilds('parent', lambda: self.write('input00', 'changed'))
+		self.assertEqual(self.read('parent'), 'changed')
+
+	@unittest.skipIf(IS_OCAML, "python-specific option")
+	def test_hashed_sources_only_cause_rebuild_when_contents_change(self):
+		self.write('input', 'a')
+		self.write('target.gup', echo_file_contents('input'))
+		self.build('--hash-sources', '-u', 'target')
+
+		def touch_input():
+			past = time.time() - 60
+			os.utime(self.path('input'), (past, past))
+		self.assertNotRebuilds('target', touch_input, built=True)
+
+		# the stored mtime is updated, so contents aren't checked again
+		lines = self.build_u('target', include_logging=True)
+		self.assertEqual([line for line in lines if 'contents are unchanged' in line], [])
+
+		self.assertRebuilds('target', lambda: self.write('input', 'b'), built=True)
+		self.assertEqual(self.read('target'), 'b')
+
 	def test_target_depends_on_gupfile(self):
 		self.write('target.gup', echo_to_target('ok'))
 
@@ -463,6 +532,13 @@ class TestChecksums(TestCase):
 		self.write('cs.gup', echo_file_contents('input') + '; cat $1 | gup --contents')
 		self.write('parent.gup', echo_file_contents('cs'))
 
+	def stored_checksum(self, target):
+		lines = self.read('.gup/deps.%s' % target).splitlines()
+		for line in lines:
+			if line.startswith('checksum: '):
+				return line.split(' ', 1)[1]
+		raise ValueError("no checksum in %r" % lines,)
+
 	def test_checksum_task_is_only_built_if_inputs_are_modified(self):
 		self.assertRebuilds('cs', lambda: self.touch('input'))
 		self.assertNotRebuilds('cs', lambda: None)
@@ -531,6 +607,57 @@ class TestChecksums(TestCase):
 		assertChecksumChanges('cs_twofile', lambda: self.write('secondline', 'new line2'))
 		assertNotChecksumChanges('cs_twofile', lambda: None)
 
+	@unittest.skipIf(IS_OCAML, "python-specific logging")
+	def test_file_checksums_are_cached_until_modified(self):
+		self.write('stamp.gup', BASH + 'gup --always; gup --contents input')
+		self.write('stamp-parent.gup', BASH + 'gup -u stamp; echo ok > "$1"')
+		# recently-modified files aren't cached
+		past = time.time() - 60
+		os.utime(self.path('input'), (past, past))
+		self.build_u('stamp-parent')
+		self.assertTrue(any(name.startswith('hashes-') for name in os.listdir(self.path('.gup'))))
+
+		def cache_hits():
+			lines = self.build_u('stamp-parent', include_logging=True)
+			return [line for line in lines if 'hash cache hit' in line]
+		self.assertNotEqual(cache_hits(), [])
+		self.assertNotRebuilds('stamp-parent', lambda: None)
+
+		self.write('input', 'modified')
+		self.assertEqual(cache_hits(), [])
+		self.assertRebuilds('stamp-parent', lambda: self.write('input', 'modified again'))
+
+	@unittest.skipIf(IS_OCAML, "python-specific option")
+	def test_checksum_algorithm_is_configurable(self):
+		self.write('files.gup', BASH + 'gup --contents input cs.gup; echo ok > "$1"')
+		self.build_u('files', 'cs')
+		# sha1 checksums are untagged, as in older versions
+		self.assertRegexpMatches(self.stored_checksum('cs'), '^[0-9a-f]{40}$')
+		import hashlib
+		contents = (self.read('input') + self.read('cs.gup')).encode('utf-8')
+		self.assertEqual(self.stored_checksum('files'), hashlib.sha1(contents).hexdigest())
+
+		self.build('--checksum=blake2b', 'files', 'cs')
+		self.assertRegexpMatches(self.stored_checksum('cs'), '^blake2b:[0-9a-f]{128}$')
+		self.assertRegexpMatches(self.stored_checksum('files'), '^blake2b:[0-9a-f]{128}$')
+
+		# rejected before building anything
+		self.write('files.gup', BASH + 'touch ran; exit 1')
+		status, lines = self.build('--checksum=no-such-hash', 'files', throwing=False, include_logging=True)
+		self.assertNotEqual(status, 0)
+		self.assertIn('Unsupported checksum algorithm: no-such-hash', '\n'.join(lines))
+		self.assertFalse(self.exists('ran'))
+
+	@unittest.skipIf(IS_OCAML, "python-specific option")
+	def test_hashed_sources_use_their_stored_checksum_algorithm(self):
+		self.write('target.gup', echo_file_contents('input'))
+		self.build('--hash-sources', '--checksum=blake2b', '-u', 'target')
+
+		def touch_input():
+			past = time.time() - 60
+			os.utime(self.path('input'), (past, past))
+		self.assertNotRebuilds('target', touch_input, built=True)
+
 	def test_parent_of_checksum_is_rebult_if_child_stops_being_checksummed(self):
 		self.build_u('parent')
 		self.assertRebuilds('parent', lambda: self.write('cs.gup', echo_file_contents('input')))
@@ -576,6 +703,18 @@ class TestVersion(TestCase):
 	def write_deps(self, lines):
 		self.write('.gup/deps.target', '\n'.join(lines))
 
+	def read_deps(self):
+		with open(self.path('.gup/deps.target'), 'rb') as f:
+			return f.read()
+
+	def write_text_deps(self):
+		from gup import state
+		deps = state.Dependencies(self.path('target'), self.read_deps())
+		lines = ['version: %s' % state.Dependencies.BASE_FORMAT_VERSION, 'run: %s' % deps.runid.value]
+		for rule in deps.rules:
+			lines.append(' '.join([rule.tag] + rule.fields))
+		self.write_deps(lines)
+
 	def write_old_deps(self):
 		self.write_deps(['version: 0', 'some_old_key: xyz'])
 
@@ -583,6 +722,57 @@ class TestVersion(TestCase):
 		self.write('target.gup', echo_to_target('hello'))
 		self.assertRebuilds('target', self.write_old_deps)
 
+	@skipPermutations
+	@unittest.skipIf(IS_OCAML, "python only")
+	def test_reads_and_migrates_text_metadata(self):
+		self.write('target.gup', echo_to_target('hello'))
+		self.write('input', 'input')
+		self.write('parent.gup', echo_file_contents('input'))
+		self.build_u('target', 'parent')
+		self.assertTrue(self.read_deps().startswith(b'version: '))
+		self.assertTrue(self.exists('.gup/deps-cache.target'))
+
+		# the stale cache is ignored
+		self.assertNotRebuilds('target', self.write_text_deps, built=True)
+		self.assertTrue(self.read_deps().startswith(b'version: 3\n'))
+
+		os.remove(self.path('.gup/deps-cache.target'))
+		self.build('--migrate-metadata')
+		self.assertTrue(self.exists('.gup/deps-cache.target'))
+		self.assertTrue(self.read_deps().startswith(b'version: 3\n'))
+		self.assertNotRebuilds('target', lambda: None, built=True)
+		self.assertRebuilds('parent', lambda: self.write('input', 'changed'))
+
+	@unittest.skipIf(IS_OCAML, "python only")
+	def test_only_writes_format_version_4_when_needed(self):
+		self.write('target.gup', echo_to_target('hello'))
+		self.write('input', 'input')
+		self.write('hashed.gup', BASH + 'gup -u --hash-sources input; cat input > "$1"')
+		self.build_u('target', 'hashed')
+		versions = {}
+		for name in ['target', 'hashed']:
+			with open(self.path('.gup/deps.' + name), 'rb') as f:
+				lines = f.read().decode('utf-8').splitlines()
+			versions[name] = lines[0]
+			if not any(line.startswith(('content:', 'stats:')) for line in lines):
+				self.assertEqual(lines[0], 'version: 3')
+		self.assertEqual(versions['hashed'], 'version: 4')
+
+	@unittest.skipIf(IS_OCAML, "python only")
+	def test_critical_path_includes_built_dependencies(self):
+		self.write('slow.gup', BASH + 'sleep 0.5; echo ok > "$1"')
+		self.write('target.gup', BASH + 'gup -u slow; echo ok > "$1"')
+		self.build_u('target')
+		from gup.state import TargetState
+		slow = TargetState(self.path('slow')).stats()
+		target = TargetState(self.path('target')).stats()
+		self.assertGreaterEqual(slow.critical, 500)
+		self.assertGreaterEqual(target.critical, slow.critical)
+		# only needed while building
+		deps = self.read_deps().decode('utf-8')
+		self.assertNotIn('critical:', deps)
+		self.assertNotIn('waited:', deps)
+
 	def test_overwrites_and_rebuilds_if_deps_are_invalid(self):
 		self.write('target.gup', echo_to_target('hello'))
 		self.assertRebuilds('target', lambda: self.write_deps(['not_even_valid']))
@@ -591,3 +781,50 @@ class TestVersion(TestCase):
 			'version: %s' % state.Dependencies.FORMAT_VERSION,
 			'something_else: 123'
 		]))
+
+@unittest.skipIf(IS_OCAML, "python only")
+class TestAffected(TestCase):
+	def affected(self, *args):
+		return sorted(self.build('--affected', *args))
+
+	def test_lists_transitive_dependents(self):
+		self.write('all.gup', BASH + 'gup -u a dir/b; touch "$1"')
+		self.write('a.gup', echo_file_contents('a.src'))
+		self.write('dir/b.gup', BASH + 'gup -u b.src ../a; cat b.src > "$1"')
+		self.write('a.src', 'a')
+		self.write('dir/b.src', 'b')
+		self.build_u('all')
+
+		self.assertEqual(self.affected('a.src'), ['a', 'all', 'dir/b'])
+		self.assertEqual(self.affected('dir/b.src'), ['all', 'dir/b'])
+		self.assertEqual(self.affected('dir/b.gup', '--compact'), ['all', 'dir/b'])
+		self.assertEqual(self.affected('all'), [])
+
+		# dependencies recorded after compaction replace indexed ones
+		self.write('dir/b.gup', BASH + 'gup -u b.src; cat b.src > "$1"')
+		self.build_u('all')
+		self.assertEqual(self.affected('a.src'), ['a', 'all'])
+		self.assertEqual(self.affected('-c', 'a.src'), ['a', 'all'])
+		self.assertEqual(sorted(self.build('--affected', '../a.src', cwd=self.path('dir'))), ['../a', '../all'])
+
+	def test_index_is_kept_in_the_project_root(self):
+		self.write('a.gup', echo_file_contents('a.src'))
+		self.write('a.src', 'a')
+		self.build_u('a')
+		self.mkdirp('elsewhere')
+		self.write('a.src', 'changed')
+		self.build_u('../a', cwd=self.path('elsewhere'))
+		self.assertFalse(self.exists('elsewhere/.gup'))
+		self.assertEqual(self.build('--affected', '../a.src', cwd=self.path('elsewhere')), ['../a'])
+
+	def test_builds_compact_a_large_log(self):
+		from gup.revdeps import ReverseIndex
+		self.mkdirp('.gup')
+		index = ReverseIndex(self.path('.gup'))
+		index.COMPACT_THRESHOLD = 1000
+		for i in range(100):
+			index.record(self.path('target'), [self.path('src-%d' % i)])
+			index.save()
+		self.assertLessEqual(os.path.getsize(index.log_path), 1000)
+		self.assertEqual(index.affected([self.path('src-99')]), [self.path('target')])
+		self.assertEqual(index.affected([self.path('src-0')]), [])
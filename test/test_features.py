@@ -44,3 +44,125 @@ class TestFeatures(TestCase):
 		# then check their contents
 		self.assertEqual(self.read('.gup/out.bad_b'), 'bad_b')
 		self.assertEqual(self.read('.gup/out.bad_c'), 'bad_c')
+
+	@skipPermutations
+	@unittest.skipIf(IS_OCAML or not sys.platform.startswith('linux'), 'python on linux only')
+	def test_watch_rebuilds_affected_targets(self):
+		self.write('all.gup', BASH + 'gup -u a b; date +%s.%N > "$1"')
+		self.write('a.gup', BASH + 'gup -u a.src; cat a.src > "$1"')
+		self.write('b.gup', BASH + 'gup -u b.src; echo "$(cat b.src) $(date +%s.%N)" > "$1"')
+		self.write('a.src', 'a1')
+		self.write('b.src', 'b1')
+
+		def wait_for(fn):
+			deadline = time.time() + 10
+			while not fn():
+				if time.time() > deadline:
+					self.fail("timed out")
+				time.sleep(0.1)
+
+		proc = self.spawn('--watch')
+		try:
+			# watches are in place once the cycle is reported
+			self.wait_for_output(proc, 'watching')
+			b_contents = self.read('b')
+			self.assertEqual(self.read('a'), 'a1')
+
+			self.write('a.src', 'a2')
+			wait_for(lambda: self.read('a') == 'a2')
+			self.assertEqual(self.read('b'), b_contents)
+
+			self.write('b.src', 'b2')
+			wait_for(lambda: self.read('b').startswith('b2'))
+		finally:
+			proc.kill()
+			proc.wait()
+
+	@skipPermutations
+	@unittest.skipIf(IS_OCAML or not sys.platform.startswith('linux'), 'python on linux only')
+	def test_daemon_skips_checks_for_clean_targets(self):
+		self.write('all.gup', BASH + 'gup -u a dir/b; echo all > "$1"')
+		self.write('a.gup', BASH + 'gup -u a.src; cat a.src > "$1"')
+		self.write('dir/b.gup', BASH + 'gup -u b.src; cat b.src > "$1"')
+		self.write('a.src', 'a1')
+		self.write('dir/b.src', 'b1')
+
+		def daemon_clean(target):
+			lines = self.build_u('all', include_logging=True)
+			return any(target + ' (according to gup daemon)' in line for line in lines)
+
+		proc = self.spawn('--daemon')
+		try:
+			self.wait_for_output(proc, 'watching')
+			# clients trust the daemon, so its socket must be private
+			import tempfile, stat
+			st = os.lstat(os.path.join(tempfile.gettempdir(), 'gup-daemon-%d' % (os.getuid(),)))
+			self.assertEqual(stat.S_IMODE(st.st_mode), 0o700)
+
+			self.build_u('all')
+			self.assertFalse(daemon_clean('all'))
+			self.assertTrue(daemon_clean('all'))
+
+			self.write('a.src', 'a2')
+			self.assertFalse(daemon_clean('all'))
+			self.assertEqual(self.read('a'), 'a2')
+
+			self.write('dir/b.src', 'b2')
+			self.assertFalse(daemon_clean('all'))
+			self.assertEqual(self.read('dir/b'), 'b2')
+		finally:
+			proc.terminate()
+			proc.wait()
+
+	@unittest.skipIf(IS_OCAML, 'python only')
+	def test_profile_json_records_every_process(self):
+		import json
+		self.write('all.gup', BASH + 'gup -u a b; echo all > "$1"')
+		self.write('a.gup', BASH + 'echo a > "$1"')
+		self.write('b.gup', BASH + 'echo b > "$1"')
+		self.build('-j2', '--profile-json', 'trace.json', 'all')
+
+		with open(self.path('trace.json')) as f:
+			events = json.load(f)
+		spans = dict((event['name'], event) for event in events if event['ph'] == 'X')
+		for target in ['all', 'a', 'b']:
+			self.assertIn('exec ' + target, spans)
+			self.assertIn('build ' + target, spans)
+		self.assertNotEqual(spans['exec all']['tid'], spans['exec a']['tid'])
+
+		outer, inner = spans['exec all'], spans['build a']
+		self.assertTrue(outer['ts'] <= inner['ts'])
+		self.assertTrue(inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur'])
+
+	@unittest.skipIf(IS_OCAML, 'python only')
+	def test_summary_includes_nested_builds(self):
+		self.write('all.gup', BASH + 'gup -u a b; echo all > "$1"')
+		self.write('a.gup', BASH + 'echo a > "$1"')
+		self.write('b.gup', BASH + 'sleep 0.5; echo b > "$1"')
+
+		def summary(*args):
+			lines = self.build(*(args + ('--summary', 'all')), include_logging=True)
+			return '\n'.join(line for line in lines if line.startswith('# INFO'))
+
+		output = summary('-j2')
+		self.assertIn('targets checked, 0 up to date, 3 built', output)
+		self.assertIn('slowest targets:', output)
+		self.assertTrue(output.index(' b (') < output.index(' a ('), output)
+
+		output = summary('-u')
+		self.assertIn('3 targets checked, 3 up to date, 0 built', output)
+		self.assertNotIn('slowest targets:', output)
+
+	@unittest.skipIf(IS_OCAML, 'python only')
+	def test_profiles_every_gup_process(self):
+		self.write('all.gup', BASH + 'GUP_PROFILE="$(pwd)/profile" gup -u a b; echo all > "$1"')
+		self.write('a.gup', BASH + 'echo a > "$1"')
+		self.write('b.gup', BASH + 'echo b > "$1"')
+		self.build('-j2', 'all')
+
+		profiles = sorted(re.sub(r'^\d+-', '', name) for name in os.listdir(self.path('profile')))
+		self.assertEqual(profiles, ['a.pstats', 'all.pstats', 'b.pstats'])
+
+		report = '\n'.join(self._build(['--profile-report', '--sort=cumulative', 'profile']))
+		self.assertIn('Combined profile of 3 gup processes', report)
+		self.assertIn('(build_or_update)', report)
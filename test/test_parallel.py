@@ -10,6 +10,7 @@ import re
 GUP_JOBSERVER = 'GUP_JOBSERVER'
 MAKEFLAGS = 'MAKEFLAGS'
 GUP_RPC = 'GUP_RPC'
+GUP_COORDINATOR = 'GUP_COORDINATOR'
 
 def load_env(path):
 	env = {}
@@ -17,7 +18,7 @@ def load_env(path):
 		for line in f.read().splitlines():
 			if '=' not in line: continue
 			key, val = line.split('=',1)
-			if key in (GUP_JOBSERVER, MAKEFLAGS, GUP_RPC):
+			if key in (GUP_JOBSERVER, MAKEFLAGS, GUP_RPC, GUP_COORDINATOR):
 				logging.debug("serialized env: %s=%s" % (key,val))
 			env[key] = val
 	return env
@@ -60,6 +61,37 @@ if not IS_WINDOWS:
 				assert env.get(MAKEFLAGS) is None
 				assert env.get(MAKEFLAGS) is None
 
+	@unittest.skipIf(IS_OCAML, "OCaml uses $GUP_RPC")
+	class TestBuildCoordinator(TestCase):
+		@skipPermutations
+		def test_advertises_coordinator_to_build_scripts(self):
+			self.write('step.gup', BASH + 'env > "$2.env"; echo ok > $1')
+			for jobs in ['-j1', '-j3']:
+				self.build('step', jobs)
+				env = load_env(self.path('step.env'))
+				assert env.get(GUP_COORDINATOR), env.get(GUP_COORDINATOR)
+
+		@skipPermutations
+		def test_coordinator_socket_is_private(self):
+			self.write('step.gup', BASH + 'env > "$2.env"; ls -ld "$(dirname "$GUP_COORDINATOR")" > "$2.perms"; echo ok > $1')
+			self.build('step')
+			socket_dir = os.path.dirname(load_env(self.path('step.env'))[GUP_COORDINATOR])
+			self.assertTrue(self.read('step.perms').startswith('drwx------'), self.read('step.perms'))
+			# and it's removed afterwards
+			self.assertFalse(os.path.exists(socket_dir))
+
+		def test_forwarded_builds_use_the_callers_cwd_and_stdio(self):
+			self.write('dir/input', 'input')
+			self.write('dir/dep.gup', BASH + 'gup -u input; echo "from $PWD" >&2; cat input > "$1"')
+			self.write('target.gup', BASH + 'cd dir; gup -u dep --verbose > ../nested.log 2>&1; cat dep > "$1"')
+			self.build_assert('target', 'input')
+			self.assertTrue('from %s' % self.path('dir') in self.read('nested.log'), self.read('nested.log'))
+
+		def test_forwarded_builds_report_exit_status(self):
+			self.write('fail.gup', '#!false')
+			self.write('target.gup', BASH + 'gup -u fail && exit 1; echo "status $?" > "$1"')
+			self.build_assert('target', 'status 2')
+
 	class TestParallelBuilds(TestCase):
 		def setUp(self):
 			super(TestParallelBuilds, self).setUp()
@@ -160,6 +192,34 @@ if not IS_WINDOWS:
 			self.build('--jobs=10', 'target', 'link/target')
 			self.assertEquals(self.read('target'), '1')
 
+		def test_jobs_check_many_dependencies_after_forking(self):
+			# enough dependencies for their mtimes to be stat()ed on a
+			# thread pool, which forked jobs can't share with their parent
+			sources = ['src-%d' % i for i in range(20)]
+			for source in sources:
+				self.write(source, source)
+			for name in ['a', 'b', 'c']:
+				self.write(name + '.gup', BASH + 'gup -u %s; echo %s >> runs; touch "$1"' % (' '.join(sources), name))
+			self.write('all.gup', BASH + 'gup -u a b c')
+			self.build_u('-j3', 'all')
+			self.build_u('-j3', 'all', 'a', 'b', 'c')
+			self.touch('src-19')
+			self.build_u('-j3', 'all', 'a', 'b', 'c')
+			self.assertEqual(sorted(self.read('runs').split()), ['a', 'a', 'b', 'b', 'c', 'c'])
+
+		@unittest.skipIf(IS_OCAML, "python only")
+		def test_pool_threads_are_stopped_before_forking(self):
+			import threading
+			from gup.state import _shared_pool
+			threads = threading.active_count()
+			_shared_pool.get().submit(time.sleep, 0.1)
+			self.assertGreater(threading.active_count(), threads)
+			pid = os.fork()
+			if pid == 0:
+				os._exit(0)
+			os.waitpid(pid, 0)
+			self.assertEqual(threading.active_count(), threads)
+
 		def test_multiple_targets_with_common_dependency(self):
 			self.write('input.txt', '1')
 			self.write('a.gup', BASH + 'gup -u input.txt ; cat input.txt > "$1" ; echo -n a >> "$1"')
@@ -204,6 +264,58 @@ if not IS_WINDOWS:
 			self.assertEquals(self.read('b'), '1b')
 			self.assertEquals(self.read('c'), '1bc')
 
+		@unittest.skipIf(IS_OCAML, "python only")
+		def test_speculatively_builds_previous_dependencies(self):
+			self.write('input', '1')
+			self.write('slow.gup', BASH + 'gup -u input; sleep ' + str(sleep_time) + '; cat input > "$1"')
+			self.write('fast.gup', BASH + 'gup -u input; cat input > "$1"')
+			# records the contents of `fast` before asking for it
+			self.write('target.gup', BASH + 'gup -u input slow; (cat fast || echo none) > "$1"; gup -u fast')
+			self.build_u('-j3', 'target')
+			self.assertEquals(self.read('target'), 'none')
+
+			self.write('input', '2')
+			self.build_u('-j3', '--speculate', 'target')
+			self.assertEquals(self.read('target'), '2')
+
+			# dependencies are only recorded when the build script asks for them
+			self.write('target.gup', BASH + 'gup -u input; echo ok > "$1"')
+			self.write('input', '3')
+			self.build_u('-j3', '--speculate', 'target')
+			self.assertEquals(self.read('fast'), '3')
+			self.assertNotRebuilds('target', lambda: self.write('fast.gup', echo_to_target('changed')), built=True)
+
+		@unittest.skipIf(IS_OCAML, "python only")
+		def test_speculative_failures_are_not_reported(self):
+			self.write('input', '1')
+			# only succeeds once `target` has prepared for it
+			self.write('dep.gup', BASH + 'gup -u input; cat ready input > "$1"')
+			self.write('target.gup', BASH + 'gup -u input; sleep ' + str(sleep_time) + '; echo ok > ready; gup -u dep; rm ready; cat dep > "$1"')
+			self.build_u('-j3', 'target')
+
+			self.write('input', '2')
+			lines = self.build_u('-j3', '--speculate', 'target', include_logging=True)
+			self.assertEquals(self.read('target'), 'ok\n2')
+			self.assertEqual([line for line in lines if 'ERROR' in line], [])
+
+		@unittest.skipIf(IS_OCAML, "python only")
+		def test_starts_longest_chains_first(self):
+			short = BASH + 'echo "$2" >> started; sleep ' + str(sleep_time / 4.0) + '; echo ok > "$1"'
+			self.write('a.gup', short)
+			self.write('b.gup', short)
+			self.write('dep.gup', BASH + 'sleep ' + str(sleep_time) + '; echo ok > "$1"')
+			self.write('c.gup', BASH + 'echo "$2" >> started; gup -u dep; echo ok > "$1"')
+			self.build('-j2', 'a', 'b', 'c')
+			self.assertEquals(self.read('started').split()[-1], 'c')
+
+			# `c` is quick to build once `dep` is up to date,
+			# but it's at the end of the longest chain
+			os.remove(self.path('started'))
+			self.build('-j2', 'a', 'b', 'c')
+			started = self.read('started').split()
+			self.assertEquals(sorted(started), ['a', 'b', 'c'])
+			self.assertIn('c', started[:2])
+
 	class TestLocking(TestCase):
 		def test_deps_file_is_write_locked_during_build(self):
 			self.write('target.gup', re.sub(r'^\t{4}', '', '''
@@ -41,6 +41,16 @@ class TestBasicRules(TestCase):
 		self.assertRaises(Unbuildable, lambda: self.build("source.txt"))
 		self.assertEqual(self.read("source.txt"), self.source_contents)
 
+	def test_first_matching_script_wins(self):
+		self.write('a.gup', echo_to_target('a'))
+		self.write('b.gup', echo_to_target('b'))
+		self.write("Gupfile", "a.gup:\n\t*.txt\n\t!x*\n\tone\nb.gup:\n\tx*.txt\n\tone\n\ttwo\n\t**")
+		self.build_assert('output.txt', 'a')
+		self.build_assert('xyz.txt', 'b')
+		self.build_assert('one', 'a')
+		self.build_assert('two', 'b')
+		self.build_assert('dir/output.txt', 'b')
+
 	@unittest.skipIf(IS_WINDOWS, 'hard to test on windows')
 	def test_builder_from_PATH(self):
 		self.write('Gupfile', "!write-text-file:\n\t*.txt")
@@ -67,6 +77,20 @@ class TestBasicRules(TestCase):
 		self.assertRebuilds('output.txt', lambda: mutable_env.update(env_with_bin2), env=mutable_env)
 		self.assertEqual(self.read('output.txt'), 'bin2 wrote output.txt')
 
+	def test_modified_gupfile_is_reparsed(self):
+		self.write('Gupfile', 'default.gup:\n\ta')
+		past = time.time() - 60
+		os.utime(self.path('Gupfile'), (past, past))
+		self.build_assert('a', 'a')
+		self.build_u('a')
+		if not IS_OCAML:
+			self.assertTrue(self.exists('.gup/gupfiles'))
+
+		# same size as the original
+		self.write('Gupfile', 'default.gup:\n\tb')
+		self.build_assert('b', 'b')
+		self.assertRaises(Unbuildable, lambda: self.build('c'))
+
 	def test_builder_with_args(self):
 		self.write('Gupfile', "!write-text-file --uppercase:\n\t*.txt")
 		self.skipTest('TODO')
@@ -133,6 +157,41 @@ class TestGupdirectory(TestCase):
 		self.build_assert('bin/foo', 'foo, called from ' + self.path('bin'))
 		self.build_assert('bin/bar', 'bar, called from gup dir ' + self.path('bin'))
 
+	def test_new_builders_are_found_in_previously_searched_directories(self):
+		self.write('default.gup', echo_to_target('default'))
+		self.write('Gupfile', 'default.gup:\n\tb')
+		self.mkdirp('gup')
+		def age_directories():
+			# directories with old mtimes get their builder lookups cached
+			past = time.time() - 60
+			for d in ['.', 'gup']:
+				os.utime(self.path(d), (past, past))
+
+		age_directories()
+		self.build_assert('b', 'default')
+		age_directories()
+		self.build_u('b')
+		if not IS_OCAML:
+			self.assertTrue(self.exists('.gup/builders'))
+
+		self.write('gup/b.gup', echo_to_target('specific'))
+		self.build_assert('b', 'specific')
+
+	@unittest.skipIf(IS_OCAML, 'python only')
+	def test_builder_lookups_are_cached_in_the_project_root(self):
+		self.write('default.gup', echo_to_target('default'))
+		self.write('Gupfile', 'default.gup:\n\t*\n\tsub/*')
+		self.build_assert('top', 'default')
+		self.build('sub/a')
+		self.assertEqual(self.read('sub/a'), 'default')
+		past = time.time() - 60
+		for d in ['.', 'sub']:
+			os.utime(self.path(d), (past, past))
+
+		self.build_u('a', cwd=self.path('sub'))
+		self.assertFalse(self.exists('sub/.gup/builders'))
+		self.assertIn(self.path('sub') + '\t', self.read('.gup/builders'))
+
 class TestBuildableCheck(TestCase):
 	def test_indicates_buildable_file(self):
 		self.write('Gupfile', 'builder:\n\ta')
@@ -56,7 +56,7 @@ def skipPermutations(fn):
 def has_feature(name):
 	return all([name in _build(exe, args=['--features'], cwd=None) for exe in GUP_EXES])
 
-def _build(exe, args, cwd, env=None, include_logging=False, throwing=True):
+def _spawn(exe, args, cwd, env=None, bufsize=-1):
 	env = env or os.environ
 	log.warn("\n\nRunning %s with args: %r [cwd=%r]" % (exe, list(args), cwd))
 	env = env.copy()
@@ -82,7 +82,10 @@ def _build(exe, args, cwd, env=None, include_logging=False, throwing=True):
 	else:
 		raise RuntimeError("Unknown exe_dir: %r" % exe_dir)
 
-	proc = subprocess.Popen(exe_args + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+	return subprocess.Popen(exe_args + list(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, bufsize=bufsize)
+
+def _build(exe, args, cwd, env=None, include_logging=False, throwing=True):
+	proc = _spawn(exe, args, cwd, env)
 
 	child_log = logging.getLogger('out')
 	err = None
@@ -207,6 +210,26 @@ class TestCase(mocktest.TestCase):
 
 		return lines
 
+	def spawn(self, *args, **k):
+		''' start a long-running gup process, returning its Popen object '''
+		self.invocation_count += 1
+		with self._root_cwd():
+			# unbuffered, so that select() is accurate
+			return _spawn(next(self.exes), args=args, cwd=self.ROOT, bufsize=0, **k)
+
+	def wait_for_output(self, proc, text, timeout=10):
+		''' read output of a spawned process until a line contains `text` '''
+		import select
+		deadline = time.time() + timeout
+		while True:
+			ready, _, _ = select.select([proc.stdout], [], [], max(0, deadline - time.time()))
+			if not ready:
+				self.fail("timed out waiting for %r" % (text,))
+			line = proc.stdout.readline().decode('utf-8')
+			self.assertTrue(line, "process exited")
+			if text in line:
+				return line
+
 	def build(self, *targets, **k):
 		return self._build(targets, **k)
 